@@ -0,0 +1,96 @@
+"""
+    Offline benchmarks of the bot's handlers against fake guilds with simulated REST latency and rate limits.
+
+        python -m benchmarks                                   # every scenario
+        python -m benchmarks reaction_storm --quick            # one scenario, a tenth of the size
+        python -m benchmarks --save benchmarks/baseline.json   # record a baseline
+        python -m benchmarks --baseline benchmarks/baseline.json --tolerance 0.25
+
+    With --baseline the run exits with code 1 if any phase got slower (p99), used more memory (peak) or handled
+    fewer operations per second than the baseline by more than the tolerance.
+"""
+import argparse
+import json
+import os
+import sys
+import tracemalloc
+
+from benchmarks.bot import BotUnderTest, load_bot
+from benchmarks.scenarios import SCENARIOS
+
+COLUMNS = ('operations', 'seconds', 'throughput', 'p50_ms', 'p99_ms', 'peak_kb', 'rest_calls', 'rate_limited')
+
+def regressions(results, baseline, tolerance, min_ms):
+    """
+        Describe every phase that is worse than its baseline by more than the tolerance.
+    """
+    failures = []
+    for phase, result in results.items():
+        expected = baseline.get(phase)
+        if expected is None:
+            continue
+        if result['p99_ms'] > max(expected['p99_ms'], min_ms) * (1 + tolerance):
+            failures.append(f"{phase}: p99 {result['p99_ms']}ms, baseline {expected['p99_ms']}ms")
+        if result['peak_kb'] > expected['peak_kb'] * (1 + tolerance):
+            failures.append(f"{phase}: peak memory {result['peak_kb']}KB, baseline {expected['peak_kb']}KB")
+        if result['throughput'] < expected['throughput'] * (1 - tolerance):
+            failures.append(f"{phase}: {result['throughput']} ops/s, baseline {expected['throughput']} ops/s")
+    return failures
+
+def print_table(results):
+    print(f"{'phase':<28}" + "".join(f"{column:>14}" for column in COLUMNS))
+    for phase, result in results.items():
+        print(f"{phase:<28}" + "".join(f"{result[column]:>14}" for column in COLUMNS))
+
+async def run(bench, names, quick):
+    results = {}
+    for name in names:
+        scenario, sizes = SCENARIOS[name]
+        if quick:
+            sizes = {key: max(value // 10, 1) for key, value in sizes.items()}
+        tracemalloc.start()
+        try:
+            measurements = await scenario(bench, **sizes)
+        finally:
+            tracemalloc.stop()
+        for measurement in measurements:
+            results[measurement.name] = measurement.result()
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('scenarios', nargs='*', help=f"scenarios to run, all by default: {', '.join(SCENARIOS)}")
+    parser.add_argument('--quick', action='store_true', help="run every scenario at a tenth of its size")
+    parser.add_argument('--latency', type=float, default=50, help="simulated REST latency in milliseconds")
+    parser.add_argument('--storage', choices=('json', 'sqlite'), default='json')
+    parser.add_argument('--xp-batch-seconds', type=float, default=0.5)
+    parser.add_argument('--save', help="write the results to this file")
+    parser.add_argument('--baseline', help="compare the results with this file")
+    parser.add_argument('--tolerance', type=float, default=0.25, help="allowed relative regression")
+    parser.add_argument('--min-ms', type=float, default=1.0, help="p99 below this is never a regression")
+    args = parser.parse_args()
+    unknown = set(args.scenarios) - set(SCENARIOS)
+    if unknown:
+        parser.error(f"unknown scenarios: {', '.join(sorted(unknown))}")
+    # The bot runs in a scratch directory, resolve the result files first
+    save = os.path.abspath(args.save) if args.save else None
+    baseline = os.path.abspath(args.baseline) if args.baseline else None
+
+    module = load_bot(args.storage, args.xp_batch_seconds)
+    bench = BotUnderTest(module, args.latency / 1000)
+    results = bench.loop.run_until_complete(run(bench, args.scenarios or list(SCENARIOS), args.quick))
+    print_table(results)
+
+    if save:
+        with open(save, 'w') as file:
+            json.dump(results, file, indent=4)
+    if baseline:
+        with open(baseline) as file:
+            failures = regressions(results, json.load(file), args.tolerance, args.min_ms)
+        for failure in failures:
+            print(f"REGRESSION {failure}")
+        if failures:
+            sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,108 @@
+"""
+    Loads programming-helper.py in a scratch directory and wires fake guilds into it, so the benchmarks call the bot's
+    real handlers with nothing but the network replaced.
+"""
+import asyncio
+import importlib.util
+import json
+import os
+import shutil
+import tempfile
+
+from benchmarks.fakes import FakeGuild, FakeREST
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BOT_FILE = os.path.join(REPO_ROOT, 'programming-helper.py')
+
+SNAPSHOT_FILES = ('servers.json', 'roles.json', 'users.json', 'messages.json', 'welcomes.json')
+
+def load_bot(storage_backend, xp_batch_seconds, state_dir=None):
+    """
+        Import the bot module in a temporary working directory, returns the module. Storage starts empty, or as a copy
+        of the files in state_dir (a bot's files/ directory). The directory lives as long as the process,
+        the bot writes its journal and logs there.
+    """
+    directory = tempfile.mkdtemp(prefix='ph-bench-')
+    if state_dir:
+        shutil.copytree(state_dir, os.path.join(directory, 'files'))
+    else:
+        os.makedirs(os.path.join(directory, 'files'))
+        for name in SNAPSHOT_FILES:
+            with open(os.path.join(directory, 'files', name), 'w') as file:
+                json.dump({}, file)
+    os.makedirs(os.path.join(directory, 'logs'))
+    os.chdir(directory)
+
+    os.environ.update(
+        TOKEN='benchmark',
+        STORAGE_BACKEND=storage_backend,
+        XP_BATCH_SECONDS=str(xp_batch_seconds),
+        METRICS_PORT='0',
+        CLUSTER_COUNT='1'
+    )
+    os.environ.pop('TRACE_FILE', None) # never record what the benchmarks feed in
+    spec = importlib.util.spec_from_file_location('programming_helper', BOT_FILE)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+class BotUnderTest:
+    """
+        The loaded bot plus the fake guilds it can see.
+    """
+    def __init__(self, module, latency):
+        self.module = module
+        self.rest = FakeREST(latency)
+
+    @property
+    def loop(self):
+        return self.module.bot.loop
+
+    def register(self, guild):
+        self.module.bot._connection._guilds[guild.id] = guild # what bot.guilds and bot.get_guild read
+        return guild
+
+    def add_replayed_guild(self, guild_id, bot_id):
+        """
+            A guild from a trace, with whatever settings the loaded state has for it.
+        """
+        return self.register(FakeGuild(self.rest, f'guild-{guild_id}', guild_id=guild_id, bot_id=bot_id))
+
+    async def add_guild(self, name, members=0, welcome="Welcome to the server!"):
+        """
+            A guild the bot is in, already set up with ph!setup and ph!welcome, with one level role.
+        """
+        guild = self.register(FakeGuild(self.rest, name, members))
+        guild.level_role = guild.add_role('helper')
+        guild.topic_role = guild.add_role('python')
+
+        server_id = str(guild.id)
+        await self.module.guild_cache.load(server_id)
+        self.module.persist('put', 'server_info', server_id, {
+            "2": guild.level_role.name,
+            "role_ids": {"2": guild.level_role.id},
+            "channel_id": guild.help_channel.id
+        })
+        self.module.persist('put', 'welcome_message', server_id, welcome)
+        return guild
+
+    def track_question(self, guild, author, title="Benchmark question"):
+        """
+            Post a question embed the way ph!ask leaves it, without going through the conversation, returns the message.
+        """
+        message = guild.help_channel.post(guild.bot_member, embed=None)
+        self.module.persist('add', 'messages_data', str(guild.id), message.id, {'author': author.id, 'role': 'python', 'title': title, 'upvotes': 0, 'pinned': False})
+        return message
+
+    async def drain(self):
+        """
+            Wait for the work handlers leave behind: batched experience, queued message deletes and DMs.
+        """
+        module = self.module
+        pending = [module.experience_batcher.flusher] + [queue.flusher for queue in module.cleanup_queues.values()]
+        for task in pending:
+            if task is not None and not task.done():
+                await task
+        while module.dm_dispatcher.pending or module.dm_dispatcher.deliveries:
+            await asyncio.sleep(0.05)
+        await self.loop.run_in_executor(module.storage_executor, module.storage.sync)
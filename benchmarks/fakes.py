@@ -0,0 +1,321 @@
+"""
+    In-memory stand-ins for the Discord objects the bot's handlers touch, backed by a fake REST layer that
+    simulates request latency and per-route rate limit buckets.
+"""
+import asyncio
+import collections
+import itertools
+import time
+
+import discord
+
+DISCORD_EPOCH_MS = 1420070400000
+
+# Requests per window (seconds) of every simulated route bucket, buckets are per channel like on Discord
+ROUTE_LIMITS = {
+    'send_message': (5, 5.0),
+    'add_reaction': (1, 0.25),
+    'remove_reaction': (1, 0.25),
+    'clear_reactions': (1, 0.25),
+    'delete_message': (5, 1.0),
+    'bulk_delete': (1, 1.0),
+    'fetch_message': (50, 1.0),
+    'pin': (5, 5.0),
+    'send_dm': (5, 5.0),
+    'edit_roles': (10, 10.0),
+}
+
+_sequence = itertools.count()
+
+def snowflake():
+    """
+        A fresh ID that sorts by creation time, like Discord's.
+    """
+    return ((int(time.time() * 1000) - DISCORD_EPOCH_MS) << 22) | (next(_sequence) & 0x3FFFFF)
+
+class FakeREST:
+    """
+        Every REST call sleeps for the simulated latency. A call over its bucket's limit waits for the bucket to free up,
+        the way discord.py waits out a 429, and is counted as rate limited.
+    """
+    def __init__(self, latency):
+        self.latency = latency
+        self.calls = collections.Counter()
+        self.rate_limited = collections.Counter()
+        self.history = collections.defaultdict(collections.deque) # (route, bucket) to start times of recent calls
+
+    async def call(self, route, bucket):
+        self.calls[route] += 1
+        limit, window = ROUTE_LIMITS.get(route, (50, 1.0))
+        loop = asyncio.get_event_loop()
+        recent = self.history[(route, bucket)]
+        while True:
+            now = loop.time()
+            while recent and recent[0] <= now - window:
+                recent.popleft()
+            if len(recent) < limit:
+                break
+            self.rate_limited[route] += 1
+            await asyncio.sleep(recent[0] + window - now)
+        recent.append(loop.time())
+        await asyncio.sleep(self.latency)
+
+    def reset(self):
+        self.calls.clear()
+        self.rate_limited.clear()
+        self.history.clear()
+
+class FakeResponse:
+    """
+        What discord.HTTPException reads from an aiohttp response.
+    """
+    def __init__(self, status, reason):
+        self.status = status
+        self.reason = reason
+        self.headers = {}
+
+def not_found(what):
+    return discord.NotFound(FakeResponse(404, 'Not Found'), f'Unknown {what}')
+
+def forbidden(reason):
+    return discord.Forbidden(FakeResponse(403, 'Forbidden'), reason)
+
+class FakePermissions:
+    """
+        Every permission granted, for the permission checks of the commands.
+    """
+    def __getattr__(self, name):
+        return True
+
+class FakeEmoji:
+    def __init__(self, name):
+        self.name = name
+
+    def __str__(self):
+        return self.name
+
+class FakeRole:
+    def __init__(self, name, guild, role_id=None):
+        self.id = role_id or snowflake()
+        self.name = name
+        self.color = 0
+        self.mention = f'<@&{self.id}>'
+        self.guild = guild
+
+    def __str__(self):
+        return self.name
+
+class FakeMember:
+    def __init__(self, guild, name, member_id=None, bot=False):
+        self.id = member_id or snowflake()
+        self.guild = guild
+        self.name = name
+        self.display_name = name
+        self.mention = f'<@{self.id}>'
+        self.avatar_url = f'https://cdn.example/avatars/{self.id}.png'
+        self.roles = []
+        self.bot = bot
+        self.accepts_dms = True
+        self.dms = []
+
+    def __str__(self):
+        return self.name
+
+    async def send(self, content=None, embed=None):
+        await self.guild.rest.call('send_dm', self.id)
+        if not self.accepts_dms:
+            raise forbidden('Cannot send messages to this user')
+        self.dms.append(content)
+
+    async def add_roles(self, *roles, reason=None):
+        for role in roles:
+            await self.guild.rest.call('edit_roles', self.guild.id)
+            self.roles.append(role)
+
+    async def remove_roles(self, *roles, reason=None):
+        for role in roles:
+            await self.guild.rest.call('edit_roles', self.guild.id)
+            if role in self.roles:
+                self.roles.remove(role)
+
+class FakeReaction:
+    def __init__(self, emoji):
+        self.emoji = emoji
+        self.count = 0
+
+class FakeMessage:
+    _state = None # read by commands.Context, only used by its own send which the fakes replace
+
+    def __init__(self, channel, author, content='', embed=None, role_mentions=(), channel_mentions=(), message_id=None):
+        self.id = message_id or snowflake()
+        self.channel = channel
+        self.guild = channel.guild
+        self.author = author
+        self.content = content
+        self.embeds = [embed] if embed is not None else []
+        self.role_mentions = list(role_mentions)
+        self.channel_mentions = list(channel_mentions)
+        self.reactions = []
+        self.pinned = False
+
+    @property
+    def rest(self):
+        return self.guild.rest
+
+    async def add_reaction(self, emoji):
+        await self.rest.call('add_reaction', self.channel.id)
+        reaction = next((reaction for reaction in self.reactions if reaction.emoji == emoji), None)
+        if reaction is None:
+            reaction = FakeReaction(emoji)
+            self.reactions.append(reaction)
+        reaction.count += 1
+
+    async def remove_reaction(self, emoji, member):
+        await self.rest.call('remove_reaction', self.channel.id)
+
+    async def clear_reactions(self):
+        await self.rest.call('clear_reactions', self.channel.id)
+        self.reactions = []
+
+    async def pin(self):
+        await self.rest.call('pin', self.channel.id)
+        self.pinned = True
+
+    async def unpin(self):
+        await self.rest.call('pin', self.channel.id)
+        self.pinned = False
+
+    async def delete(self):
+        await self.rest.call('delete_message', self.channel.id)
+        self.channel.messages.pop(self.id, None)
+
+class FakeTextChannel:
+    def __init__(self, guild, name, channel_id=None):
+        self.id = channel_id or snowflake()
+        self.guild = guild
+        self.name = name
+        self.mention = f'<#{self.id}>'
+        self.messages = {}
+        self.replayed_ids = collections.deque() # IDs the bot's next messages get, to match a recorded trace
+
+    @property
+    def rest(self):
+        return self.guild.rest
+
+    @property
+    def last_message_id(self):
+        return next(reversed(self.messages), None)
+
+    def permissions_for(self, member):
+        return FakePermissions()
+
+    def post(self, author, content='', embed=None, role_mentions=(), channel_mentions=(), message_id=None):
+        """
+            A message from a member, which Discord would announce over the gateway instead of the REST API.
+        """
+        message = FakeMessage(self, author, content, embed, role_mentions, channel_mentions, message_id)
+        self.messages[message.id] = message
+        return message
+
+    async def send(self, content=None, embed=None):
+        await self.rest.call('send_message', self.id)
+        message_id = self.replayed_ids.popleft() if self.replayed_ids else None
+        return self.post(self.guild.bot_member, content or '', embed, message_id=message_id)
+
+    async def fetch_message(self, message_id):
+        await self.rest.call('fetch_message', self.id)
+        if message_id not in self.messages:
+            raise not_found('Message')
+        return self.messages[message_id]
+
+    def get_partial_message(self, message_id):
+        return self.messages.get(message_id) or FakeMessage(self, self.guild.bot_member)
+
+    async def delete_messages(self, messages):
+        messages = list(messages)
+        if not messages:
+            return
+        await self.rest.call('bulk_delete' if len(messages) > 1 else 'delete_message', self.id)
+        for message in messages:
+            self.messages.pop(message.id, None)
+
+class FakeGuild:
+    def __init__(self, rest, name, members=0, guild_id=None, bot_id=None):
+        self.id = guild_id or snowflake()
+        self.rest = rest
+        self.name = name
+        self.members = []
+        self.member_index = {}
+        self.roles = []
+        self.role_index = {}
+        self.channels = []
+        self.channel_index = {}
+        self.bot_member = self.add_member('programming-helper', bot_id, bot=True)
+        self.help_channel = self.add_channel('help')
+        for index in range(members):
+            self.add_member(f'member-{index}')
+
+    @property
+    def me(self):
+        return self.bot_member
+
+    def add_member(self, name, member_id=None, bot=False):
+        member = FakeMember(self, name, member_id, bot)
+        self.members.append(member)
+        self.member_index[member.id] = member
+        return member
+
+    def add_channel(self, name, channel_id=None):
+        channel = FakeTextChannel(self, name, channel_id)
+        self.channels.append(channel)
+        self.channel_index[channel.id] = channel
+        return channel
+
+    def add_role(self, name, role_id=None):
+        role = FakeRole(name, self, role_id)
+        self.roles.append(role)
+        self.role_index[role.id] = role
+        return role
+
+    def get_member(self, member_id):
+        return self.member_index.get(member_id)
+
+    async def fetch_member(self, member_id):
+        await self.rest.call('fetch_member', self.id)
+        if member_id not in self.member_index:
+            raise not_found('Member')
+        return self.member_index[member_id]
+
+    def get_role(self, role_id):
+        return self.role_index.get(role_id)
+
+    def get_channel(self, channel_id):
+        return self.channel_index.get(channel_id)
+
+class FakeReactionPayload:
+    """
+        Carries the fields of discord.RawReactionActionEvent the handlers read.
+    """
+    def __init__(self, channel, message_id, member, emoji, event_type='REACTION_ADD'):
+        self.message_id = message_id
+        self.channel_id = channel.id
+        self.guild_id = channel.guild.id
+        self.user_id = member.id
+        self.member = member if event_type == 'REACTION_ADD' else None
+        self.emoji = FakeEmoji(emoji)
+        self.event_type = event_type
+
+class FakeContext:
+    """
+        The parts of commands.Context the commands read.
+    """
+    def __init__(self, message, command_name):
+        self.message = message
+        self.author = message.author
+        self.guild = message.guild
+        self.channel = message.channel
+        self.invoked_with = command_name
+        self.command = None
+
+    async def send(self, content=None, embed=None):
+        return await self.channel.send(content, embed=embed)
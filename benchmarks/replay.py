@@ -0,0 +1,214 @@
+"""
+    Replays an event trace recorded with TRACE_FILE into the bot's handlers, against fake guilds with simulated REST
+    latency and rate limits. Messages go through on_message and the command machinery, reactions through
+    on_raw_reaction_add/remove, dispatched by the bot like gateway events.
+
+        python -m benchmarks.replay trace.gz                  # original timing
+        python -m benchmarks.replay trace.gz --speed 10       # ten times faster
+        python -m benchmarks.replay trace.gz --speed 0        # as fast as possible
+        python -m benchmarks.replay trace.gz --state backup/files
+
+    Without --state every guild is set up with the channel that got the most reactions as its help channel.
+    The bot's own messages are not replayed, the bot sends them again and they get their recorded IDs, so later
+    reactions find them.
+"""
+import argparse
+import asyncio
+import collections
+import gzip
+import json
+import os
+import sys
+import time
+import zlib
+
+import discord
+from discord.ext import commands
+
+from benchmarks.bot import BotUnderTest, load_bot
+from benchmarks.fakes import FakeReactionPayload
+
+def read_trace(path):
+    """
+        Records of the trace in order, a tail cut off by a crash is skipped.
+    """
+    records = []
+    try:
+        with gzip.open(path, 'rt', encoding='utf-8') as file:
+            for line in file:
+                records.append(json.loads(line))
+    except (EOFError, zlib.error, json.JSONDecodeError):
+        print(f"Trace ends in an incomplete record, replaying the first {len(records)} records.")
+    return records
+
+class ReplayContext(commands.Context):
+    """
+        Context whose send goes to the fake channel instead of discord.py's HTTP client.
+    """
+    async def send(self, content=None, *, embed=None, **kwargs):
+        return await self.channel.send(content, embed=embed)
+
+class ReplayWorld:
+    """
+        Fake guilds, channels, members and roles, created with their recorded IDs the first time the trace mentions them.
+    """
+    def __init__(self, bench):
+        self.bench = bench
+        self.bot_id = None
+        self.guilds = {}
+
+    def guild(self, guild_id):
+        guild = self.guilds.get(guild_id)
+        if guild is None:
+            guild = self.guilds[guild_id] = self.bench.add_replayed_guild(guild_id, self.bot_id)
+        return guild
+
+    def channel(self, guild_id, channel_id):
+        guild = self.guild(guild_id)
+        return guild.get_channel(channel_id) or guild.add_channel(f'channel-{len(guild.channels)}', channel_id)
+
+    def member(self, guild_id, member_id):
+        guild = self.guild(guild_id)
+        return guild.get_member(member_id) or guild.add_member(f'member-{len(guild.members)}', member_id)
+
+    async def sent(self, payload, timeout):
+        """
+            Wait until the bot has sent the reacted message again, a reaction can't be replayed before its message exists.
+        """
+        channel = self.channel(payload.guild_id, payload.channel_id)
+        deadline = asyncio.get_event_loop().time() + timeout
+        while payload.message_id in channel.replayed_ids and asyncio.get_event_loop().time() < deadline:
+            await asyncio.sleep(0.01)
+
+    def role(self, guild_id, role_id, name):
+        guild = self.guild(guild_id)
+        return guild.get_role(role_id) or guild.add_role(name, role_id)
+
+async def prepare(world, records):
+    """
+        Create every guild the trace mentions and hand the bot's recorded message IDs to their channels.
+        Guilds without stored settings get the channel with the most reactions as their help channel.
+    """
+    module = world.bench.module
+    reactions = collections.Counter()
+    for record in records:
+        kind = record[0]
+        if kind == 'h':
+            world.bot_id = record[2]
+        elif kind == 'm' and record[4] == world.bot_id:
+            world.channel(record[2], record[3]).replayed_ids.append(record[5])
+        elif kind in ('r+', 'r-'):
+            reactions[(record[2], record[3])] += 1
+            world.channel(record[2], record[3])
+
+    for guild_id in world.guilds:
+        await module.guild_cache.load(guild_id)
+    for (guild_id, channel_id), _ in reactions.most_common():
+        server_id = str(guild_id)
+        if not module.server_info.get(server_id):
+            module.persist('put', 'server_info', server_id, {"channel_id": channel_id})
+
+def event(world, record):
+    """
+        The gateway event of a record, as (event name, argument), or None for records that are not replayed.
+    """
+    kind = record[0]
+    if kind == 'm':
+        _, _, guild_id, channel_id, author_id, message_id, content, role_mentions, channel_mentions = record
+        if author_id == world.bot_id:
+            return None
+        channel = world.channel(guild_id, channel_id)
+        message = channel.post(
+            world.member(guild_id, author_id),
+            content,
+            role_mentions=[world.role(guild_id, role_id, name) for role_id, name in role_mentions],
+            channel_mentions=[world.channel(guild_id, mentioned_id) for mentioned_id in channel_mentions],
+            message_id=message_id
+        )
+        return 'message', message
+    if kind in ('r+', 'r-'):
+        _, _, guild_id, channel_id, user_id, message_id, emoji = record
+        if user_id == world.bot_id: # the bot seeds its reactions again itself
+            return None
+        event_type = 'REACTION_ADD' if kind == 'r+' else 'REACTION_REMOVE'
+        payload = FakeReactionPayload(world.channel(guild_id, channel_id), message_id, world.member(guild_id, user_id), emoji, event_type)
+        return ('raw_reaction_add' if kind == 'r+' else 'raw_reaction_remove'), payload
+    return None
+
+def commands_handled(module):
+    """
+        Number of commands the bot has run, a replay in which every command failed before running has none.
+    """
+    return sum(histogram.count for histogram in module.metrics.histograms['command_latency_seconds'].values())
+
+async def replay(bench, records, speed, settle):
+    """
+        Dispatch the records at their recorded pace divided by speed, or back to back with speed 0.
+        Returns the number of dispatched events and the seconds it took until every handler finished.
+    """
+    module = bench.module
+    world = ReplayWorld(bench)
+    await prepare(world, records)
+
+    # The bot is logged in as the account that recorded the trace, get_context and the handlers compare against bot.user
+    bot = module.bot
+    bot._connection.user = discord.ClientUser(state=bot._connection, data={
+        "id": world.bot_id or 0, "username": "programming-helper", "discriminator": "0000", "avatar": None
+    })
+    get_context = bot.get_context
+    bot.get_context = lambda message, cls=ReplayContext: get_context(message, cls=cls)
+
+    loop = asyncio.get_event_loop()
+    running = asyncio.all_tasks()
+    start = loop.time()
+    first_timestamp = next((record[1] for record in records), 0)
+    dispatched = 0
+    for record in records:
+        if speed:
+            delay = start + (record[1] - first_timestamp) / 1000 / speed - loop.time()
+            if delay > 0:
+                await asyncio.sleep(delay)
+        gateway_event = event(world, record)
+        if gateway_event is None:
+            continue
+        if gateway_event[0] != 'message':
+            await world.sent(gateway_event[1], settle)
+        bot.dispatch(*gateway_event)
+        dispatched += 1
+        await asyncio.sleep(0) # let the handler run up to its first wait, like a gateway event would
+
+    # Wait for the handlers still running, conversations left open by the trace time out after settle seconds
+    handlers = asyncio.all_tasks() - running
+    if handlers:
+        await asyncio.wait(handlers, timeout=settle)
+    await bench.drain()
+    return dispatched, loop.time() - start
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('trace', help="trace file recorded with TRACE_FILE")
+    parser.add_argument('--speed', type=float, default=1.0, help="replay speed factor, 0 for as fast as possible")
+    parser.add_argument('--state', help="copy of the bot's files/ directory to start from")
+    parser.add_argument('--latency', type=float, default=50, help="simulated REST latency in milliseconds")
+    parser.add_argument('--storage', choices=('json', 'sqlite'), default='json')
+    parser.add_argument('--xp-batch-seconds', type=float, default=2)
+    parser.add_argument('--settle', type=float, default=30, help="seconds to wait for handlers after the last event")
+    args = parser.parse_args()
+
+    records = read_trace(args.trace)
+    module = load_bot(args.storage, args.xp_batch_seconds, os.path.abspath(args.state) if args.state else None)
+    bench = BotUnderTest(module, args.latency / 1000)
+
+    started = time.perf_counter()
+    dispatched, seconds = bench.loop.run_until_complete(replay(bench, records, args.speed, args.settle))
+    print(f"Replayed {dispatched} events in {seconds:.2f}s ({time.perf_counter() - started:.2f}s wall), {sum(bench.rest.calls.values())} REST calls, {sum(bench.rest.rate_limited.values())} rate limited.")
+    for label, histogram in module.metrics.histograms['event_latency_seconds'].items():
+        print(f"{label:<24} {histogram.count:>8} events  p50 {histogram.quantile(0.5) * 1000:8.1f}ms  p99 {histogram.quantile(0.99) * 1000:8.1f}ms")
+    for label, histogram in module.metrics.histograms['command_latency_seconds'].items():
+        print(f"ph!{label:<21} {histogram.count:>8} calls   p50 {histogram.quantile(0.5) * 1000:8.1f}ms  p99 {histogram.quantile(0.99) * 1000:8.1f}ms")
+    if dispatched and not (commands_handled(module) or sum(bench.rest.calls.values())):
+        print("The bot ran no command and made no REST call, the replay did not reach the handlers.")
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,268 @@
+"""
+    Benchmark workloads. Every scenario drives the bot's real handlers against fake guilds and returns one
+    Measurement per phase it times.
+"""
+import asyncio
+import os
+import random
+import time
+import tracemalloc
+
+from benchmarks.fakes import FakeContext, FakeReactionPayload, snowflake
+from benchmarks.replay import commands_handled, read_trace, replay
+
+class Measurement:
+    """
+        Latencies of the operations of one phase, plus the wall time of the whole phase.
+    """
+    def __init__(self, name):
+        self.name = name
+        self.latencies = []
+        self.seconds = 0.0
+        self.peak_bytes = 0
+        self.rest_calls = 0
+        self.rate_limited = 0
+
+    def percentile(self, q):
+        ordered = sorted(self.latencies)
+        return ordered[min(int(q * len(ordered)), len(ordered) - 1)] if ordered else 0.0
+
+    def result(self):
+        return {
+            'operations': len(self.latencies),
+            'seconds': round(self.seconds, 3),
+            'throughput': round(len(self.latencies) / self.seconds, 1) if self.seconds else 0.0,
+            'p50_ms': round(self.percentile(0.50) * 1000, 3),
+            'p99_ms': round(self.percentile(0.99) * 1000, 3),
+            'peak_kb': round(self.peak_bytes / 1024, 1),
+            'rest_calls': self.rest_calls,
+            'rate_limited': self.rate_limited
+        }
+
+async def timed_call(measurement, coroutine):
+    start = time.perf_counter()
+    await coroutine
+    measurement.latencies.append(time.perf_counter() - start)
+
+async def run_phase(bench, measurement, coroutines, concurrency):
+    """
+        Run the coroutines, at most `concurrency` at a time, timing each one and recording the phase's peak memory and REST usage.
+    """
+    coroutines = list(coroutines)
+    rest_calls = sum(bench.rest.calls.values())
+    rate_limited = sum(bench.rest.rate_limited.values())
+    if tracemalloc.is_tracing():
+        tracemalloc.reset_peak()
+
+    start = time.perf_counter()
+    for offset in range(0, len(coroutines), concurrency):
+        await asyncio.gather(*(timed_call(measurement, coroutine) for coroutine in coroutines[offset:offset + concurrency]))
+    measurement.seconds = time.perf_counter() - start
+
+    if tracemalloc.is_tracing():
+        measurement.peak_bytes = tracemalloc.get_traced_memory()[1]
+    measurement.rest_calls = sum(bench.rest.calls.values()) - rest_calls
+    measurement.rate_limited = sum(bench.rest.rate_limited.values()) - rate_limited
+
+async def ask_flow(bench, guild, author, lines):
+    """
+        ph!ask @python, the question in `lines` messages and 'done', the way a member types it.
+    """
+    module = bench.module
+    channel = guild.help_channel
+    command = channel.post(author, f'ph!ask {guild.topic_role.mention}', role_mentions=[guild.topic_role])
+    task = asyncio.ensure_future(module.ask(FakeContext(command, 'ask')))
+    await asyncio.sleep(0) # let ask open its conversation
+    for line in range(lines):
+        await module.on_message(channel.post(author, f'Question line {line}'))
+    await module.on_message(channel.post(author, 'done'))
+    await task
+
+async def questions(bench, guilds, askers, lines):
+    """
+        Members of many guilds asking questions at the same time.
+    """
+    measurement = Measurement('ask')
+    flows = []
+    for index in range(guilds):
+        guild = await bench.add_guild(f'ask-{index}', members=askers)
+        flows.extend(ask_flow(bench, guild, member, lines) for member in guild.members[1:])
+    await run_phase(bench, measurement, flows, len(flows))
+    return [measurement]
+
+async def reaction_storm(bench, members, tracked, events):
+    """
+        Upvotes added and taken back on a handful of questions of one busy guild.
+    """
+    module = bench.module
+    guild = await bench.add_guild('storm', members=members)
+    authors = guild.members[1:tracked + 1]
+    messages = [bench.track_question(guild, author) for author in authors]
+    voters = guild.members[1:]
+
+    rng = random.Random(16)
+    votes = [(rng.choice(messages), rng.choice(voters)) for _ in range(events)]
+    taken_back = votes[::4]
+
+    add = Measurement('reaction_storm.add')
+    await run_phase(bench, add, (module.on_raw_reaction_add(FakeReactionPayload(message.channel, message.id, voter, '⬆️')) for message, voter in votes), 500)
+    remove = Measurement('reaction_storm.remove')
+    await run_phase(bench, remove, (module.on_raw_reaction_remove(FakeReactionPayload(message.channel, message.id, voter, '⬆️', 'REACTION_REMOVE')) for message, voter in taken_back), 500)
+
+    drain = Measurement('reaction_storm.drain')
+    await run_phase(bench, drain, [bench.drain()], 1)
+    return [add, remove, drain]
+
+async def mass_join(bench, guilds, joins):
+    """
+        New members joining a few guilds at once, each welcomed by DM.
+    """
+    module = bench.module
+    joined = []
+    for index in range(guilds):
+        guild = await bench.add_guild(f'join-{index}')
+        joined.extend(guild.add_member(f'newcomer-{number}') for number in range(joins // guilds))
+    for member in joined[::20]: # some members don't accept DMs from server members
+        member.accepts_dms = False
+
+    measurement = Measurement('mass_join')
+    await run_phase(bench, measurement, (module.on_member_join(member) for member in joined), 1000)
+
+    # The welcomes are paced to DM_PER_SECOND on purpose, time a few of them and drop the rest
+    sample = list(module.dm_dispatcher.pending.items())[:50]
+    module.dm_dispatcher.pending.clear()
+    module.dm_dispatcher.pending.update(sample)
+    dms = Measurement('mass_join.dms')
+    await run_phase(bench, dms, [bench.drain()], 1)
+    return [measurement, dms]
+
+async def tracked_questions(bench, guilds, tracked, events):
+    """
+        Thousands of open questions: tracking them, reacting to random ones and compacting the storage.
+    """
+    module = bench.module
+    guild_list = [await bench.add_guild(f'tracked-{index}', members=50) for index in range(guilds)]
+
+    tracked_messages = {guild.id: [] for guild in guild_list}
+
+    async def track(guild, author):
+        tracked_messages[guild.id].append(bench.track_question(guild, author))
+
+    rng = random.Random(16)
+    add = Measurement('tracked_questions.add')
+    await run_phase(bench, add, (track(guild, rng.choice(guild.members[1:])) for guild in guild_list for _ in range(tracked // guilds)), 1000)
+
+    # Upvotes spread over every tracked question
+    targets = []
+    for _ in range(events):
+        guild = rng.choice(guild_list)
+        targets.append((rng.choice(tracked_messages[guild.id]), rng.choice(guild.members[1:])))
+
+    react = Measurement('tracked_questions.react')
+    await run_phase(bench, react, (module.on_raw_reaction_add(FakeReactionPayload(message.channel, message.id, voter, '⬆️')) for message, voter in targets), 500)
+
+    await bench.drain()
+    compact = Measurement('tracked_questions.compact')
+    await run_phase(bench, compact, [module.update_files.coro()], 1)
+    return [add, react, compact]
+
+async def guild_loading(bench, guilds, users):
+    """
+        Guild state loaded on a guild's first event after it was evicted, then served from the cache.
+    """
+    module = bench.module
+    guild_list = [await bench.add_guild(f'cache-{index}') for index in range(guilds)]
+    for guild in guild_list:
+        for number in range(users):
+            module.persist('set', 'user_data', str(guild.id), str(number), {'level': 1, 'experience': number})
+    for guild in guild_list:
+        module.guild_cache.evict(str(guild.id), 'idle')
+    await bench.drain()
+
+    miss = Measurement('guild_loading.miss')
+    await run_phase(bench, miss, (module.guild_cache.load(str(guild.id)) for guild in guild_list), 50)
+    hit = Measurement('guild_loading.hit')
+    await run_phase(bench, hit, (module.guild_cache.load(str(guild.id)) for guild in guild_list for _ in range(10)), 1000)
+    return [miss, hit]
+
+SEARCH_VOCABULARY = ['python', 'list', 'dict', 'asyncio', 'await', 'getUserName', 'os.path.join', 'std::vector', 'c++',
+    'segfault', 'null', 'pointer', 'index', 'error', 'import', 'module', 'class', 'thread', 'lock', 'regex', 'json', 'sql']
+
+async def search_archive(bench, posts, queries):
+    """
+        A guild with a large archive of questions: indexing it, the first search after its search file was closed,
+        and ph!search.
+    """
+    module = bench.module
+    guild = await bench.add_guild('archive', members=20)
+    server_id = str(guild.id)
+    rng = random.Random(16)
+    filler = [f'word{index}' for index in range(5000)]
+    loop = asyncio.get_event_loop()
+
+    def post_text():
+        words = rng.choices(filler, k=rng.randint(10, 60)) + rng.choices(SEARCH_VOCABULARY, k=rng.randint(1, 5))
+        rng.shuffle(words)
+        return ' '.join(words)
+
+    author = guild.members[1]
+    roles = ['python', 'cpp', 'java']
+
+    async def add_post():
+        post = {'kind': 'question', 'author': author.id, 'channel': guild.help_channel.id, 'role': rng.choice(roles), 'title': 'A query', 'text': post_text()}
+        await loop.run_in_executor(module.search_executor, module.search_store.add, server_id, snowflake(), post)
+
+    index = Measurement('search.index')
+    await run_phase(bench, index, [add_post() for _ in range(posts)], 1000)
+    await loop.run_in_executor(module.search_executor, module.search_store.sync)
+
+    def query():
+        return ' '.join(rng.sample(SEARCH_VOCABULARY + filler[:20], rng.randint(1, 4)))
+
+    async def rank(terms, role_name):
+        await loop.run_in_executor(module.search_executor, module.search_store.search, server_id, terms, role_name, module.SEARCH_RESULTS)
+
+    def search(terms):
+        role = guild.topic_role if rng.random() < 0.3 else None
+        content = f"ph!search {terms}" + (f" {role.mention}" if role else "")
+        command = guild.help_channel.post(author, content, role_mentions=[role] if role else [])
+        return module.search(FakeContext(command, 'search'), *content.split()[1:])
+
+    # Nothing is built when a guild's search file is opened again, e.g. after the guild was evicted
+    await loop.run_in_executor(module.search_executor, module.search_store.close, server_id)
+    cold = Measurement('search.cold')
+    await run_phase(bench, cold, [rank(query(), None)], 1)
+
+    # Ranking is what grows with the archive, the command adds one message sent over the (rate limited) REST API
+    ranking = Measurement('search.rank')
+    await run_phase(bench, ranking, [rank(query(), rng.choice([None, 'python'])) for _ in range(queries)], 1)
+    command = Measurement('search.command')
+    await run_phase(bench, command, [search(query()) for _ in range(5)], 1)
+    return [index, cold, ranking, command]
+
+FIXTURE_TRACE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures', 'ask_and_vote.trace.gz')
+
+async def trace_replay(bench):
+    """
+        A small recorded trace, a ph!ask with its question, upvotes and an answer, replayed through bot.dispatch.
+        Fails if the replay did not get the bot to run a command and call the REST API.
+    """
+    module = bench.module
+    records = read_trace(FIXTURE_TRACE)
+    handled = commands_handled(module)
+    measurement = Measurement('replay.fixture')
+    await run_phase(bench, measurement, [replay(bench, records, speed=0, settle=10)], 1)
+    if commands_handled(module) == handled or not measurement.rest_calls:
+        raise RuntimeError(f"Replaying {FIXTURE_TRACE} ran {commands_handled(module) - handled} commands and made {measurement.rest_calls} REST calls")
+    return [measurement]
+
+# Scenario name to (function, default size arguments), `--quick` divides the sizes by 10
+SCENARIOS = {
+    'questions': (questions, {'guilds': 20, 'askers': 5, 'lines': 3}),
+    'reaction_storm': (reaction_storm, {'members': 2000, 'tracked': 20, 'events': 20000}),
+    'mass_join': (mass_join, {'guilds': 5, 'joins': 5000}),
+    'tracked_questions': (tracked_questions, {'guilds': 10, 'tracked': 10000, 'events': 5000}),
+    'guild_loading': (guild_loading, {'guilds': 200, 'users': 500}),
+    'search_archive': (search_archive, {'posts': 100000, 'queries': 1000}),
+    'trace_replay': (trace_replay, {})
+}
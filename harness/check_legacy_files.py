@@ -0,0 +1,65 @@
+"""
+    Starts the bot on a copy of the global JSON files of an older version and checks that every guild comes through the
+    split into per-guild snapshots: values older versions left behind (a cancelled ph!welcome's {}, a list in
+    servers.json) are cleaned without losing the rest of the guild, and a damaged snapshot never becomes a generation.
+
+        python -m harness.check_legacy_files
+"""
+import os
+import sys
+
+from benchmarks.bot import load_bot
+
+FIXTURE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures', 'legacy_files')
+
+def check():
+    module = load_bot('json', 0.5, FIXTURE)
+    module.storage_executor.submit(lambda: None).result() # the storage opens on import, which splits the legacy files
+
+    def load(server_id):
+        return module.storage_executor.submit(module.storage.load_guild, server_id).result()
+
+    failures = []
+    damaged = [name for name in os.listdir(module.GUILDS_DIR) if name.endswith('.damaged')]
+    if damaged:
+        failures.append(f"Snapshots set aside as damaged: {damaged}")
+
+    cancelled_welcome = load('111')
+    if cancelled_welcome.get("welcome_message") != "":
+        failures.append(f"Guild 111's welcome {cancelled_welcome.get('welcome_message')!r} was not cleaned to ''")
+    if set(cancelled_welcome.get("user_data", {})) != {'100', '101'} or len(cancelled_welcome.get("messages_data", ())) != 2:
+        failures.append("Guild 111 lost its users or tracked questions")
+    if cancelled_welcome.get("server_info", {}).get("channel_id") != 741000000000000111:
+        failures.append("Guild 111 lost its setup")
+
+    reset = load('222')
+    if reset.get("server_info") != {}:
+        failures.append(f"Guild 222's server_info {reset.get('server_info')!r} was not cleaned to {{}}")
+    if set(reset.get("user_data", {})) != {'200'}:
+        failures.append(f"Guild 222 kept {sorted(reset.get('user_data', {}))} users instead of only its good record")
+
+    # A damaged snapshot is replaced, the generations keep the last good ones
+    server_id = '333'
+    state = module.empty_state()
+    module.read_guild(state, server_id)
+    module.write_guild(server_id, module.serialize_guild(state, server_id))
+    with open(module.guild_path(server_id), 'w', encoding='UTF-8') as f:
+        f.write('{"version":2,"crc32":1}\n{"user_data"')
+    module.write_guild(server_id, module.serialize_guild(state, server_id))
+    for path in module.snapshot_generations(server_id):
+        if os.path.exists(path) and not module.snapshot_intact(path):
+            failures.append(f"{path} is damaged")
+    if load(server_id).get("welcome_message") != "Welcome to the server!":
+        failures.append("Guild 333 was not read back after its damaged snapshot was replaced")
+    return failures
+
+def main():
+    failures = check()
+    for failure in failures:
+        print(f"FAIL: {failure}")
+    if failures:
+        sys.exit(1)
+    print("OK: legacy files split into per-guild snapshots without losing a guild.")
+
+if __name__ == '__main__':
+    main()
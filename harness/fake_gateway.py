@@ -0,0 +1,171 @@
+"""
+    Local stand-in for the Discord REST API and gateway, just enough for the bot to log in, identify its shards,
+    receive its guilds and be sent events. Needs aiohttp, which discord.py already depends on.
+"""
+import asyncio
+import itertools
+import json
+from datetime import datetime
+from aiohttp import web, WSMsgType
+
+API_PATH = '/api/v7'
+HEARTBEAT_INTERVAL_MS = 41250
+
+BOT_USER = {
+    "id": "741382171515945070",
+    "username": "programming-helper",
+    "discriminator": "0001",
+    "avatar": None,
+    "bot": True
+}
+
+def guild_payload(guild_id):
+    """
+        GUILD_CREATE payload of a guild with one text channel and no cached members.
+    """
+    return {
+        "id": str(guild_id),
+        "name": f"guild-{guild_id}",
+        "unavailable": False,
+        "large": False,
+        "member_count": 1,
+        "owner_id": BOT_USER["id"],
+        "roles": [{"id": str(guild_id), "name": "@everyone", "permissions": 0, "position": 0, "color": 0, "hoist": False, "managed": False, "mentionable": False}],
+        "channels": [{"id": str(guild_id + 1), "type": 0, "name": "help", "position": 0, "guild_id": str(guild_id), "permission_overwrites": []}],
+        "members": [],
+        "emojis": [],
+        "features": [],
+        "voice_states": [],
+        "presences": []
+    }
+
+def member_payload(guild_id, user_id):
+    """
+        GUILD_MEMBER_ADD payload of a new member.
+    """
+    return {
+        "guild_id": str(guild_id),
+        "user": {"id": str(user_id), "username": f"user-{user_id}", "discriminator": "0001", "avatar": None},
+        "roles": [],
+        "joined_at": datetime.utcnow().isoformat(),
+        "deaf": False,
+        "mute": False
+    }
+
+class FakeDiscord:
+    """
+        Serves the REST routes needed to log in and find the gateway, and a gateway that hands every shard its guilds.
+        Guilds go to shard (guild_id >> 22) % shard_count, like on Discord.
+    """
+    def __init__(self, guild_ids, shard_count, host='127.0.0.1', port=0):
+        self.guild_ids = list(guild_ids)
+        self.shard_count = shard_count
+        self.host = host
+        self.port = port
+        self.identifies = {} # shard id to the number of times it identified
+        self.connections = {} # shard id to its open websocket
+        self.sequence = itertools.count(1)
+        self.runner = None
+        self.base_url = None
+
+    def shard_for(self, guild_id):
+        return (guild_id >> 22) % self.shard_count
+
+    async def start(self):
+        """
+            Start serving, returns the API base URL to give the bot as DISCORD_API_BASE.
+        """
+        app = web.Application()
+        app.router.add_get(API_PATH + '/users/@me', self.current_user)
+        app.router.add_get(API_PATH + '/gateway', self.gateway_url)
+        app.router.add_get(API_PATH + '/gateway/bot', self.gateway_url)
+        app.router.add_get('/gateway', self.gateway)
+        app.router.add_route('*', API_PATH + '/{tail:.*}', self.unknown_route)
+
+        self.runner = web.AppRunner(app)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, self.host, self.port)
+        await site.start()
+        self.port = site._server.sockets[0].getsockname()[1]
+        self.base_url = f'http://{self.host}:{self.port}'
+        return self.base_url + API_PATH
+
+    async def stop(self):
+        for ws in list(self.connections.values()):
+            await ws.close()
+        await self.runner.cleanup()
+
+    def json_response(self, data, status=200):
+        """
+            JSON response with a bare application/json content type, discord.py only decodes bodies whose content type
+            is exactly that. web.json_response and text bodies get a charset added.
+        """
+        return web.Response(body=json.dumps(data).encode(), status=status, content_type='application/json')
+
+    async def current_user(self, request):
+        return self.json_response(BOT_USER)
+
+    async def gateway_url(self, request):
+        return self.json_response({
+            "url": f'ws://{self.host}:{self.port}/gateway',
+            "shards": self.shard_count,
+            "session_start_limit": {"total": 1000, "remaining": 1000, "reset_after": 0, "max_concurrency": 16}
+        })
+
+    async def unknown_route(self, request):
+        return self.json_response({"message": "Unknown route", "code": 0}, status=404)
+
+    async def send(self, ws, event, data):
+        await ws.send_str(json.dumps({"op": 0, "s": next(self.sequence), "t": event, "d": data}))
+
+    async def gateway(self, request):
+        ws = web.WebSocketResponse()
+        await ws.prepare(request)
+        await ws.send_str(json.dumps({"op": 10, "d": {"heartbeat_interval": HEARTBEAT_INTERVAL_MS}}))
+
+        shard_id = None
+        async for message in ws:
+            if message.type != WSMsgType.TEXT:
+                continue
+            payload = json.loads(message.data)
+
+            if payload["op"] == 1: # heartbeat
+                await ws.send_str(json.dumps({"op": 11}))
+            elif payload["op"] == 2: # identify
+                shard_id, shard_count = payload["d"].get("shard", [0, 1])
+                self.identifies[shard_id] = self.identifies.get(shard_id, 0) + 1
+                self.connections[shard_id] = ws
+
+                guild_ids = [guild_id for guild_id in self.guild_ids if self.shard_for(guild_id) == shard_id]
+                await self.send(ws, 'READY', {
+                    "v": 6,
+                    "user": BOT_USER,
+                    "guilds": [{"id": str(guild_id), "unavailable": True} for guild_id in guild_ids],
+                    "session_id": f"session-{shard_id}",
+                    "shard": [shard_id, shard_count],
+                    "private_channels": [],
+                    "relationships": []
+                })
+                for guild_id in guild_ids:
+                    await self.send(ws, 'GUILD_CREATE', guild_payload(guild_id))
+
+        if self.connections.get(shard_id) is ws:
+            del self.connections[shard_id]
+        return ws
+
+    async def wait_for_shards(self, timeout):
+        """
+            Wait until every shard has an open gateway connection.
+        """
+        loop = asyncio.get_event_loop()
+        deadline = loop.time() + timeout
+        while len(self.connections) < self.shard_count:
+            if loop.time() > deadline:
+                raise asyncio.TimeoutError(f"Only shards {sorted(self.connections)} of {self.shard_count} connected.")
+            await asyncio.sleep(0.1)
+
+    async def dispatch(self, guild_id, event, data):
+        """
+            Send a gateway event to the shard that owns the guild.
+        """
+        await self.send(self.connections[self.shard_for(guild_id)], event, data)
@@ -0,0 +1,79 @@
+"""
+    Runs the bot as a shard cluster against the fake gateway and checks that every shard is identified exactly once
+    and that every worker writes its guilds into the shared SQLite database.
+
+        python -m harness.run_cluster --clusters 2 --shards 4 --guilds 20
+"""
+import argparse
+import asyncio
+import os
+import sqlite3
+import sys
+import tempfile
+
+from harness.fake_gateway import FakeDiscord, member_payload
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BOT_FILE = os.path.join(REPO_ROOT, 'programming-helper.py')
+
+async def run(clusters, shards, guilds, timeout):
+    guild_ids = [((1000 + index) << 22) | index for index in range(guilds)]
+    fake = FakeDiscord(guild_ids, shards)
+    api_base = await fake.start()
+
+    with tempfile.TemporaryDirectory() as directory:
+        database = os.path.join(directory, 'state.db')
+        env = dict(
+            os.environ,
+            TOKEN='fake-token',
+            DISCORD_API_BASE=api_base,
+            SHARD_COUNT=str(shards),
+            CLUSTER_COUNT=str(clusters),
+            STORAGE_BACKEND='sqlite',
+            SQLITE_FILE=database
+        )
+        launcher = await asyncio.create_subprocess_exec(sys.executable, BOT_FILE, 'cluster', env=env, cwd=REPO_ROOT)
+
+        try:
+            await fake.wait_for_shards(timeout)
+            await asyncio.sleep(3) # let discord.py finish its guild ready wait
+
+            # One new member per guild, each stored by the worker owning the guild's shard
+            for guild_id in guild_ids:
+                await fake.dispatch(guild_id, 'GUILD_MEMBER_ADD', member_payload(guild_id, guild_id + 2))
+            await asyncio.sleep(5) # storage commits every few seconds
+
+            with sqlite3.connect(database) as db:
+                stored_guilds = {int(guild) for (guild,) in db.execute('SELECT DISTINCT guild FROM users')}
+        finally:
+            launcher.terminate()
+            await launcher.wait()
+            await fake.stop()
+
+    failures = []
+    duplicate_shards = {shard_id: count for shard_id, count in fake.identifies.items() if count != 1}
+    if duplicate_shards:
+        failures.append(f"Shards identified more than once: {duplicate_shards}")
+    if set(fake.identifies) != set(range(shards)):
+        failures.append(f"Identified shards {sorted(fake.identifies)} instead of all {shards}")
+    if stored_guilds != set(guild_ids):
+        failures.append(f"{len(set(guild_ids) - stored_guilds)} of {len(guild_ids)} guilds missing from the shared database")
+    return failures
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--clusters', type=int, default=2)
+    parser.add_argument('--shards', type=int, default=4)
+    parser.add_argument('--guilds', type=int, default=20)
+    parser.add_argument('--timeout', type=float, default=60)
+    args = parser.parse_args()
+
+    failures = asyncio.get_event_loop().run_until_complete(run(args.clusters, args.shards, args.guilds, args.timeout))
+    for failure in failures:
+        print(f"FAIL: {failure}")
+    if failures:
+        sys.exit(1)
+    print(f"OK: {args.shards} shards across {args.clusters} clusters, {args.guilds} guilds stored.")
+
+if __name__ == '__main__':
+    main()
@@ -1,24 +1,178 @@
 import os
 import discord
 import logging
+import logging.handlers
+import atexit
+import queue
 import asyncio
 import json
+import bisect
+import heapq
+import itertools
+import collections
+import contextlib
+import sqlite3
+import sys
+import signal
+import subprocess
+import time
+import random
+import functools
+import gzip
+import math
+import re
+import shutil
+import zlib
+from aiohttp import web
+from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor
 from discord.ext import commands, tasks
 from dotenv import load_dotenv
 
+STARTED_AT = time.monotonic() # for the time to READY and to the first command after a restart
+
 load_dotenv()
 TOKEN = os.getenv('TOKEN')
-bot = commands.Bot(command_prefix='ph!')
+
+# Sharding is configured next to the TOKEN in .env. SHARD_COUNT defaults to the count Discord recommends,
+# with CLUSTER_COUNT > 1 `python programming-helper.py cluster` starts that many worker processes, each owning a range of the shards
+SHARD_COUNT = int(os.getenv('SHARD_COUNT')) if os.getenv('SHARD_COUNT') else None
+CLUSTER_COUNT = int(os.getenv('CLUSTER_COUNT', 1))
+CLUSTER_ID = int(os.getenv('CLUSTER_ID', 0))
+# `python programming-helper.py cluster` only starts and waits for the workers, it has no log file or storage of a worker
+SUPERVISOR = __name__ == '__main__' and sys.argv[1:2] == ['cluster']
+
+# Point the bot at a local stand-in for Discord instead, e.g. http://127.0.0.1:8080/api/v7 (used by the harness)
+DISCORD_API_BASE = os.getenv('DISCORD_API_BASE')
+if DISCORD_API_BASE:
+    discord.http.Route.BASE = DISCORD_API_BASE
+
+def cluster_shard_ids(cluster_id, cluster_count, shard_count):
+    """
+        The contiguous range of shards owned by a cluster worker.
+    """
+    shards_per_cluster = -(-shard_count // cluster_count)
+    return list(range(cluster_id * shards_per_cluster, min((cluster_id + 1) * shards_per_cluster, shard_count)))
+
+if CLUSTER_COUNT > 1 and SHARD_COUNT is None:
+    sys.exit("SHARD_COUNT has to be set when running more than one cluster.")
+
+shard_ids = cluster_shard_ids(CLUSTER_ID, CLUSTER_COUNT, SHARD_COUNT) if CLUSTER_COUNT > 1 else None
+bot = commands.AutoShardedBot(command_prefix='ph!', shard_count=SHARD_COUNT, shard_ids=shard_ids)
 bot.remove_command(name='help')
 
+# Logging is configured next to the TOKEN in .env
+LOG_FORMAT = os.getenv('LOG_FORMAT', 'text') # 'text' or 'json', one object per line
+LOG_MAX_BYTES = int(os.getenv('LOG_MAX_BYTES', 10 * 1024 * 1024))
+LOG_ROTATE_WHEN = os.getenv('LOG_ROTATE_WHEN', 'midnight')
+LOG_BACKUP_COUNT = int(os.getenv('LOG_BACKUP_COUNT', 7))
+LOG_SAMPLE_RATES = os.getenv('LOG_SAMPLE_RATES', 'reaction_seed=10') # keep one in every N records of these events
+
+class SizeAndTimeRotatingFileHandler(logging.handlers.TimedRotatingFileHandler):
+    """
+        Rolls the log file over on its time schedule, or earlier once it grows past max_bytes.
+    """
+    def __init__(self, filename, max_bytes, **kwargs):
+        super().__init__(filename, **kwargs)
+        self.max_bytes = max_bytes
+        self.namer = self.unique_name
+
+    @staticmethod
+    def unique_name(default_name):
+        # Size rollovers can happen more than once per time period, don't overwrite the earlier file
+        name, counter = default_name, 1
+        while os.path.exists(name):
+            name, counter = f"{default_name}.{counter}", counter + 1
+        return name
+
+    def shouldRollover(self, record):
+        if self.max_bytes and self.stream is not None and self.stream.tell() >= self.max_bytes:
+            return 1
+        return super().shouldRollover(record)
+
+    def getFilesToDelete(self):
+        # The counters of size rollovers don't sort by age and freed names are used again, so the backups beyond
+        # backupCount are picked by modification time rather than by name
+        directory, base_name = os.path.split(self.baseFilename)
+        prefix = base_name + '.'
+        backups = [os.path.join(directory, name) for name in os.listdir(directory)
+            if name.startswith(prefix) and any(self.extMatch.match(part) for part in name[len(prefix):].split('.'))]
+        if len(backups) <= self.backupCount:
+            return []
+        backups.sort(key=lambda path: (os.path.getmtime(path), path))
+        return backups[:len(backups) - self.backupCount]
+
+class JSONFormatter(logging.Formatter):
+    """
+        Formats records as one JSON object per line, with the tags a record was logged with through `extra`.
+    """
+    tags = ('event', 'guild', 'command', 'latency_ms', 'sample_rate')
+
+    def format(self, record):
+        entry = {
+            "time": self.formatTime(record),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage()
+        }
+        for tag in self.tags:
+            if hasattr(record, tag):
+                entry[tag] = getattr(record, tag)
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry)
+
+class SamplingFilter(logging.Filter):
+    """
+        Keeps one in every N records of each sampled event and tags it with the sample rate, other records pass untouched.
+    """
+    def __init__(self, rates):
+        super().__init__()
+        self.rates = rates
+        self.counts = collections.Counter()
+
+    def filter(self, record):
+        rate = self.rates.get(getattr(record, 'event', None), 1)
+        if rate <= 1:
+            return True
+        self.counts[record.event] += 1
+        if self.counts[record.event] % rate:
+            return False
+        record.sample_rate = rate
+        return True
+
+def parse_sample_rates(setting):
+    rates = {}
+    for pair in filter(None, setting.split(',')):
+        event, _, rate = pair.partition('=')
+        rates[event.strip()] = int(rate)
+    return rates
+
 # setting up logger
 logger = logging.getLogger('discord')
 logger.setLevel(logging.INFO)
 
-# setting the filehandler for logger
-file_handler = logging.FileHandler(filename='logs/programming-helper.log', encoding='UTF-8', mode='w')
-file_handler.setFormatter(logging.Formatter("%(asctime)s : %(levelname)s : %(name)s:%(message)s"))
-logger.addHandler(file_handler)
+# The file handler runs on the listener's thread, the event loop only puts records on the queue
+if SUPERVISOR:
+    log_file = 'logs/programming-helper-supervisor.log'
+elif CLUSTER_COUNT == 1:
+    log_file = 'logs/programming-helper.log'
+else:
+    log_file = f'logs/programming-helper-{CLUSTER_ID}.log'
+file_handler = SizeAndTimeRotatingFileHandler(log_file, max_bytes=LOG_MAX_BYTES, when=LOG_ROTATE_WHEN, backupCount=LOG_BACKUP_COUNT, encoding='UTF-8')
+if LOG_FORMAT == 'json':
+    file_handler.setFormatter(JSONFormatter())
+else:
+    file_handler.setFormatter(logging.Formatter("%(asctime)s : %(levelname)s : %(name)s:%(message)s"))
+
+log_queue = queue.SimpleQueue()
+queue_handler = logging.handlers.QueueHandler(log_queue)
+queue_handler.addFilter(SamplingFilter(parse_sample_rates(LOG_SAMPLE_RATES)))
+logger.addHandler(queue_handler)
+
+log_listener = logging.handlers.QueueListener(log_queue, file_handler)
+log_listener.start()
+atexit.register(log_listener.stop)
 
 # Add your discord emote id here, to add more roles for the bot
 allowed_roles = {
@@ -52,178 +206,2334 @@ messages_data = {}
 custom_roles = {}
 welcome_message = {}
 
-# Previous values to be written in file, on bot close, update from the current info
-prev_messages_data = {}
-prev_user_data = {}
+# ---------------------- Persistence ---------------------- #
+
+# Pick the storage backend next to the TOKEN in .env: 'json' (snapshot files + journal) or 'sqlite'
+STORAGE_BACKEND = os.getenv('STORAGE_BACKEND', 'json')
+SQLITE_FILE = os.getenv('SQLITE_FILE', 'files/state.db')
+
+# Every change to the tables below is appended to the journal as soon as it happens, the snapshot files are only rewritten by the compactor
+JOURNAL_FILE = 'files/journal.log'
+STORAGE_SYNC_SECONDS = 2 # at most this many seconds of changes can be lost on a crash
+
+# Each guild's state has its own snapshot file, a change in one guild never rewrites another guild's file
+GUILDS_DIR = 'files/guilds'
+SCHEMA_VERSION = 2 # of the snapshot files and the SQLite database, version 1 snapshots are a bare JSON object
+SNAPSHOT_GENERATIONS = 3 # replaced snapshots kept next to each guild's file, a damaged snapshot is rolled back to the newest good one
+
+# Guild state is cached in memory, set these next to the TOKEN in .env. Guilds that saw no event for GUILD_IDLE_SECONDS
+# are dropped and loaded again on their next event, beyond GUILD_CACHE_SIZE guilds the least recently used ones are dropped
+GUILD_IDLE_SECONDS = float(os.getenv('GUILD_IDLE_SECONDS', 30 * 60))
+GUILD_CACHE_SIZE = int(os.getenv('GUILD_CACHE_SIZE', 5000))
+GUILD_PREFETCH = os.getenv('GUILD_PREFETCH', '0') == '1' # load the guilds of the READY payload in the background
+
+# The global snapshot files of older versions, split into per-guild snapshots on the first start
+snapshot_files = {
+    "server_info": 'files/servers.json',
+    "custom_roles": 'files/roles.json',
+    "user_data": 'files/users.json',
+    "messages_data": 'files/messages.json',
+    "welcome_message": 'files/welcomes.json'
+}
+
+tables = {
+    "server_info": server_info,
+    "custom_roles": custom_roles,
+    "user_data": user_data,
+    "messages_data": messages_data,
+    "welcome_message": welcome_message
+}
+
+# A single worker keeps every backend call in order and off the event loop
+storage_executor = ThreadPoolExecutor(max_workers=1)
+
+class MessageIndex:
+    """
+        Tracked messages of a guild, mapping each message ID to its info (author ID, role, title, upvotes, pinned).
+        A dict keeps them in insertion order with O(1) membership checks, adds and removals.
+        Serialized as the list messages.json has always held, where messages tracked before info was stored are plain IDs.
+    """
+    __slots__ = ('entries',)
+
+    def __init__(self, messages=()):
+        self.entries = {}
+        for entry in messages:
+            if isinstance(entry, dict):
+                info = dict(entry)
+                self.entries[info.pop('id')] = info
+            else:
+                self.entries[entry] = None
+
+    def __contains__(self, message_id):
+        return message_id in self.entries
+
+    def __iter__(self):
+        return iter(self.entries)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def info(self, message_id):
+        return self.entries.get(message_id)
+
+    def add(self, message_id, info=None):
+        self.entries[message_id] = info
+
+    def update(self, message_id, info):
+        if message_id in self.entries:
+            self.entries[message_id] = info
+
+    def discard(self, message_id):
+        self.entries.pop(message_id, None)
+
+    def expire_before(self, cutoff_id):
+        """
+            Drop every message older than the cutoff and return their IDs. Message IDs grow with time and entries are
+            kept in insertion order, so this only walks the expired entries.
+        """
+        expired = []
+        for message_id in self.entries:
+            if message_id >= cutoff_id:
+                break
+            expired.append(message_id)
+        for message_id in expired:
+            del self.entries[message_id]
+        return expired
+
+    def to_list(self):
+        return [message_id if info is None else dict(info, id=message_id) for message_id, info in self.entries.items()]
+
+# Words, dotted/namespaced identifiers (os.path.join, std::vector) and names like c++ or c#
+WORD_PATTERN = re.compile(r"\w+(?:(?:\.|::|-)\w+)*(?:\+\+|#)?")
+IDENTIFIER_PARTS = re.compile(r"[A-Z]+(?![a-z])|[A-Z]?[a-z]+|[0-9]+") # getHTTPResponse2 -> get, HTTP, Response, 2
+STOP_WORDS = frozenset("a an and are as at be but by can do does for from how i if in is it me my of on or so that the this to was what when why with you".split())
+SEARCH_TEXT_LIMIT = 2000 # characters of a post that are stored and indexed
+SEARCH_TERM_POSTINGS = 1000 # posts a single search term visits at most
+
+@functools.lru_cache(maxsize=65536)
+def word_terms(word):
+    """
+        Search terms of a single word, cached since the same words come up over and over.
+    """
+    lowered = word.lower()
+    terms = [] if lowered in STOP_WORDS else [lowered]
+    parts = [part.lower() for piece in re.split(r'[._:#+-]+', word) if piece for part in IDENTIFIER_PARTS.findall(piece) or [piece]]
+    if len(parts) > 1:
+        terms.extend(part for part in parts if part not in STOP_WORDS)
+    return tuple(terms)
+
+def tokenize(text):
+    """
+        Lowercased search terms of a text. Identifiers are kept whole and also split into their parts, so both
+        `getUserName` and `user name` find a post about getUserName.
+    """
+    return [term for word in WORD_PATTERN.findall(text) for term in word_terms(word)]
+
+# Each guild's posts and their inverted index are kept on their own worker, apart from the guild's state: loading a
+# guild never reads them and searching never holds up the storage worker's writes and fsyncs
+search_executor = ThreadPoolExecutor(max_workers=1)
+SEARCH_DIR = 'files/search' # one SQLite file per guild
+SEARCH_OPEN_FILES = 64 # search files kept open, the least recently used one is closed beyond that
+
+def post_terms(post):
+    return tokenize(f"{post['title']}\n{post['text']}")
+
+class SearchStore:
+    """
+        Questions and answers posted in each guild, with an inverted index from every term to the posts containing it
+        and how often, ranked with BM25. Every guild has a SQLite file under SEARCH_DIR that is created by its first post
+        and updated as posts are added and removed, nothing is built when a guild is loaded or searched.
+        All calls run on the search executor, changes are committed in batches by sync() like SQLiteStorage's.
+    """
+    K1 = 1.2 # how quickly repeating a term stops adding to the score
+    B = 0.75 # how much long posts are penalized
+
+    def __init__(self, directory, open_files):
+        self.directory = directory
+        self.open_files = open_files
+        self.connections = collections.OrderedDict() # server id to its open database, least recently used first
+        self.totals = {} # server id to [number of posts, number of terms in them] of its open database
+        self.pending = set() # guilds with changes that are not committed yet
+
+    def path(self, server_id):
+        return os.path.join(self.directory, f'{server_id}.db')
+
+    def connection(self, server_id, create=False):
+        """
+            The guild's database, or None if the guild has no posts and create is False.
+        """
+        db = self.connections.get(server_id)
+        if db is not None:
+            self.connections.move_to_end(server_id)
+            return db
+        if not create and not os.path.exists(self.path(server_id)):
+            return None
+
+        os.makedirs(self.directory, exist_ok=True)
+        db = sqlite3.connect(self.path(server_id), check_same_thread=False)
+        db.execute('PRAGMA journal_mode=WAL')
+        db.execute('PRAGMA synchronous=NORMAL')
+        db.executescript("""
+            CREATE TABLE IF NOT EXISTS posts (
+                message_id INTEGER PRIMARY KEY,
+                post TEXT NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS terms (
+                id INTEGER PRIMARY KEY,
+                term TEXT NOT NULL UNIQUE,
+                documents INTEGER NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS postings (
+                term INTEGER NOT NULL,
+                message_id INTEGER NOT NULL,
+                count INTEGER NOT NULL,
+                length INTEGER NOT NULL,
+                role TEXT,
+                PRIMARY KEY (term, message_id)
+            ) WITHOUT ROWID;
+            CREATE TABLE IF NOT EXISTS totals (
+                posts INTEGER NOT NULL,
+                length INTEGER NOT NULL
+            );
+            INSERT INTO totals SELECT 0, 0 WHERE NOT EXISTS (SELECT 1 FROM totals);
+        """)
+        self.totals[server_id] = list(db.execute('SELECT posts, length FROM totals').fetchone())
+        self.connections[server_id] = db
+        if len(self.connections) > self.open_files:
+            self.close(next(iter(self.connections)))
+        return db
+
+    def close(self, server_id):
+        db = self.connections.pop(server_id, None)
+        if db is not None:
+            db.commit()
+            db.close()
+        self.totals.pop(server_id, None)
+        self.pending.discard(server_id)
+
+    def add(self, server_id, message_id, post):
+        db = self.connection(server_id, create=True)
+        self.discard(server_id, message_id)
+        terms = collections.Counter(post_terms(post))
+        length = sum(terms.values())
+        db.execute('INSERT INTO posts VALUES (?, ?)', (message_id, json.dumps(post)))
+        db.executemany('INSERT INTO terms (term, documents) VALUES (?, 1) ON CONFLICT (term) DO UPDATE SET documents = documents + 1', [(term,) for term in terms])
+        db.executemany('INSERT INTO postings SELECT id, ?, ?, ?, ? FROM terms WHERE term = ?', [(message_id, count, length, post['role'], term) for term, count in terms.items()])
+        self.count(server_id, 1, length)
+
+    def discard(self, server_id, message_id):
+        db = self.connection(server_id)
+        row = db.execute('SELECT post FROM posts WHERE message_id = ?', (message_id,)).fetchone() if db else None
+        if row is None:
+            return False
+        terms = collections.Counter(post_terms(json.loads(row[0])))
+        db.execute('DELETE FROM posts WHERE message_id = ?', (message_id,))
+        db.executemany('DELETE FROM postings WHERE term = (SELECT id FROM terms WHERE term = ?) AND message_id = ?', [(term, message_id) for term in terms])
+        db.executemany('UPDATE terms SET documents = documents - 1 WHERE term = ?', [(term,) for term in terms])
+        db.executemany('DELETE FROM terms WHERE term = ? AND documents <= 0', [(term,) for term in terms])
+        self.count(server_id, -1, -sum(terms.values()))
+        return True
+
+    def count(self, server_id, posts, length):
+        totals = self.totals[server_id]
+        totals[0] += posts
+        totals[1] += length
+        self.connections[server_id].execute('UPDATE totals SET posts = ?, length = ?', totals)
+        self.pending.add(server_id)
+
+    def expire_before(self, server_id, cutoff_id):
+        """
+            Drop every post older than the cutoff, returns how many.
+        """
+        db = self.connection(server_id)
+        if db is None:
+            return 0
+        expired = [message_id for (message_id,) in db.execute('SELECT message_id FROM posts WHERE message_id < ?', (cutoff_id,))]
+        for message_id in expired:
+            self.discard(server_id, message_id)
+        return len(expired)
+
+    def clear(self, server_id):
+        """
+            Delete every post of the guild.
+        """
+        self.close(server_id)
+        for suffix in ('', '-wal', '-shm'):
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(self.path(server_id) + suffix)
+
+    def sync(self):
+        for server_id in self.pending:
+            self.connections[server_id].commit()
+        self.pending.clear()
+
+    def documents(self, db, terms):
+        """
+            The ID and number of posts of every term that is in some post.
+        """
+        if not terms:
+            return {}
+        return {term: (term_id, documents) for term_id, term, documents in db.execute(f'SELECT id, term, documents FROM terms WHERE term IN ({",".join("?" * len(terms))}) AND documents > 0', terms)}
+
+    def search(self, server_id, query, role=None, limit=5):
+        """
+            The best matching posts as (score, message ID, post), highest score first. Rarer terms are scored first and
+            no term visits more than SEARCH_TERM_POSTINGS posts: common terms only rank the posts rarer terms already
+            matched, or the newest posts containing them if no rarer term matched. So a search stays fast however large
+            the archive grows.
+        """
+        db = self.connection(server_id)
+        if db is None or not self.totals[server_id][0]:
+            return []
+        posts, total_length = self.totals[server_id]
+        terms = sorted(self.documents(db, list(set(tokenize(query)))).values(), key=lambda term: term[1])
+        terms = [(term_id, (self.K1 + 1) * math.log(1 + (posts - documents + 0.5) / (documents + 0.5)), documents) for term_id, documents in terms] # idf * (K1 + 1)
+        if not terms:
+            return []
+
+        # The postings are scored by SQLite. Rare terms visit their newest posts, the common ones only rank the posts matched so far
+        visited = [terms[0]] + [term for term in terms[1:] if term[2] <= SEARCH_TERM_POSTINGS]
+        ranked = [term for term in terms[1:] if term[2] > SEARCH_TERM_POSTINGS]
+        role_filter = ' AND role = ?' if role is not None else ''
+        matched = ' UNION ALL '.join(
+            f'SELECT * FROM (SELECT message_id, count, length, ? AS weight FROM postings WHERE term = ?{role_filter} ORDER BY message_id DESC LIMIT ?)'
+            for _ in visited
+        )
+        also_ranked = ''.join(
+            ' UNION ALL SELECT message_id, count, length, ? FROM postings WHERE term = ? AND message_id IN (SELECT message_id FROM matched)'
+            for _ in ranked
+        )
+        parameters = []
+        for term, weight, _ in visited:
+            parameters.extend([weight, term, role, SEARCH_TERM_POSTINGS] if role is not None else [weight, term, SEARCH_TERM_POSTINGS])
+        # The BM25 length normalization K1 * (1 - B + B * length / average length) split into its constant and per-length parts
+        parameters.extend([self.K1 * (1 - self.B), self.K1 * self.B * posts / max(total_length, 1)])
+        for term, weight, _ in ranked:
+            parameters.extend([weight, term])
+        parameters.append(limit)
+        best = db.execute(
+            f'WITH matched AS ({matched}) SELECT message_id, SUM(weight * count / (count + ? + ? * length)) AS score'
+            f' FROM (SELECT * FROM matched{also_ranked}) GROUP BY message_id ORDER BY score DESC LIMIT ?', parameters
+        ).fetchall()
+        return [(score, message_id, json.loads(db.execute('SELECT post FROM posts WHERE message_id = ?', (message_id,)).fetchone()[0])) for message_id, score in best]
+
+    def self_score(self, server_id, text):
+        """
+            The score a post with exactly this text would get searching for it, to tell how close results come to it.
+        """
+        db = self.connection(server_id)
+        if db is None or not self.totals[server_id][0]:
+            return 0
+        posts, total_length = self.totals[server_id]
+        terms = collections.Counter(tokenize(text))
+        normalized_length = 1 - self.B + self.B * sum(terms.values()) * posts / max(total_length, 1)
+        score = 0
+        found = self.documents(db, list(terms))
+        for term in terms:
+            documents = found.get(term, (None, 0))[1]
+            idf = math.log(1 + (posts - documents + 0.5) / (documents + 0.5))
+            score += idf * terms[term] * (self.K1 + 1) / (terms[term] + self.K1 * normalized_length)
+        return score
+
+    def similar(self, server_id, role, text, similarity, limit=3):
+        """
+            The posts about the role whose score for the text comes within `similarity` of the text's own score.
+        """
+        threshold = similarity * self.self_score(server_id, text)
+        return [result for result in self.search(server_id, text, role, limit) if result[0] >= threshold]
+
+search_store = SearchStore(SEARCH_DIR, SEARCH_OPEN_FILES)
+
+def move_posts(server_id, records):
+    """
+        Older versions kept each guild's posts with its state, as a posts_data entry and journal records. Apply those
+        records to the guild's search file instead, returns once they are committed.
+    """
+    def apply():
+        for op, _, _, *args in records:
+            if op == 'put':
+                search_store.clear(server_id)
+                for post in map(dict, args[0]):
+                    search_store.add(server_id, post.pop('id'), post)
+            elif op == 'add':
+                search_store.add(server_id, *args)
+            elif op == 'discard':
+                search_store.discard(server_id, args[0])
+            elif op == 'expire':
+                search_store.expire_before(server_id, args[0])
+        search_store.sync()
+    search_executor.submit(apply).result()
+
+# Tables whose guild entries are indexes rather than plain JSON, with the type each one is loaded into
+indexed_tables = {
+    "messages_data": MessageIndex
+}
+
+def encode_state(value):
+    """
+        json.dump fallback for the in-memory types that are stored as plain JSON.
+    """
+    if isinstance(value, MessageIndex):
+        return value.to_list()
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+def apply_record(state, record):
+    """
+        Apply a single journal record to the given tables.
+        Every operation is idempotent, so replaying a record that already made it into the snapshot is harmless.
+    """
+    op, table, server_id, *args = record
+    guild_data = state[table]
+
+    if op == 'put': # replace the whole guild entry
+        guild_data[server_id] = indexed_tables[table](args[0]) if table in indexed_tables else args[0]
+    elif op == 'set': # set one key of the guild entry
+        guild_data.setdefault(server_id, {})[args[0]] = args[1]
+    elif op == 'del': # delete one key of the guild entry
+        guild_data.get(server_id, {}).pop(args[0], None)
+    elif op == 'add': # add a message and its info to the guild index
+        guild_data.setdefault(server_id, indexed_tables[table]()).add(*args)
+    elif op == 'update': # replace the info of a message that is still tracked
+        if server_id in guild_data:
+            guild_data[server_id].update(*args)
+    elif op == 'discard': # remove a message from the guild index
+        if server_id in guild_data:
+            guild_data[server_id].discard(args[0])
+    elif op == 'expire': # remove every message older than the cutoff ID from the guild index
+        if server_id in guild_data:
+            guild_data[server_id].expire_before(args[0])
+
+# Type of every table's guild entry, checked when a snapshot is read
+table_schema = {
+    "server_info": dict,
+    "custom_roles": dict,
+    "user_data": dict,
+    "messages_data": list,
+    "welcome_message": str
+}
+
+def valid_record(table, record):
+    """
+        Whether a single record inside a guild entry is one the bot can use.
+    """
+    if table == "user_data":
+        return isinstance(record, dict) and isinstance(record.get('experience'), (int, float))
+    if table == "messages_data":
+        return isinstance(record, int) or (isinstance(record, dict) and isinstance(record.get('id'), int))
+    return True
+
+def clean_guild(data, source):
+    """
+        The tables of a guild as the bot can use them. Only the bad parts are dropped, each one logged: tables this bot
+        doesn't know, entries of the wrong type, which become the table's empty value (a non-str welcome becomes ""),
+        and malformed records inside an entry. Older versions left such values behind, e.g. ph!welcome stored {}.
+    """
+    cleaned = {}
+    for table, value in data.items():
+        schema = table_schema.get(table)
+        if table == "posts_data" and isinstance(value, list): # kept by older versions, read_guild moves it to the search file
+            cleaned[table] = value
+            continue
+        if schema is None:
+            logger.warning(f"{source}: dropped the unknown {table} entry.")
+            metrics.count('snapshot_errors_total', 'result', 'cleaned')
+            continue
+        if not isinstance(value, schema):
+            logger.warning(f"{source}: {table} entry was a {type(value).__name__}, replaced with an empty {schema.__name__}.")
+            metrics.count('snapshot_errors_total', 'result', 'cleaned')
+            value = schema()
+        elif table in ("user_data", "messages_data"):
+            records = value.items() if schema is dict else value
+            good = [record for record in records if valid_record(table, record[1] if schema is dict else record)]
+            if len(good) != len(value):
+                logger.warning(f"{source}: dropped {len(value) - len(good)} malformed {table} records.")
+                metrics.count('snapshot_errors_total', 'result', 'cleaned')
+                value = dict(good) if schema is dict else good
+        cleaned[table] = value
+    return cleaned
+
+def empty_state():
+    return {table: {} for table in tables}
+
+def write_atomic(path, text):
+    """
+        Replace a file atomically, a crash leaves either the old or the new file behind but never half of one.
+    """
+    temp_path = path + '.tmp'
+    with open(temp_path, 'w', encoding='UTF-8') as f:
+        f.write(text)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temp_path, path)
+
+def guild_path(server_id):
+    return os.path.join(GUILDS_DIR, f'{server_id}.json')
+
+def parse_snapshot(text, source):
+    """
+        The tables of a guild snapshot: a header line with the schema version and the CRC32 of the body, then the body.
+        Raises ValueError if the snapshot is damaged, entries that don't match the schema are cleaned (see clean_guild).
+    """
+    header_line, _, body = text.partition('\n')
+    header = json.loads(header_line)
+    if "version" in header:
+        if header["version"] > SCHEMA_VERSION:
+            raise ValueError(f"schema version {header['version']} is newer than this bot's {SCHEMA_VERSION}")
+        if zlib.crc32(body.encode('utf-8')) != header.get("crc32"):
+            raise ValueError("checksum mismatch")
+        data = json.loads(body)
+    else:
+        data = header
+
+    if not isinstance(data, dict):
+        raise ValueError("not a guild snapshot")
+    return clean_guild(data, source)
+
+def snapshot_intact(path):
+    """
+        Whether a snapshot file is whole: its body matches the checksum, or a version 1 snapshot is a JSON object.
+        Cheaper than parse_snapshot, the body of a versioned snapshot is not decoded.
+    """
+    try:
+        with open(path, 'r', encoding='UTF-8') as f:
+            header_line, _, body = f.read().partition('\n')
+        header = json.loads(header_line)
+    except (OSError, ValueError):
+        return False
+    if not isinstance(header, dict):
+        return False
+    return "version" not in header or zlib.crc32(body.encode('utf-8')) == header.get("crc32")
+
+def snapshot_generations(server_id):
+    """
+        The guild's snapshot followed by the ones it replaced, newest first.
+    """
+    path = guild_path(server_id)
+    return [path] + [f'{path}.{generation}' for generation in range(1, SNAPSHOT_GENERATIONS + 1)]
+
+def read_guild(state, server_id):
+    """
+        Read the snapshot of one guild into the given tables. A damaged snapshot is skipped for the newest good one it
+        replaced, if none is good the damaged snapshot is set aside as <id>.json.damaged and the guild starts empty.
+    """
+    for path in snapshot_generations(server_id):
+        if not os.path.exists(path):
+            continue
+        try:
+            with open(path, 'r', encoding='UTF-8') as f:
+                data = parse_snapshot(f.read(), path)
+        except (ValueError, TypeError, UnicodeDecodeError) as error:
+            logger.error(f"Snapshot {path} is damaged: {error}")
+            metrics.count('snapshot_errors_total', 'result', 'damaged')
+            continue
+
+        if path != guild_path(server_id):
+            logger.warning(f"Guild {server_id} was rolled back to {path}.")
+            metrics.count('snapshot_errors_total', 'result', 'rolled_back')
+        posts = data.pop("posts_data", None)
+        for table, value in data.items():
+            state[table][server_id] = indexed_tables[table](value) if table in indexed_tables else value
+        if posts is not None: # moved once, the snapshot is written again without them
+            move_posts(server_id, [['put', 'posts_data', server_id, posts]])
+            write_guild(server_id, serialize_guild(state, server_id))
+        return
+
+    if os.path.exists(guild_path(server_id)):
+        logger.error(f"No good snapshot of guild {server_id} is left, it starts empty.")
+        os.replace(guild_path(server_id), guild_path(server_id) + '.damaged')
+
+def serialize_guild(state, server_id):
+    body = json.dumps({table: guilds[server_id] for table, guilds in state.items() if server_id in guilds}, default=encode_state, separators=(',', ':'))
+    return json.dumps({"version": SCHEMA_VERSION, "crc32": zlib.crc32(body.encode('utf-8'))}) + '\n' + body
+
+def write_guild(server_id, text):
+    """
+        Replace the snapshot of one guild. The replaced snapshot becomes generation 1 and the older ones move up, the
+        oldest is dropped. Generations are hard links to the files they were, so keeping them copies nothing.
+        A damaged snapshot is overwritten without becoming a generation, the generations are the last good ones.
+    """
+    path, *generations = snapshot_generations(server_id)
+    if generations and os.path.exists(path):
+        if not snapshot_intact(path):
+            logger.warning(f"Snapshot {path} is damaged, it is replaced without being kept.")
+        else:
+            for older, newer in reversed(list(zip(generations[1:], generations))):
+                if os.path.exists(newer):
+                    os.replace(newer, older)
+            with contextlib.suppress(FileNotFoundError): # only left when a single generation is kept
+                os.remove(generations[0])
+            try:
+                os.link(path, generations[0])
+            except OSError: # file systems without hard links
+                shutil.copyfile(path, generations[0])
+    write_atomic(path, text)
+
+def read_journal(path):
+    """
+        The records of a journal file grouped by guild, in the order they were written.
+    """
+    records = collections.defaultdict(list)
+    if not os.path.exists(path):
+        return records
+
+    with open(path, 'r', encoding='UTF-8') as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError: # a torn write at the tail of the log, everything before it is intact
+                break
+            records[record[2]].append(record)
+    return records
+
+def fold_journal(path):
+    """
+        Apply the records of a journal file to the snapshots of the guilds they changed, returns the number of records.
+        Snapshots of the other guilds are not touched.
+    """
+    folded = 0
+    for server_id, records in read_journal(path).items():
+        state = empty_state()
+        read_guild(state, server_id)
+        # Older versions journaled the posts with the rest of the guild, they go to its search file
+        posts = [record for record in records if record[1] == "posts_data"]
+        if posts:
+            move_posts(server_id, posts)
+        for record in records:
+            if record[1] != "posts_data":
+                apply_record(state, record)
+        write_guild(server_id, serialize_guild(state, server_id))
+        folded += len(records)
+    return folded
+
+def split_legacy_snapshot():
+    """
+        Split the global snapshot files of older versions into one snapshot per guild. The files are written to a
+        scratch directory that is renamed once complete, an interrupted split simply runs again on the next start.
+    """
+    if os.path.isdir(GUILDS_DIR):
+        return
+
+    state = empty_state()
+    for table, path in snapshot_files.items():
+        if os.path.exists(path):
+            with open(path, 'r') as f:
+                guilds = json.load(f)
+            if not isinstance(guilds, dict):
+                logger.error(f"{path} is not a JSON object of guilds, it is skipped.")
+                continue
+            state[table] = guilds
+    # Older versions left values behind the bot can't use, only those are dropped before the first versioned snapshots
+    for server_id in set().union(*state.values()):
+        data = clean_guild({table: guilds[server_id] for table, guilds in state.items() if server_id in guilds}, f"Legacy guild {server_id}")
+        for table, guilds in state.items():
+            guilds.pop(server_id, None)
+            if table in data:
+                guilds[server_id] = data[table]
+
+    scratch_dir = GUILDS_DIR + '.tmp'
+    os.makedirs(scratch_dir, exist_ok=True)
+    for server_id in set().union(*state.values()):
+        write_atomic(os.path.join(scratch_dir, f'{server_id}.json'), serialize_guild(state, server_id))
+    os.replace(scratch_dir, GUILDS_DIR)
+
+class Storage:
+    """
+        Interface of a persistence backend. The live tables hold the loaded guilds in memory, backends receive every change
+        as a serialized journal record. All calls except open() run on the storage executor, in the order they were made.
+    """
+    def open(self):
+        """
+            Prepare the stored state, called once before the bot runs.
+        """
+
+    def load_guild(self, server_id):
+        """
+            Return the stored value of every table the guild has an entry in.
+        """
+        raise NotImplementedError
+
+    def evict_guild(self, server_id, text):
+        """
+            Store the serialized state of a guild that is dropped from memory.
+        """
+
+    def write(self, line):
+        """
+            Persist a single serialized record.
+        """
+        raise NotImplementedError
+
+    def sync(self):
+        """
+            Make the records written so far durable.
+        """
+
+    def compact(self):
+        """
+            Reclaim space used by old records, returns the number of records compacted.
+        """
+        return 0
+
+class JSONStorage(Storage):
+    """
+        One snapshot file per guild under files/guilds/ plus an append-only journal that is fsynced every few seconds.
+        The compactor folds the journal into the snapshots of the guilds it changed.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.rotated_path = path + '.1'
+        self.file = None
+        self.dirty = False
+
+    def open(self):
+        # Bring every snapshot up to date, so a guild only needs its own file when it is loaded
+        split_legacy_snapshot()
+        for path in (self.rotated_path, self.path):
+            if os.path.exists(path):
+                fold_journal(path)
+                os.remove(path)
+        self.file = open(self.path, 'a', encoding='UTF-8')
+
+    def guild_ids(self):
+        return [name[:-len('.json')] for name in os.listdir(GUILDS_DIR) if name.endswith('.json')]
+
+    def load_guild(self, server_id):
+        state = empty_state()
+        read_guild(state, server_id)
+        return {table: guilds[server_id] for table, guilds in state.items() if server_id in guilds}
+
+    def evict_guild(self, server_id, text):
+        # The journal may still hold this guild's records, folding them again later changes nothing since they are idempotent
+        write_guild(server_id, text)
+
+    def write(self, line):
+        self.file.write(line + '\n')
+        self.dirty = True
+
+    def sync(self):
+        if self.dirty:
+            self.file.flush()
+            os.fsync(self.file.fileno())
+            self.dirty = False
+
+    def compact(self):
+        # A rotated journal left behind by a failed compaction is folded in first, the current one waits for the next run
+        if not os.path.exists(self.rotated_path):
+            self.sync()
+            self.file.close()
+            os.replace(self.path, self.rotated_path)
+            self.file = open(self.path, 'a', encoding='UTF-8')
+
+        folded = fold_journal(self.rotated_path)
+        os.remove(self.rotated_path)
+        return folded
+
+class SQLiteStorage(Storage):
+    """
+        Indexed SQLite database, changes are committed in batches every few seconds.
+    """
+    config_tables = ("server_info", "custom_roles", "welcome_message")
+
+    def __init__(self, path):
+        self.path = path
+        self.pending = 0
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        self.connection.executescript("""
+            CREATE TABLE IF NOT EXISTS users (
+                guild TEXT NOT NULL,
+                user TEXT NOT NULL,
+                level INTEGER NOT NULL,
+                experience INTEGER NOT NULL,
+                PRIMARY KEY (guild, user)
+            ) WITHOUT ROWID;
+            CREATE TABLE IF NOT EXISTS messages (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                guild TEXT NOT NULL,
+                message_id INTEGER NOT NULL,
+                info TEXT,
+                UNIQUE (guild, message_id)
+            );
+            CREATE TABLE IF NOT EXISTS config (
+                name TEXT NOT NULL,
+                guild TEXT NOT NULL,
+                value TEXT NOT NULL,
+                PRIMARY KEY (name, guild)
+            ) WITHOUT ROWID;
+        """)
+
+    def open(self):
+        # The schema version is stamped into the database, databases written by a newer bot are not touched
+        version = self.connection.execute('PRAGMA user_version').fetchone()[0]
+        if version > SCHEMA_VERSION:
+            raise RuntimeError(f"{self.path} has schema version {version}, newer than this bot's {SCHEMA_VERSION}")
+        self.connection.execute(f'PRAGMA user_version = {SCHEMA_VERSION}')
+        problems = [row[0] for row in self.connection.execute('PRAGMA quick_check')]
+        if problems != ['ok']:
+            logger.error(f"Integrity check of {self.path} failed: {'; '.join(problems[:5])}")
+            metrics.count('snapshot_errors_total', 'result', 'damaged')
+
+        # Older versions kept the posts in this database, they move to each guild's search file once
+        if self.connection.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'posts'").fetchone():
+            guilds = collections.defaultdict(list)
+            for server_id, message_id, post in self.connection.execute('SELECT guild, message_id, post FROM posts ORDER BY message_id'):
+                guilds[server_id].append(dict(json.loads(post), id=message_id))
+            for server_id, posts in guilds.items():
+                move_posts(server_id, [['put', 'posts_data', server_id, posts]])
+            self.connection.execute('DROP TABLE IF EXISTS posts')
+            self.connection.commit()
+
+    def load_guild(self, server_id):
+        data = {}
+        db = self.connection
+        users = {user: {'level': level, 'experience': experience} for user, level, experience in db.execute('SELECT user, level, experience FROM users WHERE guild = ?', (server_id,))}
+        if users:
+            data["user_data"] = users
+        messages = [message_id if info is None else dict(json.loads(info), id=message_id) for message_id, info in db.execute('SELECT message_id, info FROM messages WHERE guild = ? ORDER BY id', (server_id,))]
+        if messages:
+            data["messages_data"] = MessageIndex(messages)
+        for name, value in db.execute('SELECT name, value FROM config WHERE guild = ?', (server_id,)):
+            data[name] = json.loads(value)
+        return data
+
+    def write(self, line):
+        op, table, server_id, *args = json.loads(line)
+        db = self.connection
+
+        if table == "user_data":
+            if op == 'put':
+                db.execute('DELETE FROM users WHERE guild = ?', (server_id,))
+                db.executemany('INSERT INTO users VALUES (?, ?, ?, ?)', [(server_id, user, record['level'], record['experience']) for user, record in args[0].items()])
+            elif op == 'set':
+                db.execute('INSERT OR REPLACE INTO users VALUES (?, ?, ?, ?)', (server_id, args[0], args[1]['level'], args[1]['experience']))
+            elif op == 'del':
+                db.execute('DELETE FROM users WHERE guild = ? AND user = ?', (server_id, args[0]))
+        elif table == "messages_data":
+            if op == 'put':
+                db.execute('DELETE FROM messages WHERE guild = ?', (server_id,))
+                entries = MessageIndex(args[0]).entries.items()
+                db.executemany('INSERT OR IGNORE INTO messages (guild, message_id, info) VALUES (?, ?, ?)', [(server_id, message_id, info and json.dumps(info)) for message_id, info in entries])
+            elif op == 'add':
+                info = args[1] if len(args) > 1 else None
+                db.execute('INSERT OR REPLACE INTO messages (guild, message_id, info) VALUES (?, ?, ?)', (server_id, args[0], info and json.dumps(info)))
+            elif op == 'update':
+                db.execute('UPDATE messages SET info = ? WHERE guild = ? AND message_id = ?', (json.dumps(args[1]), server_id, args[0]))
+            elif op == 'discard':
+                db.execute('DELETE FROM messages WHERE guild = ? AND message_id = ?', (server_id, args[0]))
+            elif op == 'expire':
+                db.execute('DELETE FROM messages WHERE guild = ? AND message_id < ?', (server_id, args[0]))
+        else:
+            # Guild config is small, apply the record to the stored value and write it back
+            row = db.execute('SELECT value FROM config WHERE name = ? AND guild = ?', (table, server_id)).fetchone()
+            state = {table: {server_id: json.loads(row[0])} if row else {}}
+            apply_record(state, [op, table, server_id, *args])
+            db.execute('INSERT OR REPLACE INTO config VALUES (?, ?, ?)', (table, server_id, json.dumps(state[table][server_id])))
+        self.pending += 1
+
+    def sync(self):
+        self.connection.commit()
+
+    def compact(self):
+        self.connection.commit()
+        self.connection.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+        compacted, self.pending = self.pending, 0
+        return compacted
+
+def migrate_json_to_sqlite(path):
+    """
+        One-shot import of the JSON snapshot files and journal into a SQLite database.
+    """
+    source = JSONStorage(JOURNAL_FILE)
+    storage_executor.submit(source.open).result() # after the bot's own storage has opened
+    target = SQLiteStorage(path)
+    migrated = 0
+    for server_id in source.guild_ids():
+        for table, value in source.load_guild(server_id).items():
+            target.write(json.dumps(['put', table, server_id, value], default=encode_state))
+            migrated += 1
+    target.sync()
+    target.compact()
+    return migrated
+
+def log_storage_error(future):
+    """
+        Done callback for backend writes, which nobody awaits.
+    """
+    if future.exception() is not None:
+        logger.error(f"Storage write failed: {future.exception()}")
+
+def store_evicted_guild(server_id, state):
+    storage.evict_guild(server_id, serialize_guild(state, server_id))
+
+def busy_guilds():
+    """
+        Guilds with work in flight that will change their state, they are never evicted.
+    """
+    return {str(guild_id) for guild_id, _ in conversations.users} | {str(guild_id) for guild_id, _ in experience_batcher.pending}
+
+class GuildCache:
+    """
+        The guilds whose state is in the tables. A guild is loaded from storage on its first event, once however many
+        events wait for it. Beyond the capacity the least recently used guilds are evicted, guilds without events
+        for idle_seconds are evicted by a background task. A changed guild's snapshot is written before it is evicted.
+    """
+    def __init__(self, capacity, idle_seconds):
+        self.capacity = capacity
+        self.idle_seconds = idle_seconds
+        self.last_used = collections.OrderedDict() # server id to the time it was last used, least recently used first
+        self.loading = {} # server id to the task loading it
+        self.dirty = set() # loaded guilds changed since their snapshot was last written
+
+    def __contains__(self, server_id):
+        return server_id in self.last_used
+
+    def __len__(self):
+        return len(self.last_used)
+
+    def touch(self, server_id):
+        self.last_used[server_id] = time.monotonic()
+        self.last_used.move_to_end(server_id)
+
+    async def load(self, server_id):
+        """
+            Make sure the guild's state is in the tables.
+        """
+        server_id = str(server_id)
+        if server_id in self.last_used:
+            metrics.count('guild_cache_total', 'result', 'hit')
+            self.touch(server_id)
+            return
+
+        metrics.count('guild_cache_total', 'result', 'miss')
+        task = self.loading.get(server_id)
+        if task is None:
+            task = self.loading[server_id] = asyncio.ensure_future(self.fetch(server_id))
+        await asyncio.shield(task) # an event that gets cancelled doesn't cancel the load other events wait for
+
+    async def fetch(self, server_id):
+        start = time.perf_counter()
+        try:
+            data = await asyncio.get_event_loop().run_in_executor(storage_executor, storage.load_guild, server_id)
+        finally:
+            del self.loading[server_id]
+        if server_id not in self.last_used: # a change loaded it meanwhile
+            self.install(server_id, data)
+        metrics.observe('guild_load_seconds', 'backend', STORAGE_BACKEND, time.perf_counter() - start)
+        self.evict_overflow()
+
+    def load_now(self, server_id):
+        """
+            Load the guild while blocking the event loop, for changes that reach a guild no event loaded.
+        """
+        logger.warning(f"Guild {server_id} was changed before it was loaded, loading it now.")
+        self.install(server_id, storage_executor.submit(storage.load_guild, server_id).result())
+
+    def install(self, server_id, data):
+        for table, value in data.items():
+            tables[table][server_id] = value
+        self.touch(server_id)
+
+    def evict(self, server_id, reason):
+        detached = {table: {server_id: guilds.pop(server_id)} for table, guilds in tables.items() if server_id in guilds}
+        if server_id in self.dirty:
+            # Nothing on the event loop reaches the detached entries anymore, the storage worker serializes them
+            storage_executor.submit(store_evicted_guild, server_id, detached).add_done_callback(log_storage_error)
+            self.dirty.discard(server_id)
+        level_tables.pop(server_id, None)
+        rankings.pop(server_id, None)
+        role_thumbnails.pop(server_id, None)
+        del self.last_used[server_id]
+        metrics.count('guild_evictions_total', 'reason', reason)
+
+    def evict_overflow(self):
+        overflow = len(self.last_used) - self.capacity
+        if overflow > 0:
+            busy = busy_guilds()
+            for server_id in [server_id for server_id in self.last_used if server_id not in busy][:overflow]:
+                self.evict(server_id, 'capacity')
+
+    def evict_idle(self):
+        """
+            Evict every guild without events for idle_seconds, returns how many were evicted.
+        """
+        busy = busy_guilds()
+        cutoff = time.monotonic() - self.idle_seconds
+        idle = [server_id for server_id, last_used in self.last_used.items() if last_used < cutoff and server_id not in busy]
+        for server_id in idle:
+            self.evict(server_id, 'idle')
+        return len(idle)
+
+    async def prefetch(self, server_ids):
+        """
+            Load the guilds one by one in the background, as long as there is room for them.
+        """
+        start = time.perf_counter()
+        loaded = 0
+        for server_id in server_ids:
+            if len(self.last_used) >= self.capacity:
+                break
+            if server_id not in self.last_used:
+                await self.load(server_id)
+                loaded += 1
+        logger.info(f"Prefetched {loaded} guilds in {time.perf_counter() - start:.1f}s.", extra={'event': 'prefetch'})
+
+guild_cache = GuildCache(GUILD_CACHE_SIZE, GUILD_IDLE_SECONDS)
+
+def persist(*record):
+    """
+        Apply a change to the live tables and hand it to the storage backend.
+        The live tables are updated from the serialized record so they always match what a replay would produce.
+    """
+    server_id = record[2]
+    if server_id not in guild_cache: # changes have to be applied on top of the stored state
+        guild_cache.load_now(server_id)
+    guild_cache.touch(server_id)
+    guild_cache.dirty.add(server_id)
+
+    line = json.dumps(record)
+    apply_record(tables, json.loads(line))
+    storage_executor.submit(storage.write, line).add_done_callback(log_storage_error)
+
+if SUPERVISOR: # the workers open the storage
+    storage = None
+elif STORAGE_BACKEND == 'sqlite':
+    storage = SQLiteStorage(SQLITE_FILE)
+else:
+    storage = JSONStorage(JOURNAL_FILE)
 
-# Load the data from the file before the bot runs
-with open('files/servers.json','r') as f:
-    server_info = json.load(f)
 
-with open('files/roles.json','r') as f:
-    custom_roles = json.load(f)
+# ---------------------- Metrics ---------------------- #
 
-with open('files/users.json','r') as f:
-    user_data = json.load(f)
-prev_user_data.update(user_data.copy())
+# Prometheus text endpoint on 127.0.0.1, every cluster worker serves on METRICS_PORT + its cluster id, set to 0 to disable
+METRICS_PORT = int(os.getenv('METRICS_PORT', 9108))
+LOOP_LAG_INTERVAL_SECONDS = 0.5
 
-with open('files/messages.json','r') as f:
-    messages_data = json.load(f)
-prev_messages_data.update(messages_data.copy())  
+# Upper bounds in seconds, the last bucket catches conversations that wait on the user for minutes
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300, float('inf'))
 
-with open('files/welcomes.json','r') as f:
-    welcome_message = json.load(f)
+class Histogram:
+    """
+        Counts observations into fixed buckets, like a Prometheus histogram.
+    """
+    __slots__ = ('counts', 'count', 'sum')
+
+    def __init__(self):
+        self.counts = [0] * len(LATENCY_BUCKETS)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(LATENCY_BUCKETS, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def quantile(self, q):
+        """
+            Estimate of the q-quantile, interpolated inside the bucket it falls in.
+        """
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for index, bucket_count in enumerate(self.counts):
+            if seen + bucket_count >= rank and bucket_count:
+                lower = LATENCY_BUCKETS[index - 1] if index else 0.0
+                upper = LATENCY_BUCKETS[index] if index < len(LATENCY_BUCKETS) - 1 else lower
+                return lower + (upper - lower) * (rank - seen) / bucket_count
+            seen += bucket_count
+        return LATENCY_BUCKETS[-2]
+
+class Metrics:
+    """
+        Latency histograms and counters, keyed by metric name and one label value.
+    """
+    def __init__(self):
+        self.histograms = collections.defaultdict(lambda: collections.defaultdict(Histogram))
+        self.counters = collections.defaultdict(collections.Counter)
+        self.label_names = {}
+
+    def observe(self, name, label_name, label, seconds):
+        self.label_names[name] = label_name
+        self.histograms[name][label].observe(seconds)
+
+    def count(self, name, label_name, label, amount=1):
+        self.label_names[name] = label_name
+        self.counters[name][label] += amount
+
+    def render(self):
+        """
+            All metrics in the Prometheus text exposition format.
+        """
+        lines = []
+        for name, histograms in self.histograms.items():
+            label_name = self.label_names[name]
+            lines.append(f"# TYPE {name} histogram")
+            for label, histogram in histograms.items():
+                cumulative = 0
+                for bound, bucket_count in zip(LATENCY_BUCKETS, histogram.counts):
+                    cumulative += bucket_count
+                    le = '+Inf' if bound == float('inf') else repr(bound)
+                    lines.append(f'{name}_bucket{{{label_name}="{label}",le="{le}"}} {cumulative}')
+                lines.append(f'{name}_sum{{{label_name}="{label}"}} {histogram.sum}')
+                lines.append(f'{name}_count{{{label_name}="{label}"}} {histogram.count}')
+        for name, counter in self.counters.items():
+            label_name = self.label_names[name]
+            lines.append(f"# TYPE {name} counter")
+            for label, value in counter.items():
+                lines.append(f'{name}{{{label_name}="{label}"}} {value}')
+        lines.append("# TYPE conversations_in_flight gauge")
+        lines.append(f"conversations_in_flight {conversations.in_flight}")
+        lines.append("# TYPE guilds_loaded gauge")
+        lines.append(f"guilds_loaded {len(guild_cache)}")
+        lines.append("# TYPE dm_queue_length gauge")
+        lines.append(f"dm_queue_length {len(dm_dispatcher)}")
+        lines.append("# TYPE gateway_latency_seconds gauge")
+        lines.append(f"gateway_latency_seconds {bot.latency}")
+        return "\n".join(lines) + "\n"
+
+metrics = Metrics()
+
+def timed(event):
+    """
+        Decorator recording the run time of an event handler or background task in the event latency histogram.
+    """
+    def decorator(handler):
+        @functools.wraps(handler)
+        async def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return await handler(*args, **kwargs)
+            finally:
+                metrics.observe('event_latency_seconds', 'event', event, time.perf_counter() - start)
+        return wrapper
+    return decorator
+
+async def counted_request(route, **kwargs):
+    """
+        Stands in for bot.http.request to count REST calls and failures per route.
+    """
+    route_name = f"{route.method} {route.path}"
+    metrics.count('rest_requests_total', 'route', route_name)
+    try:
+        return await discord.http.HTTPClient.request(bot.http, route, **kwargs)
+    except discord.HTTPException as error:
+        metrics.count('rest_errors_total', 'route', f"{route_name} {error.status}")
+        raise
+
+bot.http.request = counted_request
+
+class RateLimitCounter(logging.Handler):
+    """
+        Counts the 429s discord.py's HTTP client waits out itself, by route, from its rate limit warnings.
+    """
+    def emit(self, record):
+        message = record.getMessage()
+        if message.startswith('We are being rate limited'):
+            bucket = str(record.args[-1]) if record.args else 'unknown'
+            metrics.count('rest_rate_limits_total', 'route', bucket.rpartition(':')[2])
+        elif 'Global rate limit' in message:
+            metrics.count('rest_rate_limits_total', 'route', 'global')
+
+logging.getLogger('discord.http').addHandler(RateLimitCounter(level=logging.WARNING))
+
+async def sample_loop_lag():
+    """
+        Sleep a fixed interval over and over and record how late the event loop wakes up.
+    """
+    loop = asyncio.get_event_loop()
+    while True:
+        start = loop.time()
+        await asyncio.sleep(LOOP_LAG_INTERVAL_SECONDS)
+        metrics.observe('event_loop_lag_seconds', 'cluster', CLUSTER_ID, max(loop.time() - start - LOOP_LAG_INTERVAL_SECONDS, 0))
+
+async def serve_metrics(request):
+    return web.Response(text=metrics.render(), content_type='text/plain', charset='utf-8')
+
+async def start_metrics_server():
+    app = web.Application()
+    app.router.add_get('/metrics', serve_metrics)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, '127.0.0.1', METRICS_PORT + CLUSTER_ID).start()
+    logger.info(f"Serving metrics on http://127.0.0.1:{METRICS_PORT + CLUSTER_ID}/metrics")
+
+metrics_started = False
+
+# ---------------------- Event Trace ---------------------- #
+
+# Record message creates and reactions to replay them offline with `python -m benchmarks.replay`, set TRACE_FILE next to the TOKEN in .env
+TRACE_FILE = os.getenv('TRACE_FILE')
+TRACE_FLUSH_SECONDS = 5 # at most this many seconds of events are lost on a crash
+TRACE_KEYWORDS = {'done', 'nope', 'yes'} # conversation answers the bot acts on
+
+class TraceWriter:
+    """
+        Appends events to a gzip trace, one compact JSON array per line. Every flush appends its records as a complete
+        gzip member, so the file stays readable after each flush and is never rewritten.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.records = []
+
+    def record(self, kind, *fields):
+        self.records.append(json.dumps([kind, int(time.time() * 1000), *fields], separators=(',', ':'), ensure_ascii=False))
+
+    def flush(self):
+        records, self.records = self.records, []
+        if records:
+            with open(self.path, 'ab') as file:
+                file.write(gzip.compress(('\n'.join(records) + '\n').encode('utf-8')))
+
+trace = TraceWriter(TRACE_FILE) if TRACE_FILE else None
+if trace is not None:
+    atexit.register(trace.flush)
+
+def scrub_word(match):
+    word = match.group()
+    if word.isdigit() or (word.startswith('<') and word.endswith('>')):
+        return word
+    return 'x' * len(word)
+
+def scrub_content(content):
+    """
+        Helper function that strips what users wrote from a message and keeps what the bot acts on:
+        command names, conversation keywords, numbers and mentions. Anything else only keeps its length,
+        so command arguments other than numbers and mentions become runs of x of the same length.
+    """
+    words = content.split()
+    if content.startswith(bot.command_prefix):
+        name = words[0][len(bot.command_prefix):]
+        if name not in bot.all_commands:
+            name = 'x' * len(name)
+        return bot.command_prefix + name + re.sub(r'\S+', scrub_word, content[len(words[0]):])
+    if content.strip().lower() in TRACE_KEYWORDS or content.strip().isdigit():
+        return content
+    if words and all(word.startswith('<') and word.endswith('>') for word in words):
+        return content
+    return 'x' * len(content)
+
+def trace_message(message):
+    if message.guild is None:
+        return
+    trace.record('m', message.guild.id, message.channel.id, message.author.id, message.id, scrub_content(message.content),
+        [[role.id, role.name] for role in message.role_mentions], [channel.id for channel in message.channel_mentions])
+
+def trace_reaction(payload):
+    if payload.guild_id is None:
+        return
+    trace.record('r+' if payload.event_type == 'REACTION_ADD' else 'r-', payload.guild_id, payload.channel_id, payload.user_id, payload.message_id, payload.emoji.name)
 
 # ---------------------- Bot Start - On Ready ---------------------- #
 
+def log_storage_open(future):
+    if future.exception() is not None:
+        logger.critical(f"Opening the {STORAGE_BACKEND} storage backend failed: {future.exception()}")
+        return
+    metrics.observe('startup_seconds', 'stage', 'storage_open', time.monotonic() - STARTED_AT)
+    logger.info(f"Opened the {STORAGE_BACKEND} storage backend.")
+
+# Guilds are loaded on their first event and the journal left by the last run is folded on the storage worker
+# while the bot connects, loads queue up behind it
+if storage is not None:
+    storage_executor.submit(storage.open).add_done_callback(log_storage_open)
+
 @bot.event
 async def on_ready():
-    update_files.start()
-    logger.info(f"{bot.user.name} is online.")
-    print(f"{bot.user.name} is online.")
+    global metrics_started
+    if not update_files.is_running():
+        update_files.start()
+    if not sync_storage.is_running():
+        sync_storage.start()
+    if not metrics_started: # on_ready fires again after every reconnect
+        metrics_started = True
+        asyncio.ensure_future(sample_loop_lag())
+        if METRICS_PORT:
+            await start_metrics_server()
+    if not evict_idle_guilds.is_running():
+        metrics.observe('startup_seconds', 'stage', 'ready', time.monotonic() - STARTED_AT)
+        logger.info(f"Ready {time.monotonic() - STARTED_AT:.1f}s after start.", extra={'event': 'startup'})
+        evict_idle_guilds.start()
+        expire_old_questions.start()
+        if GUILD_PREFETCH:
+            asyncio.ensure_future(guild_cache.prefetch([str(guild.id) for guild in bot.guilds]))
+    if trace is not None and not flush_trace.is_running():
+        trace.record('h', bot.user.id) # who the bot was, its own messages are only replayed as IDs
+        flush_trace.start()
+    logger.info(f"{bot.user.name} is online with shards {sorted(bot.shards)} of {bot.shard_count}.")
+    print(f"{bot.user.name} is online with shards {sorted(bot.shards)} of {bot.shard_count}.")
     await bot.change_presence(activity=discord.Game(name="Coding. Command prefix: ph!"))
     
+# ---------------------- Embed Templates ---------------------- #
+
+EMOJI_URL = r'https://cdn.discordapp.com/emojis/'
+DEFAULT_THUMBNAIL = EMOJI_URL + '741984835698163742'
+
+@functools.lru_cache(maxsize=None)
+def help_embed():
+    """
+        Helper function that returns the help menu embed, built on first use and sent as is after that, used by ph!help exclusively.
+    """
+    role_list = "typescript  swift  sql  rust  ruby  php  perl  python  mac  linux  kotlin  java  javascript  haskell  golang  erlang  csharp  cpp  windows  c_  r_"
+    emb = discord.Embed(
+        title="Help Menu",
+        colour=discord.Colour.green()
+    )
+    emb.add_field(name="ph!setup", value="Set the level system of the guild/server. **Command user needs to have admin access.**", inline=False)
+    emb.add_field(name="ph!hardreset", value="Hard reset the bot for the particular guild/server. **Command user needs to have admin access.**", inline=False)
+    emb.add_field(name="ph!ask @role", value="Ask a question about a role. :arrows_counterclockwise: to answer the question, :arrow_up: to upvote and :white_check_mark: to mark it solved. **Bot requires permissions in the channel: manage_messages=True, manage_roles=True**", inline=False)
+    emb.add_field(name="ph!search <terms> @role", value="Search the questions and answers asked in the server, role is optional.", inline=False)
+    emb.add_field(name="ph!rank", value="See your level, exp points and rank in the server as of now.", inline=False)
+    emb.add_field(name="ph!stats", value="See command and event latencies, REST usage and event loop lag of the bot. **Command user needs to have admin access.**", inline=False)
+    emb.add_field(name="ph!leaderboard <page>", value="See the members with the most exp points in the server. Page is optional.", inline=False)
+    emb.add_field(name="ph!retention <days>", value="See or set after how many days unsolved questions stop being tracked, 0 to track them until they are solved. **Command user needs to have admin access.**", inline=False)
+    emb.add_field(name="ph!welcome", value="Set the welcome message for users new to the server. By default, no message is sent to the new user. **Command user needs to have admin access.**", inline=False)
+    emb.add_field(name="ph!addrole @role <web-url-to-thumnail-image>", value="Add a role to/about which questions can be asked. URL to thumbnail image is optional. **Command user needs to have admin access.**", inline=False)
+    emb.add_field(name="ph!delrole @role", value="Delete a role from being asked a question. The  actual server role will NOT be deleted. **Command user needs to have admin access.**", inline=False)
+    emb.add_field(name="Default Roles", value=f"We provide default roles that you can add in your sever for ph!ask commands (create one of the below roles in the guild) : \n*{role_list}*", inline=False)
+    return emb
+
+role_thumbnails = {} # server id to the thumbnail URL of every role questions can be asked about
+
+def ask_roles(server_id):
+    """
+        Helper function that returns the thumbnail URL of every role questions can be asked about in the guild, the default
+        roles and the ones added with ph!addrole. Built on first use and dropped whenever the guild's custom roles change.
+    """
+    thumbnails = role_thumbnails.get(server_id)
+    if thumbnails is None:
+        thumbnails = {role_name: EMOJI_URL + str(emoji_id) for role_name, emoji_id in allowed_roles.items()}
+        for role_name, url in custom_roles.get(server_id, {}).items():
+            thumbnails[role_name] = url or thumbnails.get(role_name, DEFAULT_THUMBNAIL)
+        role_thumbnails[server_id] = thumbnails
+    return thumbnails
+
 # ---------------------- Ask Command - Helper Functions ---------------------- #
 
+REACTION_INTERVAL_SECONDS = 0.25 # Discord allows one reaction add per channel every 250ms
+REACTION_RETRIES = 3 # attempts per reaction when Discord answers with a 429
+
+class ReactionScheduler:
+    """
+        Seeds reactions on bot messages. Reaction adds are rate limited per channel, so every add reserves the next free
+        slot of its channel and is sent as soon as the slot opens, without waiting for the previous add to return.
+        Adds for every message in a channel, from every session, share the same slots.
+    """
+    def __init__(self, interval):
+        self.interval = interval
+        self.next_slot = {} # channel id to the loop time at which its next reaction add may start
+
+    def reserve(self, channel_id, not_before=0):
+        """
+            Reserve the next slot of the channel, returns how many seconds to wait for it.
+        """
+        now = asyncio.get_event_loop().time()
+        slot = max(now, not_before, self.next_slot.get(channel_id, 0))
+        self.next_slot[channel_id] = slot + self.interval
+        return slot - now
+
+    async def add(self, message, reaction):
+        not_before = 0
+        for attempt in range(REACTION_RETRIES):
+            await asyncio.sleep(self.reserve(message.channel.id, not_before))
+            try:
+                await message.add_reaction(reaction)
+                return
+            except discord.HTTPException as error:
+                if error.status != 429 or attempt == REACTION_RETRIES - 1:
+                    raise
+                retry_after = float(error.response.headers.get('Retry-After', self.interval))
+                not_before = asyncio.get_event_loop().time() + retry_after
+                logger.warning(f"Reaction add on message {message.id} was rate limited, retrying in {retry_after}s")
+
+    async def seed(self, message, *reactions):
+        """
+            Add every reaction to the message, returns the seconds it took.
+        """
+        start = time.perf_counter()
+        await asyncio.gather(*(self.add(message, reaction) for reaction in reactions))
+        return time.perf_counter() - start
+
+reaction_scheduler = ReactionScheduler(REACTION_INTERVAL_SECONDS)
+
 async def add_reaction(message, *reactions):
     """
         Helper function to add reactions to a message.
     """
-    for reaction in reactions:
+    try:
+        seconds = await reaction_scheduler.seed(message, *reactions)
+    except discord.HTTPException:
+        await message.channel.send('Failed to add reaction due to HTTP Error, your text will be displayed but users will not be able to upvote or answer it.\nSorry for the inconvenience, please retry if needed.')
+        return
+    logger.info(f"Seeded {len(reactions)} reactions on message {message.id} in {seconds * 1000:.0f}ms", extra={'event': 'reaction_seed', 'guild': message.guild.id, 'latency_ms': round(seconds * 1000, 1)})
+
+async def ask_question(ctx, emb_color):
+    """
+        Helper function to create a question embed, returns the sent message.
+    """
+    emb = discord.Embed(
+        title = "Add a question:",
+        description = "Type your question and send. Enter 'done' when you are done with the process. Enter 'nope' to terminate the process.",
+        colour = emb_color
+    )
+    return await ctx.send(embed=emb)
+
+async def answer_question(channel):
+    """
+        Helper function to create an answer embed, returns the sent message.
+    """
+    emb = discord.Embed(
+        title = "Add a response/answer",
+        description = "Keep on messaging your response. Enter a single word 'done' to terminate the process. Enter 'nope' to terminate the process.",
+        colour = discord.Colour.gold()
+    )
+    return await channel.send(embed=emb)
+
+# ---------------------- Message Cleanup ---------------------- #
+
+CLEANUP_DELAY_SECONDS = 1 # messages queued within this window are deleted together
+BULK_DELETE_LIMIT = 100 # Discord accepts at most this many messages per bulk delete
+BULK_DELETE_MAX_AGE = timedelta(days=14, minutes=-5) # older messages can only be deleted one by one, keep a margin for clock drift
+
+# Channel id to the queue of messages waiting to be deleted in that channel
+cleanup_queues = {}
+
+class CleanupQueue:
+    """
+        Messages waiting to be deleted from one channel. Every session in the channel queues its messages here and
+        a single flusher deletes them in bulk, so the channel's delete routes never have more than one request in flight.
+        Rate limit responses on those routes are waited out by discord.py's HTTP client.
+    """
+    def __init__(self, channel):
+        self.channel = channel
+        self.message_ids = set()
+        self.flusher = None
+
+    def add(self, message_ids):
+        self.message_ids.update(message_ids)
+        if self.flusher is None or self.flusher.done():
+            self.flusher = asyncio.ensure_future(self.flush())
+
+    async def flush(self):
+        await asyncio.sleep(CLEANUP_DELAY_SECONDS)
+        while self.message_ids:
+            message_ids = sorted(self.message_ids)
+            self.message_ids.clear()
+
+            bulk_cutoff = discord.utils.time_snowflake(datetime.utcnow() - BULK_DELETE_MAX_AGE)
+            old_ids = [message_id for message_id in message_ids if message_id < bulk_cutoff]
+            recent_ids = [message_id for message_id in message_ids if message_id >= bulk_cutoff]
+
+            for start in range(0, len(recent_ids), BULK_DELETE_LIMIT):
+                chunk = [discord.Object(id=message_id) for message_id in recent_ids[start:start + BULK_DELETE_LIMIT]]
+                try:
+                    await self.channel.delete_messages(chunk)
+                except discord.NotFound: # someone else already deleted one of them, delete the rest one by one
+                    old_ids.extend(message.id for message in chunk)
+                except discord.HTTPException as error:
+                    logger.warning(f"Bulk delete of {len(chunk)} messages in channel {self.channel.id} failed: {error}")
+
+            for message_id in old_ids:
+                try:
+                    await self.channel.get_partial_message(message_id).delete()
+                except discord.NotFound:
+                    pass
+                except discord.HTTPException as error:
+                    logger.warning(f"Deleting message {message_id} in channel {self.channel.id} failed: {error}")
+
+def clean_up(channel, *messages):
+    """
+        Helper function to queue messages for deletion, returns right away.
+    """
+    queue = cleanup_queues.get(channel.id)
+    if queue is None:
+        queue = cleanup_queues[channel.id] = CleanupQueue(channel)
+    queue.add(message.id for message in messages)
+
+# ---------------------- Direct Messages ---------------------- #
+
+# Discord answers bursts of DMs with 429s and flags bots that mass DM, so they are paced well below the global rate limit
+DM_PER_SECOND = 5
+DM_QUEUE_LIMIT = 5000 # notifications beyond this are dropped, a raid can't make the queue grow without bounds
+DM_RETRIES = 3 # attempts per DM when Discord answers with a 429 or a server error
+DM_BACKOFF_SECONDS = 2 # doubled after every failed attempt
+
+class DirectMessageDispatcher:
+    """
+        Sends welcome, level up and answer DMs from a bounded queue in the background, paced to DM_PER_SECOND.
+        A notification for a user that is still waiting with the same kind and scope is merged into it, so a user
+        gets one DM for every answer to a question that came in meanwhile, or only their latest level up.
+        Users who don't accept DMs are recorded and skipped from then on.
+    """
+    def __init__(self, per_second, limit):
+        self.interval = 1 / per_second
+        self.limit = limit
+        self.pending = collections.OrderedDict() # (user id, kind, scope) to [user, lines, attempt], oldest first
+        self.blocked = set() # IDs of users whose DMs are closed to the bot
+        self.deliveries = set()
+        self.worker = None
+
+    def __len__(self):
+        return len(self.pending)
+
+    def send(self, user, content, kind, scope=None, replace=False):
+        """
+            Queue a DM and return right away. With replace, the latest content wins over a waiting notification
+            of the same kind and scope instead of being added to it. Returns False if the DM was dropped.
+        """
+        if user.id in self.blocked:
+            return False
+
+        key = (user.id, kind, scope)
+        entry = self.pending.get(key)
+        if entry is not None:
+            if replace:
+                entry[1] = [content]
+            elif content not in entry[1]:
+                entry[1].append(content)
+            metrics.count('dm_merged_total', 'kind', kind)
+            return True
+
+        if len(self.pending) >= self.limit:
+            metrics.count('dm_dropped_total', 'kind', kind)
+            logger.warning(f"DM queue is full, dropped a {kind} DM to user {user.id}", extra={'event': 'dm'})
+            return False
+
+        self.pending[key] = [user, [content], 0]
+        if self.worker is None or self.worker.done():
+            self.worker = asyncio.ensure_future(self.run())
+        return True
+
+    async def run(self):
+        loop = asyncio.get_event_loop()
+        next_slot = loop.time()
+        while self.pending:
+            await asyncio.sleep(max(next_slot - loop.time(), 0))
+            next_slot = max(next_slot, loop.time()) + self.interval
+            key, entry = self.pending.popitem(last=False)
+            delivery = asyncio.ensure_future(self.deliver(key, entry))
+            self.deliveries.add(delivery)
+            delivery.add_done_callback(self.deliveries.discard)
+
+    async def deliver(self, key, entry):
+        user, lines, attempt = entry
+        kind = key[1]
         try:
-            await message.add_reaction(reaction)
-        except discord.HTTPException:
-            await message.channel.send('Failed to add reaction due to HTTP Error, your text will be displayed but users will not be able to upvote or answer it.\nSorry for the inconvenience, please retry if needed.')
-            return
+            await user.send("\n".join(lines))
+            metrics.count('dm_sent_total', 'kind', kind)
+        except discord.Forbidden:
+            self.blocked.add(user.id)
+            metrics.count('dm_failures_total', 'reason', 'forbidden')
+            logger.info(f"User {user.id} does not accept DMs, skipping their notifications", extra={'event': 'dm'})
+        except discord.HTTPException as error:
+            if attempt + 1 < DM_RETRIES and (error.status == 429 or error.status >= 500):
+                delay = DM_BACKOFF_SECONDS * 2 ** attempt
+                asyncio.get_event_loop().call_later(delay, self.retry, key, [user, lines, attempt + 1])
+                return
+            metrics.count('dm_failures_total', 'reason', str(error.status))
+            logger.warning(f"Sending a {kind} DM to user {user.id} failed: {error}", extra={'event': 'dm'})
+
+    def retry(self, key, entry):
+        """
+            Put a failed DM back in the queue, together with what was queued for it since.
+        """
+        waiting = self.pending.pop(key, None)
+        if waiting is not None:
+            entry[1].extend(line for line in waiting[1] if line not in entry[1])
+        self.pending[key] = entry
+        self.pending.move_to_end(key, last=False) # it has waited long enough
+        if self.worker is None or self.worker.done():
+            self.worker = asyncio.ensure_future(self.run())
+
+dm_dispatcher = DirectMessageDispatcher(DM_PER_SECOND, DM_QUEUE_LIMIT)
+
+# ---------------------- Conversations ---------------------- #
+
+CONVERSATION_BUSY_MESSAGE = "{user.mention} please finish your other ongoing command first, or enter 'nope' to cancel it."
+
+class Conversation:
+    """
+        A user's multi-step exchange with the bot in one channel (ask, answer, setup...), fed by the conversation router.
+        Use it as a context manager so it is closed however the exchange ends.
+    """
+    __slots__ = ('key', 'user_key', 'messages', 'waiter', 'deadline')
+
+    def __init__(self, key, user_key):
+        self.key = key
+        self.user_key = user_key
+        self.messages = collections.deque() # messages that arrived while nobody was waiting
+        self.waiter = None
+        self.deadline = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        conversations.close(self)
+
+    async def next(self, timeout):
+        """
+            Wait for the next message of the user in the channel, raises asyncio.TimeoutError after timeout seconds.
+        """
+        if self.messages:
+            return self.messages.popleft()
+
+        loop = asyncio.get_event_loop()
+        self.waiter = loop.create_future()
+        self.deadline = loop.time() + timeout
+        conversations.schedule(self)
+        try:
+            return await self.waiter
+        finally:
+            self.waiter = None
+            self.deadline = None
+
+class ConversationRouter:
+    """
+        Hands every message to the conversation of its (guild, channel, user) with a single dict lookup,
+        instead of running one bot.wait_for check per open conversation. A user can only have one open conversation per guild.
+        Timeouts of every conversation share one heap and one timer, set for the earliest deadline.
+    """
+    def __init__(self):
+        self.sessions = {} # (guild id, channel id, user id) to the open conversation
+        self.users = {} # (guild id, user id) to the key of the user's open conversation
+        self.deadlines = [] # heap of (deadline, sequence, conversation), entries of answered waits are dropped when they come up
+        self.sequence = itertools.count()
+        self.timer = None
+
+    @property
+    def in_flight(self):
+        return len(self.sessions)
+
+    def open(self, channel, user):
+        """
+            Open a conversation with the user in the channel, returns None if the user is already in one.
+        """
+        user_key = (channel.guild.id, user.id)
+        if user_key in self.users:
+            return None
+
+        key = (channel.guild.id, channel.id, user.id)
+        conversation = Conversation(key, user_key)
+        self.sessions[key] = conversation
+        self.users[user_key] = key
+        return conversation
+
+    def close(self, conversation):
+        if self.sessions.get(conversation.key) is conversation:
+            del self.sessions[conversation.key]
+            del self.users[conversation.user_key]
+
+    def dispatch(self, message):
+        """
+            Hand the message to its conversation, returns False if its author has none open in the channel.
+        """
+        if message.guild is None:
+            return False
+
+        conversation = self.sessions.get((message.guild.id, message.channel.id, message.author.id))
+        if conversation is None:
+            return False
+
+        if conversation.waiter is not None and not conversation.waiter.done():
+            conversation.waiter.set_result(message)
+        else:
+            conversation.messages.append(message)
+        return True
+
+    def schedule(self, conversation):
+        heapq.heappush(self.deadlines, (conversation.deadline, next(self.sequence), conversation))
+        if self.deadlines[0][2] is conversation: # new earliest deadline
+            self.set_timer()
+
+    def set_timer(self):
+        if self.timer is not None:
+            self.timer.cancel()
+        self.timer = None
+        if self.deadlines:
+            self.timer = asyncio.get_event_loop().call_at(self.deadlines[0][0], self.expire)
+
+    def expire(self):
+        now = asyncio.get_event_loop().time()
+        while self.deadlines and self.deadlines[0][0] <= now:
+            deadline, _, conversation = heapq.heappop(self.deadlines)
+            waiter = conversation.waiter
+            if conversation.deadline == deadline and waiter is not None and not waiter.done():
+                waiter.set_exception(asyncio.TimeoutError())
+        self.timer = None
+        self.set_timer()
+
+conversations = ConversationRouter()
+
+# ---------------------- Entity Lookups ---------------------- #
+
+ENTITY_CACHE_SIZE = int(os.getenv('ENTITY_CACHE_SIZE', '1000')) # guilds, channels and members fetched over REST that are kept
+ENTITY_TTL_SECONDS = 300 # a fetched entity goes stale (renamed, roles changed) and is fetched again after this long
+
+class EntityResolver:
+    """
+        Resolves guilds, channels and members from the IDs in raw gateway events. The client's caches are keyed by ID,
+        so they are tried first. Entities missing from them (members while the members intent is off, guilds that are
+        still unavailable) are fetched over REST and kept, least recently used dropped first, along with the ones that
+        were not found. Every lookup is counted in entity_lookups_total as cache, fetched or rest per kind.
+    """
+    def __init__(self, capacity, ttl_seconds):
+        self.capacity = capacity
+        self.ttl_seconds = ttl_seconds
+        self.fetched = collections.OrderedDict() # (kind, id) to (fetched at, entity or None if it wasn't found)
+
+    async def resolve(self, kind, entity_id, cached, fetch):
+        """
+            The entity from the client's cache, the ones fetched before or else fetch(), None if it doesn't exist.
+        """
+        if cached is not None:
+            metrics.count('entity_lookups_total', 'lookup', f'{kind}:cache')
+            return cached
+
+        key = (kind, entity_id)
+        if key in self.fetched:
+            fetched_at, entity = self.fetched[key]
+            if time.monotonic() - fetched_at < self.ttl_seconds:
+                metrics.count('entity_lookups_total', 'lookup', f'{kind}:fetched')
+                self.fetched.move_to_end(key)
+                return entity
+
+        metrics.count('entity_lookups_total', 'lookup', f'{kind}:rest')
+        try:
+            entity = await fetch()
+        except (discord.NotFound, discord.Forbidden):
+            entity = None
+        except discord.HTTPException: # not remembered, the next lookup tries again
+            return None
+
+        self.fetched[key] = (time.monotonic(), entity)
+        self.fetched.move_to_end(key)
+        while len(self.fetched) > self.capacity:
+            self.fetched.popitem(last=False)
+        return entity
+
+    async def guild(self, guild_id):
+        return await self.resolve('guild', guild_id, bot.get_guild(guild_id), lambda: bot.fetch_guild(guild_id))
+
+    async def channel(self, guild, channel_id):
+        async def fetch():
+            # A fetched channel only gets a Guild if the client has it cached, a bare discord.Object otherwise. It is
+            # given the resolved guild, a channel that isn't in that guild counts as not found.
+            channel = await bot.fetch_channel(channel_id)
+            if getattr(channel, 'guild', None) is None or channel.guild.id != guild.id:
+                return None
+            channel.guild = guild
+            return channel
+        return await self.resolve('channel', (guild.id, channel_id), guild.get_channel(channel_id), fetch)
+
+    async def member(self, guild, user_id):
+        return await self.resolve('member', (guild.id, user_id), guild.get_member(user_id), lambda: guild.fetch_member(user_id))
+
+    def hit_ratio(self):
+        """
+            The share of lookups that didn't need a REST call.
+        """
+        lookups = metrics.counters['entity_lookups_total']
+        rest = sum(count for lookup, count in lookups.items() if lookup.endswith(':rest'))
+        return 1 - rest / max(sum(lookups.values()), 1)
+
+entities = EntityResolver(ENTITY_CACHE_SIZE, ENTITY_TTL_SECONDS)
+
+# ---------------------- Reaction Events - Helper Functions ---------------------- #
+
+PIN_UPVOTES = 10 # pin a tracked message once it has this many upvotes
+
+async def tracked_message_info(channel, message_id):
+    """
+        Helper function that returns the stored info of a tracked message, or None if it can't be found.
+        Messages tracked before their info was stored are fetched once and their info is stored for the next reactions.
+    """
+    server_id = str(channel.guild.id)
+    info = messages_data[server_id].info(message_id)
+    if info is not None:
+        return info
+
+    try:
+        message = await channel.fetch_message(message_id)
+    except (discord.NotFound, discord.HTTPException):
+        return None
+
+    message_embed = message.embeds[0]
+    original_author = discord.utils.find(lambda u: u.name == message_embed.author.name, channel.guild.members)
+    reactions = discord.utils.get(message.reactions, emoji='⬆️')
+    role_name = message_embed.title.rpartition(' : *')[2].rstrip('*') if ' : *' in message_embed.title else None
+
+    info = {
+        'author': original_author.id if original_author else None,
+        'role': role_name,
+        'title': message_embed.title,
+        'upvotes': reactions.count - 1 if reactions else 0, # the bot's own reaction is not an upvote
+        'pinned': message.pinned
+    }
+    persist('update', 'messages_data', server_id, message_id, info)
+    return info
+
+async def fetch_tracked_message(channel, message_id):
+    """
+        Helper function to fetch a tracked message, only needed when the message itself has to change.
+    """
+    try:
+        return await channel.fetch_message(message_id)
+    except (discord.NotFound, discord.HTTPException):
+        await channel.send('Something went wrong, either the original message could not be fetched or a 404 HTTP Error occured.\nSorry for the inconvenience, please retry.')
+        return None
+
+def set_pinned(server_id, message_id, pinned):
+    """
+        Helper function to correct the stored pin state of a tracked message after a pin or unpin failed.
+    """
+    info = messages_data[server_id].info(message_id)
+    if info is not None:
+        persist('update', 'messages_data', server_id, message_id, dict(info, pinned=pinned))
+
+# ---------------------- Level Up - Helper Functions ---------------------- #
+
+async def add_user_data(user, server_id):
+    """
+        Helper function to add user data for rank and experience updates.
+    """
+    user_id = str(user.id)
+    server_id = str(server_id)
+
+    if not server_id in user_data.keys() or not user_id in user_data[server_id]:
+        persist('set', 'user_data', server_id, user_id, {'level': 1, 'experience': 0})
+        update_ranking(server_id, user_id, 0)
+
+async def add_experience(user, exp_points, server_id):
+    """
+        Helper function to add/update the user.
+    """
+    user_id = str(user.id)
+    server_id = str(server_id)
+    user_record = user_data[server_id][user_id]
+    experience = user_record['experience'] + int(exp_points * 1000)
+    persist('set', 'user_data', server_id, user_id, {'level': user_record['level'], 'experience': experience})
+    update_ranking(server_id, user_id, experience)
+
+def level_threshold(level):
+    """
+        Experience needed to reach the level.
+    """
+    return (level ** 3) * 600 # Modify the formula here if needed
+
+class LevelTable:
+    """
+        The levels a guild configured with ph!setup, sorted by the experience they need, and the role each one awards.
+        Role IDs are resolved once and cached, role names are only looked up for guilds set up before IDs were stored.
+    """
+    def __init__(self, guild_info):
+        self.levels = sorted(int(level) for level in guild_info if level.isdigit())
+        self.thresholds = [level_threshold(level) for level in self.levels]
+        self.role_names = {level: guild_info[str(level)] for level in self.levels}
+        self.role_ids = {int(level): role_id for level, role_id in guild_info.get("role_ids", {}).items()}
+
+    def level_for(self, experience):
+        """
+            Highest configured level the experience reaches, everyone starts at level 1.
+        """
+        index = bisect.bisect_right(self.thresholds, experience)
+        return self.levels[index - 1] if index else 1
+
+    def role(self, guild, level):
+        role = guild.get_role(self.role_ids[level]) if level in self.role_ids else None
+        if role is None:
+            role = discord.utils.find(lambda r: r.name == self.role_names[level], guild.roles)
+            if role is not None:
+                self.role_ids[level] = role.id
+        return role
+
+    def roles_between(self, guild, low_level, high_level):
+        """
+            Roles awarded by the levels above low_level up to and including high_level.
+        """
+        roles = (self.role(guild, level) for level in self.levels if low_level < level <= high_level)
+        return [role for role in roles if role is not None]
+
+# Guild id to its level table, built by ph!setup or on first use
+level_tables = {}
+
+def level_table(server_id):
+    """
+        Helper function that returns the level table of the guild, or None if it has not been set up.
+    """
+    table = level_tables.get(server_id)
+    if table is None and server_info.get(server_id):
+        table = level_tables[server_id] = LevelTable(server_info[server_id])
+    return table
+
+async def level_up(user, channel):
+    """
+        Helper function to move the user to the level their experience has reached, up or down, in a single step.
+    """
+    server_id = str(channel.guild.id)
+    user_id = str(user.id)
+    table = level_table(server_id)
+    if table is None:
+        return
+
+    current_level = user_data[server_id][user_id]['level']
+    new_level = table.level_for(user_data[server_id][user_id]['experience'])
+
+    if new_level > current_level:
+        roles = table.roles_between(channel.guild, current_level, new_level)
+        role = roles[-1] if roles else None
+        await channel.send(f'{user} has levelled up to level {new_level} and has been promoted to {role}!') # comment this line out if you don't want channel to get pinged for level increase
+        dm_dispatcher.send(user, f'You have levelled up to level {new_level} and have been promoted to {role}!', 'level_up', server_id, replace=True) # comment this line out if you don't want the users to fet DM
+        if roles:
+            await user.add_roles(*roles)
+    elif new_level < current_level:
+        roles = table.roles_between(channel.guild, new_level, current_level)
+        await channel.send(f'{user} has dropped to level {new_level}.') # comment this line out if you don't want channel to get pinged for level decrease
+        if roles:
+            await user.remove_roles(*roles)
+    else:
+        return
+
+    persist('set', 'user_data', server_id, user_id, {'level': new_level, 'experience': user_data[server_id][user_id]['experience']})
+
+class KeyedLocks:
+    """
+        One asyncio lock per key, created on first use and dropped once nobody holds or waits for it.
+    """
+    def __init__(self):
+        self.locks = {} # key to [lock, number of holders and waiters]
+
+    @contextlib.asynccontextmanager
+    async def hold(self, key):
+        entry = self.locks.get(key)
+        if entry is None:
+            entry = self.locks[key] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                yield
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0:
+                del self.locks[key]
+
+# Serializes experience awards per (guild, user), awards for different users never wait on each other
+experience_locks = KeyedLocks()
+
+async def award_experience(user, exp_points, channel):
+    """
+        Helper function that adds experience to the user and levels them up as one atomic step.
+    """
+    server_id = str(channel.guild.id)
+    async with experience_locks.hold((server_id, user.id)):
+        await guild_cache.load(server_id) # batched awards can come in after the guild's last event
+        await add_user_data(user=user, server_id=server_id)
+        await add_experience(user=user, exp_points=exp_points, server_id=server_id)
+        await level_up(user=user, channel=channel)
+
+# Experience from reactions is applied once per window, set it next to the TOKEN in .env
+XP_BATCH_SECONDS = float(os.getenv('XP_BATCH_SECONDS', 2))
+
+class ExperienceBatcher:
+    """
+        Buffers the experience changes of reaction events per (guild, user) and applies them once per window,
+        so a burst of upvotes becomes a single award and an upvote that is taken back again costs nothing.
+    """
+    def __init__(self, window):
+        self.window = window
+        self.pending = {} # (guild id, user id) to [user, channel, exp_points]
+        self.flusher = None
+
+    def add(self, user, exp_points, channel):
+        key = (channel.guild.id, user.id)
+        entry = self.pending.get(key)
+        if entry is None:
+            self.pending[key] = [user, channel, exp_points]
+        else:
+            entry[2] += exp_points
+
+        if self.flusher is None or self.flusher.done():
+            self.flusher = asyncio.ensure_future(self.flush())
+
+    async def flush(self):
+        # Changes added while the awards are applied wait for the next window of this same flusher, add() only
+        # starts a new flusher once this one is done
+        while self.pending:
+            await asyncio.sleep(self.window)
+            pending, self.pending = self.pending, {}
+            awards = [award_experience(user=user, exp_points=exp_points, channel=channel) for user, channel, exp_points in pending.values() if exp_points]
+            for result in await asyncio.gather(*awards, return_exceptions=True):
+                if isinstance(result, Exception):
+                    logger.error(f"Applying batched experience failed: {result}")
+
+experience_batcher = ExperienceBatcher(XP_BATCH_SECONDS)
+
+async def display_rank(user, channel):
+    """
+        Helper function that displays the rank of the current user, used by ph!rank exclusively.
+    """
+    user_id = str(user.id)
+    server_id = str(channel.guild.id)
+
+    guild_users = user_data[server_id]
+    user_record = guild_users[user_id]
+
+    emb = discord.Embed(
+        title="User Level and Experience Points",
+        color=discord.Colour.green()
+    )
+    emb.set_author(name=user.name, icon_url=user.avatar_url)
+    emb.add_field(name="User Level", value=user_record['level'], inline=True)
+    emb.add_field(name="User EXP Points", value=user_record['experience'], inline=True)
+    emb.add_field(name="Server Rank", value=f"#{guild_ranking(server_id).position(user_id) + 1} of {len(guild_users)}", inline=True)
+
+    await channel.send(embed=emb)
+
+# ---------------------- Leaderboard ---------------------- #
+
+LEADERBOARD_PAGE_SIZE = 10
+
+class RankIndex:
+    """
+        Indexable skip list of sorted keys. Insert, remove, "how many keys come before this one" and "key at position i"
+        all take O(log n) expected time, so ranking a guild never needs a full sort.
+    """
+    MAX_HEIGHT = 32
+
+    class Node:
+        __slots__ = ('key', 'next', 'width')
+
+        def __init__(self, key, height):
+            self.key = key
+            self.next = [None] * height
+            self.width = [1] * height
+
+    def __init__(self):
+        self.head = RankIndex.Node(None, RankIndex.MAX_HEIGHT)
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    def find_chain(self, key):
+        """
+            Last node before the key on every level, and how many keys each of those nodes comes after.
+        """
+        chain = [None] * RankIndex.MAX_HEIGHT
+        positions = [0] * RankIndex.MAX_HEIGHT
+        node, position = self.head, 0
+        for level in reversed(range(RankIndex.MAX_HEIGHT)):
+            while node.next[level] is not None and node.next[level].key < key:
+                position += node.width[level]
+                node = node.next[level]
+            chain[level] = node
+            positions[level] = position
+        return chain, positions
+
+    def insert(self, key):
+        chain, positions = self.find_chain(key)
+        height = 1
+        while height < RankIndex.MAX_HEIGHT and random.random() < 0.5:
+            height += 1
+
+        node = RankIndex.Node(key, height)
+        for level in range(height):
+            previous = chain[level]
+            steps = positions[0] - positions[level] # keys between the previous node on this level and the new node
+            node.next[level] = previous.next[level]
+            previous.next[level] = node
+            node.width[level] = previous.width[level] - steps
+            previous.width[level] = steps + 1
+        for level in range(height, RankIndex.MAX_HEIGHT):
+            chain[level].width[level] += 1
+        self.size += 1
+
+    def remove(self, key):
+        chain, _ = self.find_chain(key)
+        node = chain[0].next[0]
+        if node is None or node.key != key:
+            raise KeyError(key)
+
+        for level in range(len(node.next)):
+            previous = chain[level]
+            previous.width[level] += node.width[level] - 1
+            previous.next[level] = node.next[level]
+        for level in range(len(node.next), RankIndex.MAX_HEIGHT):
+            chain[level].width[level] -= 1
+        self.size -= 1
+
+    def index(self, key):
+        """
+            Number of keys that sort before the key.
+        """
+        _, positions = self.find_chain(key)
+        return positions[0]
+
+    def slice(self, start, count):
+        """
+            Up to count keys starting at position start.
+        """
+        if start >= self.size:
+            return []
+
+        node, remaining = self.head, start + 1
+        for level in reversed(range(RankIndex.MAX_HEIGHT)):
+            while node.next[level] is not None and node.width[level] <= remaining:
+                remaining -= node.width[level]
+                node = node.next[level]
+
+        keys = []
+        while node is not None and len(keys) < count:
+            keys.append(node.key)
+            node = node.next[0]
+        return keys
+
+class GuildRanking:
+    """
+        Members of a guild ordered by experience, highest first.
+    """
+    def __init__(self, guild_users):
+        self.index = RankIndex()
+        self.keys = {} # user id to the user's key in the index
+        for user_id, record in guild_users.items():
+            self.update(user_id, record['experience'])
+
+    def update(self, user_id, experience):
+        old_key = self.keys.get(user_id)
+        if old_key is not None:
+            self.index.remove(old_key)
+        key = self.keys[user_id] = (-experience, user_id)
+        self.index.insert(key)
+
+    def position(self, user_id):
+        return self.index.index(self.keys[user_id])
+
+    def page(self, start, count):
+        """
+            (position, user id, experience) of up to count members starting at position start.
+        """
+        return [(start + offset, user_id, -negative_experience) for offset, (negative_experience, user_id) in enumerate(self.index.slice(start, count))]
+
+# Guild id to its ranking, built from user_data on first use and kept up to date by add_experience
+rankings = {}
+
+def guild_ranking(server_id):
+    """
+        Helper function that returns the ranking of the guild.
+    """
+    ranking = rankings.get(server_id)
+    if ranking is None:
+        ranking = rankings[server_id] = GuildRanking(user_data.get(server_id, {}))
+    return ranking
+
+def update_ranking(server_id, user_id, experience):
+    """
+        Helper function to move the user in the guild ranking, if it has been built already.
+    """
+    ranking = rankings.get(server_id)
+    if ranking is not None:
+        ranking.update(user_id, experience)
+
+async def display_leaderboard(guild, channel, page):
+    """
+        Helper function that displays a page of the guild leaderboard, used by ph!leaderboard exclusively.
+    """
+    server_id = str(guild.id)
+    ranking = guild_ranking(server_id)
+    total_pages = max(1, -(-len(ranking.index) // LEADERBOARD_PAGE_SIZE))
+    page = min(max(page, 1), total_pages)
+
+    lines = []
+    for position, user_id, experience in ranking.page((page - 1) * LEADERBOARD_PAGE_SIZE, LEADERBOARD_PAGE_SIZE):
+        member = guild.get_member(int(user_id))
+        name = member.display_name if member else f"User {user_id}"
+        lines.append(f"**#{position + 1}** {name} - Level {user_data[server_id][user_id]['level']}, {experience} EXP")
+
+    emb = discord.Embed(
+        title="Leaderboard",
+        description="\n".join(lines) or "Nobody has earned any experience yet.",
+        color=discord.Colour.green()
+    )
+    emb.set_footer(text=f"Page {page} of {total_pages}")
+
+    await channel.send(embed=emb)
+
+# ---------------------- Search - Helper Functions ---------------------- #
+
+SEARCH_RESULTS = 5
+# Set SUGGEST_DUPLICATES=1 next to the TOKEN in .env to show ph!ask users similar posts before their question is posted
+SUGGEST_DUPLICATES = os.getenv('SUGGEST_DUPLICATES', '0') == '1'
+DUPLICATE_SIMILARITY = 0.5 # share of the score the question would get against itself a post needs to be suggested
+
+def index_post(message, kind, author, role_name, title, text):
+    """
+        Helper function to add a question or answer the bot just posted to the guild's search index.
+    """
+    post = {'kind': kind, 'author': author.id, 'channel': message.channel.id, 'role': role_name, 'title': title, 'text': text[:SEARCH_TEXT_LIMIT]}
+    search_executor.submit(search_store.add, str(message.guild.id), message.id, post).add_done_callback(log_storage_error)
 
-async def ask_question(ctx, emb_color):
+async def similar_posts(server_id, role_name, text):
     """
-        Helper function to create a question embed.
+        Helper function that returns the posts about the role that come close to the text, used by ph!ask exclusively.
     """
-    emb = discord.Embed(
-        title = "Add a question:",
-        description = "Type your question and send. Enter 'done' when you are done with the process. Enter 'nope' to terminate the process.",
-        colour = emb_color
-    )
-    await ctx.send(embed=emb)
+    return await asyncio.get_event_loop().run_in_executor(search_executor, search_store.similar, server_id, role_name, text, DUPLICATE_SIMILARITY)
 
-async def answer_question(channel):
+async def display_search_results(channel, title, results, footer=None):
     """
-        Helper function to create an answer embed.
+        Helper function that displays search results with a link to each post, returns the sent message.
     """
     emb = discord.Embed(
-        title = "Add a response/answer",
-        description = "Keep on messaging your response. Enter a single word 'done' to terminate the process. Enter 'nope' to terminate the process.",
-        colour = discord.Colour.gold()
+        title=title[:256],
+        description=None if results else "No questions or answers matched your search.",
+        color=discord.Colour.blue()
     )
-    await channel.send(embed=emb)
+    for _, message_id, post in results:
+        snippet = post['text'] if len(post['text']) <= 200 else post['text'][:200] + "..."
+        link = f"https://discord.com/channels/{channel.guild.id}/{post['channel']}/{message_id}"
+        emb.add_field(name=post['title'][:256], value=f"{snippet}\n[Go to the {post['kind']}]({link})", inline=False)
+    if footer:
+        emb.set_footer(text=footer)
 
-# ---------------------- Level Up - Helper Functions ---------------------- #
+    return await channel.send(embed=emb)
 
-async def add_user_data(user, server_id):
-    """
-        Helper function to add user data for rank and experience updates.
-    """
-    prev_user_data.update(user_data)
-    user_id = str(user.id)
-    server_id = str(server_id)
+# ---------------------- Retention ---------------------- #
 
-    if not server_id in user_data.keys():
-        user_data[server_id] = {}
+# Questions nobody marked solved stop being tracked after this many days, set it next to the TOKEN in .env.
+# Admins can change it per guild with ph!retention, 0 keeps questions tracked forever
+QUESTION_TTL_DAYS = int(os.getenv('QUESTION_TTL_DAYS', 30))
+# Questions and answers drop out of ph!search after this many days, set it next to the TOKEN in .env, 0 keeps them forever
+SEARCH_TTL_DAYS = int(os.getenv('SEARCH_TTL_DAYS', 365))
+ARCHIVE_DIR = 'files/archive' # closed questions, one gzip file per guild
+RETENTION_BATCH = 20 # guilds the sweeper looks at before it lets other tasks run
 
-    if not user_id in user_data[server_id]:
-        user_data[server_id][user_id] = {}
-        user_data[server_id][user_id]['level'] = 1
-        user_data[server_id][user_id]['experience'] = 0
+def retention_days(server_id):
+    return server_info.get(server_id, {}).get("retention_days", QUESTION_TTL_DAYS)
 
-async def add_experience(user, exp_points, server_id):
+def append_archive(server_id, lines):
     """
-        Helper function to add/update the user.
+        Append closed questions to the guild's archive. Every call appends a complete gzip member, the file is never rewritten.
     """
-    prev_user_data.update(user_data)
-    user_id = str(user.id)
-    server_id = str(server_id)
-    user_data[server_id][user_id]['experience'] += int(exp_points * 1000)
+    os.makedirs(ARCHIVE_DIR, exist_ok=True)
+    with open(os.path.join(ARCHIVE_DIR, f'{server_id}.jsonl.gz'), 'ab') as f:
+        f.write(gzip.compress(('\n'.join(lines) + '\n').encode('utf-8')))
 
-async def level_up(user, channel):
+def archive_questions(server_id, message_ids, reason):
     """
-        Helper function to update the level of the user if the conditions are met.
+        Helper function that hands the stored info of tracked messages to the archive before they stop being tracked.
     """
-    prev_user_data.update(user_data)
-    server_id = str(channel.guild.id)
-    user_id = str(user.id)
+    closed_at = int(time.time())
+    index = messages_data[server_id]
+    lines = [json.dumps(dict(index.info(message_id) or {}, id=message_id, closed=reason, closed_at=closed_at)) for message_id in message_ids]
+    storage_executor.submit(append_archive, server_id, lines).add_done_callback(log_storage_error)
+    metrics.count('questions_closed_total', 'reason', reason, len(message_ids))
 
-    current_experience = user_data[server_id][user_id]['experience']
-    current_level = user_data[server_id][user_id]['level']
-    next_level = current_level + 1
-    level_EXP_required = (next_level ** 3) * 600 # Modify the formula here if needed
+def close_questions(server_id, message_ids, reason):
+    """
+        Helper function to stop tracking the given messages and archive them, messages that are not tracked are skipped.
+    """
+    tracked = [message_id for message_id in message_ids if message_id in messages_data.get(server_id, ())]
+    if tracked:
+        archive_questions(server_id, tracked, reason)
+        for message_id in tracked:
+            persist('discard', 'messages_data', server_id, message_id)
+    return len(tracked)
+
+def expire_questions(server_id):
+    """
+        Helper function to stop tracking the guild's messages older than its retention period and archive them, returns how many.
+        Message IDs grow with time and the index keeps them in order, so only the expired entries are visited.
+    """
+    days = retention_days(server_id)
+    index = messages_data.get(server_id)
+    if not days or not index:
+        return 0
+
+    cutoff_id = discord.utils.time_snowflake(datetime.utcnow() - timedelta(days=days))
+    expired = list(itertools.takewhile(lambda message_id: message_id < cutoff_id, index))
+    if expired:
+        archive_questions(server_id, expired, 'expired')
+        persist('expire', 'messages_data', server_id, cutoff_id)
+    return len(expired)
+
+async def expire_posts(server_id):
+    """
+        Helper function to drop the guild's posts older than SEARCH_TTL_DAYS from the search index, returns how many.
+    """
+    if not SEARCH_TTL_DAYS:
+        return 0
+    cutoff_id = discord.utils.time_snowflake(datetime.utcnow() - timedelta(days=SEARCH_TTL_DAYS))
+    return await asyncio.get_event_loop().run_in_executor(search_executor, search_store.expire_before, server_id, cutoff_id)
 
-    if current_experience >= level_EXP_required:
-        try:
-            role_to_add = server_info[server_id][str(next_level)]
-        except KeyError: # keyerror occurs here when the user has not setup next_level higher than the current one
-            return
+def forget_deleted_messages(server_id, message_ids):
+    """
+        Helper function for messages deleted in Discord: tracked ones are closed and archived, and posts are dropped from the search index.
+    """
+    close_questions(server_id, message_ids, 'deleted')
+    for message_id in message_ids:
+        search_executor.submit(search_store.discard, server_id, message_id).add_done_callback(log_storage_error)
 
-        role = discord.utils.find(lambda r: r.name == role_to_add, channel.guild.roles)
-        await channel.send(f'{user} has levelled up to level {next_level} and has been promoted to {role}!') # comment this line out if you don't want channel to get pinged for level increase
-        await user.send(f'You have levelled up to level {next_level} and have been promoted to {role}!') # comment this line out if you don't want the users to fet DM
-        await user.add_roles(role)
-        user_data[server_id][user_id]['level'] = next_level
+# ---------------------- Background Tasks ---------------------- #
 
-async def display_rank(user, channel):
+@tasks.loop(seconds=STORAGE_SYNC_SECONDS)
+async def sync_storage():
     """
-        Helper function that displays the rank of the current user, used by ph!rank exclusively.
+        Run a background task that makes the stored changes durable every few seconds
     """
-    user_id = str(user.id)
-    server_id = str(channel.guild.id)
-
-    user_level = user_data[server_id][user_id]['level']
-    user_exp = user_data[server_id][user_id]['experience']
+    await asyncio.get_event_loop().run_in_executor(storage_executor, storage.sync)
+    await asyncio.get_event_loop().run_in_executor(search_executor, search_store.sync)
 
-    emb = discord.Embed(
-        title="User Level and Experience Points",
-        color=discord.Colour.green()
-    )
-    emb.set_author(name=user.name, icon_url=user.avatar_url)
-    emb.add_field(name="User Level", value=user_level, inline=True)
-    emb.add_field(name="User EXP Points", value=user_exp, inline=True)
+@tasks.loop(seconds=TRACE_FLUSH_SECONDS)
+async def flush_trace():
+    """
+        Run a background task that appends the recorded events to the trace file
+    """
+    await asyncio.get_event_loop().run_in_executor(None, trace.flush)
 
-    await channel.send(embed=emb)
+@tasks.loop(minutes=5)
+async def evict_idle_guilds():
+    """
+        Run a background task that drops the state of guilds without events for GUILD_IDLE_SECONDS from memory
+    """
+    evicted = guild_cache.evict_idle()
+    if evicted:
+        logger.info(f"Evicted {evicted} idle guilds, {len(guild_cache)} guilds stay loaded.", extra={'event': 'eviction'})
 
-# ---------------------- Background Tasks ---------------------- #
+@tasks.loop(minutes=10)
+@timed('expire_old_questions')
+async def expire_old_questions():
+    """
+        Run a background task that closes the questions of the loaded guilds that are older than their retention period
+        and drops posts older than SEARCH_TTL_DAYS from their search index, a few guilds at a time.
+        Guilds that are not loaded are swept once their next event loads them.
+    """
+    expired = 0
+    expired_posts = 0
+    server_ids = list(guild_cache.last_used) # closing questions moves a guild to the end of last_used
+    for batch_start in range(0, len(server_ids), RETENTION_BATCH):
+        for server_id in server_ids[batch_start:batch_start + RETENTION_BATCH]:
+            if server_id in guild_cache: # evicted while the sweeper waited
+                expired += expire_questions(server_id)
+                expired_posts += await expire_posts(server_id)
+        await asyncio.sleep(0)
+    if expired:
+        logger.info(f"Closed {expired} questions past their retention period.", extra={'event': 'retention'})
+    if expired_posts:
+        logger.info(f"Dropped {expired_posts} posts older than {SEARCH_TTL_DAYS} days from the search index.", extra={'event': 'retention'})
 
 @tasks.loop(minutes=15)
+@timed('update_files')
 async def update_files():
     """
-        Run a background task that handles file handling processes and creates backups on a regular interval
+        Run a background task that compacts the storage backend on a regular interval
     """
-    temp_messages_data = {}
-    temp_user_data = {}
-
     try:
-        temp_messages_data.update(messages_data.copy())
-    except (ValueError, SyntaxError):
-        # If the current user data is corrupted, use previous data and set the current data to previous one
-        temp_messages_data.update(prev_messages_data.copy())
-        messages_data.clear()
-        messages_data.update(prev_messages_data)
-    
-    try: 
-        temp_user_data.update(user_data.copy())
-    except (ValueError, SyntaxError):
-        # If the current user data is corrupted, use previous data and set the current data to previous one
-        temp_user_data.update(prev_user_data.copy())
-        user_data.clear()
-        user_data.update(prev_user_data)
-
-    with open('files/users.json','w') as f:
-        json.dump(temp_user_data,f)
-
-    with open('files/messages.json','w') as f:
-        json.dump(temp_messages_data,f)
+        compacted = await asyncio.get_event_loop().run_in_executor(storage_executor, storage.compact)
+    except (OSError, ValueError, sqlite3.Error) as error:
+        logger.error(f"Storage compaction failed, will retry on the next run: {error}", extra={'event': 'compaction'})
+        return
 
-    logger.info("15 minutes up, file backup completed!")
-    print("15 minutes up, file backup completed!")
+    logger.info(f"15 minutes up, compacted {compacted} stored records!", extra={'event': 'compaction'})
+    print(f"15 minutes up, compacted {compacted} stored records!")
 
 # ---------------------- Bot Commands ---------------------- #
 
@@ -233,63 +2543,48 @@ async def help(ctx):
         Displays the help menu embed.\n
         Command Format: ph!help
     """
-    role_list = "typescript  swift  sql  rust  ruby  php  perl  python  mac  linux  kotlin  java  javascript  haskell  golang  erlang  csharp  cpp  windows  c_  r_"
-    emb = discord.Embed(
-        title="Help Menu",
-        colour=discord.Colour.green()
-    )
-    emb.add_field(name="ph!setup", value="Set the level system of the guild/server. **Command user needs to have admin access.**", inline=False)
-    emb.add_field(name="ph!hardreset", value="Hard reset the bot for the particular guild/server. **Command user needs to have admin access.**", inline=False)
-    emb.add_field(name="ph!ask @role", value="Ask a question about a role. :arrows_counterclockwise: to answer the question, :arrow_up: to upvote and :white_check_mark: to mark it solved. **Bot requires permissions in the channel: manage_messages=True, manage_roles=True**", inline=False)
-    emb.add_field(name="ph!rank", value="See your level and exp points as of now.", inline=False)
-    emb.add_field(name="ph!welcome", value="Set the welcome message for users new to the server. By default, no message is sent to the new user. **Command user needs to have admin access.**", inline=False)
-    emb.add_field(name="ph!addrole @role <web-url-to-thumnail-image>", value="Add a role to/about which questions can be asked. URL to thumbnail image is optional. **Command user needs to have admin access.**", inline=False)
-    emb.add_field(name="ph!delrole @role", value="Delete a role from being asked a question. The  actual server role will NOT be deleted. **Command user needs to have admin access.**", inline=False)
-    emb.add_field(name="Default Roles", value=f"We provide default roles that you can add in your sever for ph!ask commands (create one of the below roles in the guild) : \n*{role_list}*", inline=False)
-    await ctx.send(embed=emb)
+    await ctx.send(embed=help_embed())
 
 @bot.command()
 @commands.has_permissions(administrator=True)
 async def reset(ctx):
     """
         Performs a hard reset of the bot. 
-        User roles will not be taken away but the messages data, user experience, custom roles and server setup will be wiped.
+        User roles will not be taken away but the messages data, search index, user experience, custom roles and server setup will be wiped.
         Use in case the bot becomes unresponsive to the commands, for a hard fix, wiping user data as well. Needs administrative access.\n
         Command Format: ph!reset
     """
-    await ctx.send("Are you really sure you want to reset all bot data?\nNote: This will not take away the roles assigned by the bot but the user exp will be reset.\nEnter **yes** to continue, **nope** to cancel")
-    confirmation = await bot.wait_for('message', check=lambda message: message.author == ctx.author, timeout=300)
-    if confirmation.content.lower() == "yes":
-        server_id = str(ctx.guild.id)
-
-        # Reset data here
-        messages_data[server_id] = []
-        custom_roles[server_id].clear()
-        user_data[server_id].clear()
-        server_info[server_id].clear()
-        welcome_message[server_id] = ""
-
-        # Clean up the files
-        with open('files/servers.json','w') as f:
-            json.dump(server_info,f)
-        
-        with open('files/roles.json','w') as f:
-            json.dump(custom_roles,f)
-
-        with open('files/users.json','w') as f:
-            json.dump(user_data,f)
-        
-        with open('files/servers.json','w') as f:
-            json.dump(messages_data,f)
-        
-        with open('files/welcomes.json','w') as f:
-            json.dump(welcome_message,f)
+    conversation = conversations.open(ctx.channel, ctx.author)
+    if conversation is None:
+        await ctx.send(CONVERSATION_BUSY_MESSAGE.format(user=ctx.author))
+        return
 
-        await ctx.send('Reset Completed!')
+    with conversation:
+        await ctx.send("Are you really sure you want to reset all bot data?\nNote: This will not take away the roles assigned by the bot but the user exp will be reset.\nEnter **yes** to continue, **nope** to cancel")
+        try:
+            confirmation = await conversation.next(timeout=300)
+        except asyncio.TimeoutError:
+            await ctx.send("Due to no response from the user in 5 minutes, the reset is cancelled.")
+            return
+        if confirmation.content.lower() == "yes":
+            server_id = str(ctx.guild.id)
+
+            # Reset data here
+            persist('put', 'messages_data', server_id, [])
+            search_executor.submit(search_store.clear, server_id).add_done_callback(log_storage_error)
+            persist('put', 'custom_roles', server_id, {})
+            role_thumbnails.pop(server_id, None)
+            persist('put', 'user_data', server_id, {})
+            rankings.pop(server_id, None)
+            persist('put', 'server_info', server_id, {})
+            level_tables.pop(server_id, None)
+            persist('put', 'welcome_message', server_id, "")
+
+            await ctx.send('Reset Completed!')
         
-    else:
-        await ctx.send("Reset Cancelled!")
-        return
+        else:
+            await ctx.send("Reset Cancelled!")
+            return
 
 @bot.command()
 @commands.has_permissions(administrator=True)
@@ -302,30 +2597,32 @@ async def welcome(ctx):
     """
     server_id = str(ctx.guild.id)
     welcome_string = ""
-    if not server_id in welcome_message.keys():
-        welcome_message[server_id] = {}
     
-    await ctx.send("Type the strings one by one and enter 'done' when you're finished.\nEnter 'nope' to cancel.")
-    while True:
-        try:
-            welcome = await bot.wait_for('message', check=lambda message: message.author == ctx.author, timeout=300)
-        except asyncio.TimeoutError:
-            await ctx.send("Due to no response from the user in 5 minutes, the welcome message setting process is terminated.")
-            return
+    conversation = conversations.open(ctx.channel, ctx.author)
+    if conversation is None:
+        await ctx.send(CONVERSATION_BUSY_MESSAGE.format(user=ctx.author))
+        return
+
+    with conversation:
+        await ctx.send("Type the strings one by one and enter 'done' when you're finished.\nEnter 'nope' to cancel.")
+        while True:
+            try:
+                welcome = await conversation.next(timeout=300)
+            except asyncio.TimeoutError:
+                await ctx.send("Due to no response from the user in 5 minutes, the welcome message setting process is terminated.")
+                return
         
-        if welcome.content.lower() == 'done':
-            break
-        if welcome.content.lower() == 'nope':
-            welcome_string = ""
-            return
+            if welcome.content.lower() == 'done':
+                break
+            if welcome.content.lower() == 'nope':
+                welcome_string = ""
+                return
 
-        welcome_string = welcome_string + welcome.content + "\n"
+            welcome_string = welcome_string + welcome.content + "\n"
     
-    welcome_string = welcome_string + "\nUse ph!help in the server I am in to see my functionalities. My command prefix is: `ph!help`"
-    welcome_message[server_id] = welcome_string
-    with open('files/welcomes.json','w') as f:
-        json.dump(welcome_message,f)
-    await ctx.send("Welcome message stored successfully!")
+        welcome_string = welcome_string + "\nUse ph!help in the server I am in to see my functionalities. My command prefix is: `ph!help`"
+        persist('put', 'welcome_message', server_id, welcome_string)
+        await ctx.send("Welcome message stored successfully!")
 
 @bot.command()
 async def rank(ctx):
@@ -338,6 +2635,91 @@ async def rank(ctx):
     await add_user_data(user=user, server_id=server_id)
     await display_rank(user=user, channel=ctx.channel)
 
+@bot.command()
+@commands.has_permissions(administrator=True)
+async def stats(ctx):
+    """
+        Displays the latency of commands and events, REST usage and event loop health of the bot.\n
+        Command Format: ph!stats
+    """
+    emb = discord.Embed(
+        title="Bot Statistics",
+        color=discord.Colour.green()
+    )
+    for name, title in (('command_latency_seconds', "Commands"), ('event_latency_seconds', "Events")):
+        rows = [f"{label}: {histogram.count} calls, p50 {histogram.quantile(0.5) * 1000:.0f}ms, p99 {histogram.quantile(0.99) * 1000:.0f}ms" for label, histogram in sorted(metrics.histograms[name].items())]
+        emb.add_field(name=title, value="\n".join(rows) or "Nothing recorded yet.", inline=False)
+
+    busiest_routes = metrics.counters['rest_requests_total'].most_common(5)
+    emb.add_field(name="REST Calls", value="\n".join(f"{route}: {count}" for route, count in busiest_routes) or "None yet.", inline=False)
+    emb.add_field(name="Rate Limited", value=sum(metrics.counters['rest_rate_limits_total'].values()), inline=True)
+    emb.add_field(name="Conversations", value=conversations.in_flight, inline=True)
+    cache_results = metrics.counters['guild_cache_total']
+    hit_ratio = cache_results['hit'] / max(cache_results['hit'] + cache_results['miss'], 1)
+    emb.add_field(name="Guilds Loaded", value=f"{len(guild_cache)} ({hit_ratio:.0%} cache hits)", inline=True)
+    startup = metrics.histograms['startup_seconds']
+    emb.add_field(name="Startup", value="\n".join(f"{stage}: {histogram.sum:.1f}s" for stage, histogram in startup.items()) or "Not ready yet.", inline=True)
+    emb.add_field(name="Lookups", value=f"{entities.hit_ratio():.0%} without REST", inline=True)
+    emb.add_field(name="DMs Queued", value=len(dm_dispatcher), inline=True)
+    emb.add_field(name="DMs Failed", value=sum(metrics.counters['dm_failures_total'].values()), inline=True)
+    loop_lag = metrics.histograms['event_loop_lag_seconds'][CLUSTER_ID]
+    emb.add_field(name="Event Loop Lag p99", value=f"{loop_lag.quantile(0.99) * 1000:.0f}ms", inline=True)
+    emb.add_field(name="Gateway Latency", value=f"{bot.latency * 1000:.0f}ms", inline=True)
+
+    await ctx.send(embed=emb)
+
+@bot.command()
+async def leaderboard(ctx, page: int = 1):
+    """
+        Displays the members of the server with the most experience points, ten per page.\n
+        Command Format: ph!leaderboard <page-optional>
+    """
+    await display_leaderboard(guild=ctx.guild, channel=ctx.channel, page=page)
+
+@bot.command()
+async def search(ctx, *terms):
+    """
+        Search the questions and answers asked in the server, optionally only the ones about a role.\n
+        Command Format: ph!search <terms> @role-optional
+    """
+    role = ctx.message.role_mentions
+    server_id = str(ctx.guild.id)
+
+    if len(role) > 1:
+        await ctx.send("Please include at most one role mention!")
+        return
+
+    query = " ".join(term for term in terms if not term.startswith('<@'))
+    if not tokenize(query):
+        await ctx.send("Please use the valid format: ```ph!search <terms> @role-optional```")
+        return
+
+    role_name = role[0].name if role else None
+    results = await asyncio.get_event_loop().run_in_executor(search_executor, search_store.search, server_id, query, role_name, SEARCH_RESULTS)
+    title = f"Search results for: {query}" + (f" ({role_name})" if role_name else "")
+    await display_search_results(ctx.channel, title, results)
+
+@bot.command()
+@commands.has_permissions(administrator=True)
+async def retention(ctx, days: int = None):
+    """
+        See or set after how many days questions that nobody marked solved stop being tracked and are archived, 0 to never stop.\n
+        Command Format: ph!retention <days-optional>
+    """
+    server_id = str(ctx.guild.id)
+
+    if days is None:
+        current = retention_days(server_id)
+        await ctx.send(f"Questions are tracked for {current} days." if current else "Questions are tracked until they are marked solved.")
+        return
+
+    if days < 0:
+        await ctx.send("Please enter a number of days that is 0 or more!")
+        return
+
+    persist('set', 'server_info', server_id, "retention_days", days)
+    await ctx.send(f"Questions will be tracked for {days} days." if days else "Questions will be tracked until they are marked solved.")
+
 @bot.command()
 @commands.has_permissions(administrator=True)
 async def addrole(ctx, *message):
@@ -348,9 +2730,6 @@ async def addrole(ctx, *message):
     role = ctx.message.role_mentions    
     server_id = str(ctx.guild.id)
 
-    if not server_id in custom_roles.keys():
-        custom_roles[server_id] = {}
-
     if len(role) != 1:
         await ctx.send("Please use the valid format: ```ph!addrole @role <link-optional>```")
         return
@@ -361,13 +2740,13 @@ async def addrole(ctx, *message):
     
     if len(message) == 2:
         _, link_message = message
-        custom_roles[server_id].update({str(role[0].name) : str(link_message)})
+        persist('set', 'custom_roles', server_id, str(role[0].name), str(link_message))
 
     if len(message) == 1:
-        custom_roles[server_id].update({str(role[0].name) : r'https://cdn.discordapp.com/emojis/741984835698163742'})
+        persist('set', 'custom_roles', server_id, str(role[0].name), DEFAULT_THUMBNAIL)
+
+    role_thumbnails.pop(server_id, None) # resolved again on the next ph!ask
 
-    with open('files/roles.json','w') as f:
-        json.dump(custom_roles,f)
     await ctx.send("Role added successfully!")
 
 @bot.command()
@@ -390,11 +2769,11 @@ async def delrole(ctx):
         return
     
     roleName = role[0].name
-    try:
-        custom_roles[server_id].pop(roleName)
-    except KeyError:
+    if not roleName in custom_roles[server_id]:
         await ctx.send(f"{role[0].name} hasn't been added to custom roles yet.")
         return
+    persist('del', 'custom_roles', server_id, roleName)
+    role_thumbnails.pop(server_id, None)
 
     await ctx.send("Role access deleted successfully!")
 
@@ -408,58 +2787,64 @@ async def setup(ctx):
     """
     server_id = str(ctx.guild.id)
     role_by_level = {}
-    role_by_level[server_id] = {}
-
-    await ctx.send("Please enter the number of levels you want to set for ranking system. Default level for everyone is level 1.")
-    try:
-        number_of_levels = await bot.wait_for('message', check=lambda message: message.author == ctx.author, timeout=300)
-    except asyncio.TimeoutError:
-        await ctx.send("Due to no response from the user in 5 minutes, the process is terminated.")
-        return
+    role_by_level[server_id] = {"role_ids": {}}
 
-    try:
-        total_levels = int(number_of_levels.content)
-    except ValueError:
-        await ctx.send("Please enter a valid integer/number! The process is terminated...")
+    conversation = conversations.open(ctx.channel, ctx.author)
+    if conversation is None:
+        await ctx.send(CONVERSATION_BUSY_MESSAGE.format(user=ctx.author))
         return
 
-    for level in range(total_levels):
-        await ctx.send(f"Please enter the role to be assigned when the user reaches level {level+2}")
+    with conversation:
+        await ctx.send("Please enter the number of levels you want to set for ranking system. Default level for everyone is level 1.")
         try:
-            role_message = await bot.wait_for('message', check=lambda message: message.author == ctx.author, timeout=300)
+            number_of_levels = await conversation.next(timeout=300)
         except asyncio.TimeoutError:
             await ctx.send("Due to no response from the user in 5 minutes, the process is terminated.")
             return
-        
-        role = role_message.role_mentions
-        if len(role) != 1:
-            await ctx.send("Please include at least (and not more than) one role!")
-            await ctx.send("Process terminated.")
+
+        try:
+            total_levels = int(number_of_levels.content)
+        except ValueError:
+            await ctx.send("Please enter a valid integer/number! The process is terminated...")
             return
-        role_by_level[server_id][level+2] = role[0].name
-    
-    # Ask in which channel the bot has to check for reactions/emotes, the reactions in rest of the channels will be ignored
-    await ctx.send("Please enter the channel where the bot is to be active #channel.")
-    try:
-        channel_for_bot = await bot.wait_for('message', check=lambda message: message.author == ctx.author, timeout=300)
-    except asyncio.TimeoutError:
-        await ctx.send("Due to no response from the user in 5 minutes, the process is terminated.")
-        return 
 
-    channel_mentions = channel_for_bot.channel_mentions
+        for level in range(total_levels):
+            await ctx.send(f"Please enter the role to be assigned when the user reaches level {level+2}")
+            try:
+                role_message = await conversation.next(timeout=300)
+            except asyncio.TimeoutError:
+                await ctx.send("Due to no response from the user in 5 minutes, the process is terminated.")
+                return
+        
+            role = role_message.role_mentions
+            if len(role) != 1:
+                await ctx.send("Please include at least (and not more than) one role!")
+                await ctx.send("Process terminated.")
+                return
+            role_by_level[server_id][str(level+2)] = role[0].name
+            role_by_level[server_id]["role_ids"][str(level+2)] = role[0].id
+    
+        # Ask in which channel the bot has to check for reactions/emotes, the reactions in rest of the channels will be ignored
+        await ctx.send("Please enter the channel where the bot is to be active #channel.")
+        try:
+            channel_for_bot = await conversation.next(timeout=300)
+        except asyncio.TimeoutError:
+            await ctx.send("Due to no response from the user in 5 minutes, the process is terminated.")
+            return 
 
-    if len(role) != 1:
-        await ctx.send("Please include at least (and not more than) one  channel_mention! Process is terminated...")
-        return
+        channel_mentions = channel_for_bot.channel_mentions
 
-    role_by_level[server_id]["channel_id"] = channel_mentions[0].id
-    server_info.update(role_by_level)
+        if len(channel_mentions) != 1:
+            await ctx.send("Please include at least (and not more than) one  channel_mention! Process is terminated...")
+            return
 
-    # Since setup is only done at most once, no need to back it up in a background process continously, just run it once 
-    with open('files/servers.json','w') as f:
-        json.dump(server_info,f)
+        role_by_level[server_id]["channel_id"] = channel_mentions[0].id
+        if "retention_days" in server_info.get(server_id, {}): # set with ph!retention, not part of the setup
+            role_by_level[server_id]["retention_days"] = server_info[server_id]["retention_days"]
+        persist('put', 'server_info', server_id, role_by_level[server_id])
+        level_tables[server_id] = LevelTable(server_info[server_id])
 
-    await ctx.send('Setup Complete!')
+        await ctx.send('Setup Complete!')
 
 @bot.command()
 @commands.bot_has_permissions(manage_messages=True, manage_roles=True)
@@ -468,12 +2853,8 @@ async def ask(ctx):
         Ask a question about a role. Only default roles can be asked a question about, or a role added using ph!addrole.\n
         Command Format: ph!ask @role
     """
-    prev_messages_data.update(messages_data.copy())
     server_id = str(ctx.guild.id)
 
-    if not server_id in messages_data.keys():
-        messages_data[server_id] = []
-
     try:
         if ctx.message.channel.id != server_info[server_id]["channel_id"]:
             await ctx.send("You can not use the command in this channel!\nChange target channel using ph!setup (admin acess required)")
@@ -496,329 +2877,405 @@ async def ask(ctx):
     role_name = role[0].name
     role_color = role[0].color
 
-    in_custom_roles =  False
-    try:
-        in_custom_roles = role_name in custom_roles[server_id].keys()
-    except KeyError:
-        pass
-
     # Check if a query can be made about the role and if yes, then fetch the thumbnail url for the embed
-    if (not role_name in allowed_roles.keys()) and (not in_custom_roles):
-        await ctx.send("Question can not be asked about this role!")
-        await ctx.channel.delete_messages(messages_to_clean_up)
-        await asyncio.sleep(1)
-        await ctx.channel.purge(limit=1)
+    thumbnail_url = ask_roles(server_id).get(role_name)
+    if thumbnail_url is None:
+        notice = await ctx.send("Question can not be asked about this role!")
+        clean_up(ctx.channel, *messages_to_clean_up, notice)
         return
 
-    thumbnail_url = r'https://cdn.discordapp.com/emojis/741984835698163742'
-    if not in_custom_roles:
-        thumbnail_url = r'https://cdn.discordapp.com/emojis/'+str(allowed_roles[role_name])
-    else:
-        try:
-            thumbnail_url = custom_roles[server_id][role_name] or r'https://cdn.discordapp.com/emojis/'+str(allowed_roles[role_name])  
-        except KeyError:
-            pass
-    
-    # Ask for a question
-    await ask_question(ctx, role_color)
-    try:
-        ask_message_embed = await ctx.channel.fetch_message(ctx.channel.last_message_id)
-    except (discord.NotFound, discord.HTTPException):
-        await ctx.send('Something went wrong, either the original message was not found or a 404 HTTP Error occured.\nSorry for the inconvenience, please retry.')
+    conversation = conversations.open(ctx.channel, ctx.author)
+    if conversation is None:
+        await ctx.send(CONVERSATION_BUSY_MESSAGE.format(user=ctx.author))
         return
-    messages_to_clean_up.append(ask_message_embed)
-
-    # Run an infinite loop until the user inputs 'done', 'nope' or timeout occurs due to no user response in 5 mins
-    while True:
-        try:
-            question = await bot.wait_for('message', check=lambda message: message.author == ctx.author, timeout=300)
-        except asyncio.TimeoutError:
-            await ctx.send("Due to no response from the user in 5 minutes, the process is terminated.")
-            await ctx.channel.delete_messages(messages_to_clean_up)
-            await ctx.channel.purge(limit=1)
-            return
-        
-        if question.content.lower() == 'done':
-            messages_to_clean_up.append(question)
-            break
-        if question.content.lower() == 'nope':
-            messages_to_clean_up.append(question)
-            await ctx.channel.delete_messages(messages_to_clean_up)
-            return
 
-        question_full_string = question_full_string + question.content + "\n"
-        messages_to_clean_up.append(question)
+    with conversation:
+        # Ask for a question
+        ask_message_embed = await ask_question(ctx, role_color)
+        messages_to_clean_up.append(ask_message_embed)
 
-    if len(question_full_string) == 0:
-        await ctx.channel.delete_messages(messages_to_clean_up)
-        return
+        # Run an infinite loop until the user inputs 'done', 'nope' or timeout occurs due to no user response in 5 mins
+        while True:
+            try:
+                question = await conversation.next(timeout=300)
+            except asyncio.TimeoutError:
+                notice = await ctx.send("Due to no response from the user in 5 minutes, the process is terminated.")
+                clean_up(ctx.channel, *messages_to_clean_up, notice)
+                return
+        
+            if question.content.lower() == 'done':
+                messages_to_clean_up.append(question)
+                break
+            if question.content.lower() == 'nope':
+                messages_to_clean_up.append(question)
+                clean_up(ctx.channel, *messages_to_clean_up)
+                return
 
-    # Create embed
-    emb = discord.Embed(
-        title = f'{author.display_name} has a query about : *{role_name}*',
-        colour = role_color
-    )
-    emb.set_author(name=author.display_name, icon_url=author.avatar_url)
-    emb.add_field(name="**#Question**",value=question_full_string, inline=False)
-    emb.set_thumbnail(url=thumbnail_url)
-    emb.set_footer(text="Upvote ⬆️ | Answer | Mark Solved")
+            question_full_string = question_full_string + question.content + "\n"
+            messages_to_clean_up.append(question)
 
-    # Deleting the original messages and sending the embed
-    await ctx.send('Cleaning up...wait for a few seconds...')
-    try:
-        await ctx.channel.delete_messages(messages_to_clean_up)
-        await ctx.channel.purge(limit=1) # delete the most recent message
-    except discord.HTTPException:
-        pass
+        if len(question_full_string) == 0:
+            clean_up(ctx.channel, *messages_to_clean_up)
+            return
 
-    await ctx.send(embed=emb)
+        # Point the user to similar posts first, they may already have been answered
+        duplicates = await similar_posts(server_id, role_name, question_full_string) if SUGGEST_DUPLICATES else []
+        if duplicates:
+            suggestion = await display_search_results(ctx.channel, "These posts look similar to your question:", duplicates, footer="Enter 'post' to post your question anyway or 'nope' to cancel.")
+            messages_to_clean_up.append(suggestion)
+            try:
+                confirmation = await conversation.next(timeout=300)
+            except asyncio.TimeoutError:
+                notice = await ctx.send("Due to no response from the user in 5 minutes, the process is terminated.")
+                clean_up(ctx.channel, *messages_to_clean_up, notice)
+                return
 
-    # Add emojis to the embed
-    bot_message_id = ctx.channel.last_message_id
-    messages_data[server_id].append(bot_message_id)
+            messages_to_clean_up.append(confirmation)
+            if confirmation.content.lower() != 'post':
+                clean_up(ctx.channel, *messages_to_clean_up)
+                return
 
-    try:
-        bot_message = await ctx.channel.fetch_message(bot_message_id)
-    except (discord.NotFound, discord.HTTPException):
-        await ctx.send('Something went wrong, either the original message could not be fetched or a 404 HTTP Error occured.\nSorry for the inconvenience, please retry.')
-        return
-    await add_reaction(bot_message,'⬆️','🔄','✅')
+        # Create embed
+        emb = discord.Embed(
+            title = f'{author.display_name} has a query about : *{role_name}*',
+            colour = role_color
+        )
+        emb.set_author(name=author.display_name, icon_url=author.avatar_url)
+        emb.add_field(name="**#Question**",value=question_full_string, inline=False)
+        emb.set_thumbnail(url=thumbnail_url)
+        emb.set_footer(text="Upvote ⬆️ | Answer | Mark Solved")
+
+        # Deleting the original messages and sending the embed
+        clean_up(ctx.channel, *messages_to_clean_up)
+        bot_message = await ctx.send(embed=emb)
+
+        # Add emojis to the embed
+        persist('add', 'messages_data', server_id, bot_message.id, {'author': author.id, 'role': role_name, 'title': emb.title, 'upvotes': 0, 'pinned': False})
+        index_post(bot_message, 'question', author, role_name, emb.title, question_full_string)
+        await add_reaction(bot_message,'⬆️','🔄','✅')
     
-    await add_user_data(user=author, server_id=server_id)
-    await add_experience(user=author, exp_points=1, server_id=server_id) # provide 1 * 1000 exp_point for asking a question
-    await level_up(user=author, channel=ctx.channel)
+        await award_experience(user=author, exp_points=1, channel=ctx.channel) # provide 1 * 1000 exp_point for asking a question
 
 # ---------------------- Bot Events ---------------------- #
 
 @bot.event
+async def on_message(message):
+    if trace is not None:
+        trace_message(message)
+    # Messages that belong to an open conversation are answers to the bot, not commands
+    if conversations.dispatch(message):
+        return
+    await bot.process_commands(message)
+
+@bot.event
+@timed('on_member_join')
 async def on_member_join(member):
     server_id = str(member.guild.id)
+    await guild_cache.load(server_id)
     await add_user_data(user=member, server_id=server_id)
-    if len(welcome_message[server_id]) > 0:
-        await member.send(welcome_message[server_id])
+    if welcome_message.get(server_id): # guilds without ph!welcome have no entry
+        dm_dispatcher.send(member, welcome_message[server_id], 'welcome', server_id)
 
 @bot.event
+@timed('on_raw_reaction_add')
 @commands.bot_has_permissions(manage_messages=True, manage_roles=True)
 async def on_raw_reaction_add(payload):
-    prev_messages_data.update(messages_data.copy())
+    if trace is not None:
+        trace_reaction(payload)
     message_id, channel_id, guild_id, user_id = (payload.message_id, payload.channel_id, payload.guild_id, payload.user_id)
 
     if user_id == 741382171515945070: # id of the bot, ignore reaction event from bot itself
         return
 
+    await guild_cache.load(guild_id)
+
     if channel_id != server_info[str(guild_id)]["channel_id"]: # not the configured channel, ignore reaction event
         return
     
     answer_full_string = ""
     messages_to_clean_up = []
 
-    guild = discord.utils.find(lambda g: g.id == guild_id, bot.guilds)
-    channel = discord.utils.find(lambda c: c.id == channel_id, guild.channels)
+    guild = await entities.guild(guild_id)
+    channel = await entities.channel(guild, channel_id) if guild is not None else None
+    if channel is None:
+        return
 
-    if message_id in reversed(messages_data[str(guild_id)]):
+    if message_id in messages_data.get(str(guild_id), ()):
         user = payload.member # Can only fetch this property for on_reaction_add
-        try:
-            message = await channel.fetch_message(message_id)
-        except:
+        info = await tracked_message_info(channel, message_id)
+        if info is None:
             await channel.send('Something went wrong, either the original message could not be fetched or a 404 HTTP Error occured.\nSorry for the inconvenience, please retry.')
             return
-        
-        embed_list = message.embeds
-        message_embed = embed_list[0]
-        message_author = message_embed.author
-        original_author = discord.utils.find(lambda u: u.name == message_author.name, guild.members)
+        original_author = await entities.member(guild, info['author']) if info['author'] else None
 
         # Handle event in case of 'upvote' emote being added
         if payload.emoji.name == '⬆️':
-            if user == original_author:
+            if user == original_author or original_author is None:
                 return
 
-            # Check if there are already more than 10+ upvotes on the message, if yes, then pin it
-            reactions = discord.utils.get(message.reactions, emoji=payload.emoji.name)
-            if reactions and reactions.count >= 10:
+            # Count the upvote before awaiting anything, so concurrent upvotes never overwrite each other's counts
+            info = dict(info, upvotes=info['upvotes'] + 1)
+            pin = info['upvotes'] >= PIN_UPVOTES and not info['pinned']
+            if pin:
+                info['pinned'] = True # claimed by this upvote, the ones arriving while it is pinned don't pin again
+            persist('update', 'messages_data', str(guild_id), message_id, info)
+
+            experience_batcher.add(user=original_author, exp_points=0.25, channel=channel) # provide 0.25 * 1000 exp_point per upvote
+
+            # Pin the message once it has 10+ upvotes
+            if pin:
+                message = await fetch_tracked_message(channel, message_id)
                 try:
-                    await message.pin()
+                    if message is not None:
+                        await message.pin()
                 except discord.HTTPException:
                     await channel.send(f"Message {message_id} could not be pinned because there are already more than 50 pins in this channel.")
-
-            await add_user_data(user=original_author, server_id=guild_id)
-            await add_experience(user=original_author, exp_points=0.25, server_id=guild_id) # provide 0.25 * 1000 exp_point per upvote
-            await level_up(user=original_author, channel=channel)
+                    message = None
+                if message is None:
+                    set_pinned(str(guild_id), message_id, False)
         
         # Handle event in case of 'mark solved' being added
         if payload.emoji.name == '✅':            
             if user == original_author:
-                await channel.send(f"{original_author} do you really want to mark the question completed? Doing so will close the question, making other users unable to answer/upvote to it. Enter **'yes'** to continue and **'nope'** to cancel.")                
-                try:
-                    bot_query = await channel.fetch_message(channel.last_message_id)
-                except:
-                    await channel.send('Something went wrong, either the original message could not be fetched or a 404 HTTP Error occured.\nSorry for the inconvenience, please retry.')
+                conversation = conversations.open(channel, user)
+                if conversation is None:
+                    await channel.send(CONVERSATION_BUSY_MESSAGE.format(user=user))
                     return
-                messages_to_clean_up.append(bot_query)
 
-                try:
-                    user_response = await bot.wait_for('message', check=lambda message: message.author == user, timeout=300)
-                except asyncio.TimeoutError:
-                    await channel.send("Due to no response from the user in 5 minutes, the process is terminated.")
-                    await channel.delete_messages(messages_to_clean_up)
-                    await channel.purge(limit=1)
-                    return
-                
-                if user_response.content.lower() == 'yes':
+                with conversation:
+                    bot_query = await channel.send(f"{original_author} do you really want to mark the question completed? Doing so will close the question, making other users unable to answer/upvote to it. Enter **'yes'** to continue and **'nope'** to cancel.")
+                    messages_to_clean_up.append(bot_query)
+
                     try:
-                        await channel.purge(limit=1)
-                        await channel.delete_messages(messages_to_clean_up)
-                    except discord.HTTPException:
-                        pass
-                    await message.clear_reactions()
-                    messages_data[str(guild_id)].remove(message_id)
-                else:
-                    await channel.purge(limit=1)
-                    await channel.delete_messages(messages_to_clean_up)
-                    return
+                        user_response = await conversation.next(timeout=300)
+                    except asyncio.TimeoutError:
+                        notice = await channel.send("Due to no response from the user in 5 minutes, the process is terminated.")
+                        clean_up(channel, *messages_to_clean_up, notice)
+                        return
+                
+                    clean_up(channel, *messages_to_clean_up, user_response)
+                    if user_response.content.lower() == 'yes':
+                        message = await fetch_tracked_message(channel, message_id)
+                        if message is not None:
+                            await message.clear_reactions()
+                        close_questions(str(guild_id), [message_id], 'solved')
+                    else:
+                        return
 
         # Handle event in case of 'answer' emote being added
         if payload.emoji.name == '🔄':    
-            if user == original_author:
+            if user == original_author or original_author is None:
                 return
                     
-            await answer_question(channel)
-            try:
-                ask_answer = await channel.fetch_message(channel.last_message_id)
-            except:
-                await channel.send('Something went wrong, either the original message could not be fetched or a 404 HTTP Error occured.\nSorry for the inconvenience, please retry.')
+            conversation = conversations.open(channel, user)
+            if conversation is None:
+                await channel.send(CONVERSATION_BUSY_MESSAGE.format(user=user))
                 return
-            messages_to_clean_up.append(ask_answer)
 
-            # Run an infinite loop until the user inputs 'done', 'nope' or timeout occurs due to no user response in 5 mins
-            while True:
-                try:
-                    answer_message = await bot.wait_for('message', check=lambda message: message.author == user, timeout=300)
-                except asyncio.TimeoutError:
-                    await channel.send("Due to no response from the user in 5 minutes, the process is terminated.")
-                    await channel.delete_messages(messages_to_clean_up)
-                    await channel.purge(limit=1)
-                    return
+            with conversation:
+                ask_answer = await answer_question(channel)
+                messages_to_clean_up.append(ask_answer)
+
+                # Run an infinite loop until the user inputs 'done', 'nope' or timeout occurs due to no user response in 5 mins
+                while True:
+                    try:
+                        answer_message = await conversation.next(timeout=300)
+                    except asyncio.TimeoutError:
+                        notice = await channel.send("Due to no response from the user in 5 minutes, the process is terminated.")
+                        clean_up(channel, *messages_to_clean_up, notice)
+                        return
                 
-                if answer_message.content.lower() == 'done':
-                    messages_to_clean_up.append(answer_message)
-                    break
-                if answer_message.content.lower() == 'nope':
-                    messages_to_clean_up.append(answer_message)
-                    await channel.delete_messages(messages_to_clean_up)
-                    await message.remove_reaction('🔄',user)
-                    return
+                    if answer_message.content.lower() == 'done':
+                        messages_to_clean_up.append(answer_message)
+                        break
+                    if answer_message.content.lower() == 'nope':
+                        messages_to_clean_up.append(answer_message)
+                        clean_up(channel, *messages_to_clean_up)
+                        await channel.get_partial_message(message_id).remove_reaction('🔄',user)
+                        return
                 
-                messages_to_clean_up.append(answer_message)
-                answer_full_string = answer_full_string + answer_message.content + "\n"
-
-            # If user inputs 'done' without entering anything before, invalidate the answer and remove the reaction
-            if len(answer_full_string) == 0:
-                await channel.delete_messages(messages_to_clean_up)
-                await message.remove_reaction('🔄',user)
-                return
+                    messages_to_clean_up.append(answer_message)
+                    answer_full_string = answer_full_string + answer_message.content + "\n"
 
-            # Create an embed of the answer
-            question_title = message_embed.title
-            emb = discord.Embed(
-                title= f"Response to: \n{question_title}",
-                colour= discord.Colour.red()
-            )
-            emb.set_author(name=user.name, icon_url=user.avatar_url)
-            emb.add_field(name='Answer in full:', value=answer_full_string, inline=False)
-            emb.set_footer(text='Upvote')
-
-            await channel.send('Cleaning up...wait for a few seconds...')
-            try:
-                await channel.delete_messages(messages_to_clean_up)
-                await channel.purge(limit=1)
-            except discord.HTTPException:
-                pass
-            await channel.send(embed=emb)
+                # If user inputs 'done' without entering anything before, invalidate the answer and remove the reaction
+                if len(answer_full_string) == 0:
+                    clean_up(channel, *messages_to_clean_up)
+                    await channel.get_partial_message(message_id).remove_reaction('🔄',user)
+                    return
 
-            # Add reactions to the answer embed
-            try:
-                embed_message_id = await channel.fetch_message(channel.last_message_id)
-            except:
-                await channel.send('Something went wrong, either the original message could not be fetched or a 404 HTTP Error occured.\nSorry for the inconvenience, please retry.')
-                return
-            await add_reaction(embed_message_id, '⬆️')
-            messages_data[str(guild_id)].append(embed_message_id.id)
+                # Create an embed of the answer
+                question_title = info['title']
+                emb = discord.Embed(
+                    title= f"Response to: \n{question_title}",
+                    colour= discord.Colour.red()
+                )
+                emb.set_author(name=user.name, icon_url=user.avatar_url)
+                emb.add_field(name='Answer in full:', value=answer_full_string, inline=False)
+                emb.set_footer(text='Upvote')
+
+                clean_up(channel, *messages_to_clean_up)
+                answer_embed_message = await channel.send(embed=emb)
+
+                # Add reactions to the answer embed
+                persist('add', 'messages_data', str(guild_id), answer_embed_message.id, {'author': user.id, 'role': info['role'], 'title': emb.title, 'upvotes': 0, 'pinned': False})
+                index_post(answer_embed_message, 'answer', user, info['role'], emb.title, answer_full_string)
+                await add_reaction(answer_embed_message, '⬆️')
                 
-            # DM the user who made the request that his/her question was answered
-            await original_author.send(f'{user.display_name} just answered your question!')
+                # DM the user who made the request that his/her question was answered
+                dm_dispatcher.send(original_author, f'{user.display_name} just answered your question!', 'answer', message_id)
 
-            await add_user_data(user=user, server_id=guild_id)
-            await add_experience(user=user, exp_points=2, server_id=guild_id) # provide 2 * 1000 exp_point for answering a question
-            await level_up(user=user, channel=channel)
+                await award_experience(user=user, exp_points=2, channel=channel) # provide 2 * 1000 exp_point for answering a question
 
 @bot.event
+@timed('on_raw_reaction_remove')
 @commands.bot_has_permissions(manage_messages=True, manage_roles=True)
 async def on_raw_reaction_remove(payload):
-    prev_messages_data.update(messages_data.copy())
+    if trace is not None:
+        trace_reaction(payload)
     message_id, channel_id, guild_id, user_id = (payload.message_id, payload.channel_id, payload.guild_id, payload.user_id)
 
     if user_id == 741382171515945070: # id of the bot, ignore reactions from the bot itself
         return
+
+    await guild_cache.load(guild_id)
     
     if channel_id != server_info[str(guild_id)]["channel_id"]: # not the configured channel, ignore reaction event
         return
 
-    guild = discord.utils.find(lambda g: g.id == guild_id, bot.guilds)
-    channel = discord.utils.find(lambda c: c.id == channel_id, guild.channels)
-    user = discord.utils.find(lambda u: u.id == user_id, guild.members)
+    guild = await entities.guild(guild_id)
+    channel = await entities.channel(guild, channel_id) if guild is not None else None
+    if channel is None:
+        return
+    user = await entities.member(guild, user_id) # payload.member is only set for reactions being added
+    if user is None: # left the guild or could not be fetched
+        return
 
-    if message_id in reversed(messages_data[str(guild_id)]):
-        try:
-            message = await channel.fetch_message(message_id)
-        except (discord.HTTPException, discord.NotFound):
+    if message_id in messages_data.get(str(guild_id), ()):
+        info = await tracked_message_info(channel, message_id)
+        if info is None:
             await channel.send('Something went wrong, either the original message was not found or a 404 HTTP Error occured.\nSorry for the inconvenience, please retry.')
             return
-
-        # Fetch info about the original embed
-        embed_list = message.embeds
-        message_embed = embed_list[0]
-        message_author = message_embed.author
-        original_author = discord.utils.find(lambda u: u.name == message_author.name, guild.members)  
+        original_author = await entities.member(guild, info['author']) if info['author'] else None
 
         if user == original_author: # Comment this portion out if you want users to react to their own message
             return
 
         # Handle event in case of 'upvote' emote being removed
         if payload.emoji.name == '⬆️':  
-            # Check if removing an upvote decreases upvote count to less than 10, if yes, then unpin it
-            reactions = discord.utils.get(message.reactions, emoji=payload.emoji.name)
-            if reactions and reactions.count < 10 and message.pinned:
-                await message.unpin()     
-
-            await add_user_data(user=original_author, server_id=guild_id)
-            await add_experience(user=original_author, exp_points=-0.25, server_id=guild_id) # deduct 0.25 * 1000 exp_point per upvote
-            await level_up(user=original_author, channel=channel)
+            if original_author is None:
+                return
+
+            # Count the removal before awaiting anything, same as upvotes
+            info = dict(info, upvotes=max(info['upvotes'] - 1, 0))
+            unpin = info['upvotes'] < PIN_UPVOTES and info['pinned']
+            if unpin:
+                info['pinned'] = False
+            persist('update', 'messages_data', str(guild_id), message_id, info)
+
+            experience_batcher.add(user=original_author, exp_points=-0.25, channel=channel) # deduct 0.25 * 1000 exp_point per upvote
+
+            # Unpin the message if removing the upvote dropped it below 10 upvotes
+            if unpin:
+                message = await fetch_tracked_message(channel, message_id)
+                if message is None:
+                    set_pinned(str(guild_id), message_id, True)
+                else:
+                    await message.unpin()
         
         # Handle event in case of 'answer' emote being removed
         if payload.emoji.name == '🔄': 
-            await add_user_data(user=user, server_id=guild_id)
-            await add_experience(user=user, exp_points=-2, server_id=guild_id) # deduct 2 * 1000 exp_point for removing answer emote
-            await level_up(user=user, channel=channel)
+            experience_batcher.add(user=user, exp_points=-2, channel=channel) # deduct 2 * 1000 exp_point for removing answer emote
+
+@bot.event
+@timed('on_raw_message_delete')
+async def on_raw_message_delete(payload):
+    server_id = str(payload.guild_id)
+    if payload.guild_id is None or server_id not in guild_cache: # questions of guilds that aren't loaded expire instead
+        return
+    forget_deleted_messages(server_id, [payload.message_id])
+
+@bot.event
+@timed('on_raw_bulk_message_delete')
+async def on_raw_bulk_message_delete(payload):
+    server_id = str(payload.guild_id)
+    if payload.guild_id is None or server_id not in guild_cache:
+        return
+    forget_deleted_messages(server_id, sorted(payload.message_ids))
 
 # ---------------------- Logger Tasks ---------------------- #
 
 @bot.event
 async def on_command_error(ctx,error):
+    tags = command_log_tags(ctx, 'command_error')
     if isinstance(error, commands.CommandNotFound):
-        logger.warning(str(error))
+        logger.warning(str(error), extra=tags)
         return
     if isinstance(error, commands.BotMissingPermissions):
-        logger.warning(str(error))
+        logger.warning(str(error), extra=tags)
         await ctx.send('The bot does not have the required permissions for this channel.')
         return
     raise error
 
 @bot.event
 async def on_command_completion(ctx):
-    logger.info(f"{ctx.invoked_with} was called successfully by {ctx.author.name}")
+    if 'first_command' not in metrics.histograms['startup_seconds']:
+        metrics.observe('startup_seconds', 'stage', 'first_command', time.monotonic() - STARTED_AT)
+        logger.info(f"First command completed {time.monotonic() - STARTED_AT:.1f}s after start.", extra={'event': 'startup'})
+    logger.info(f"{ctx.invoked_with} was called successfully by {ctx.author.name} ({conversations.in_flight} conversations in flight)", extra=command_log_tags(ctx, 'command'))
     return
 
+@bot.before_invoke
+async def prepare_command(ctx):
+    ctx.started_at = time.perf_counter()
+    if ctx.guild is not None:
+        await guild_cache.load(ctx.guild.id)
+
+def command_log_tags(ctx, event):
+    """
+        Helper function that returns the tags for a command's log record.
+    """
+    tags = {'event': event, 'guild': ctx.guild.id if ctx.guild else None, 'command': ctx.invoked_with}
+    if hasattr(ctx, 'started_at'):
+        seconds = time.perf_counter() - ctx.started_at
+        tags['latency_ms'] = round(seconds * 1000, 1)
+        metrics.observe('command_latency_seconds', 'command', ctx.command.qualified_name if ctx.command else ctx.invoked_with, seconds)
+    return tags
+
 # ---------------------- Run the bot ---------------------- #
 
-bot.run(TOKEN)
\ No newline at end of file
+def run_cluster():
+    """
+        Start one worker process per cluster and wait for them. Guilds never move between shards, so every worker only
+        changes its own guilds' rows in the shared SQLite database.
+    """
+    if STORAGE_BACKEND != 'sqlite':
+        sys.exit("Clusters share one database, set STORAGE_BACKEND=sqlite (see `python programming-helper.py migrate`).")
+
+    workers = []
+    for cluster_id in range(CLUSTER_COUNT):
+        worker_env = dict(os.environ, CLUSTER_ID=str(cluster_id))
+        workers.append(subprocess.Popen([sys.executable, os.path.abspath(__file__)], env=worker_env))
+        print(f"Started cluster {cluster_id} with shards {cluster_shard_ids(cluster_id, CLUSTER_COUNT, SHARD_COUNT)}.")
+        logger.info(f"Started cluster {cluster_id} with pid {workers[-1].pid}.")
+
+    def stop_workers(*_):
+        for worker in workers:
+            worker.terminate()
+    signal.signal(signal.SIGTERM, stop_workers)
+
+    try:
+        for cluster_id, worker in enumerate(workers):
+            code = worker.wait()
+            print(f"Cluster {cluster_id} exited with code {code}.")
+            logger.info(f"Cluster {cluster_id} exited with code {code}.")
+    except KeyboardInterrupt:
+        stop_workers()
+
+if __name__ == '__main__':
+    if sys.argv[1:2] == ['migrate']: # python programming-helper.py migrate [path-to-sqlite-file]
+        migrated = migrate_json_to_sqlite(sys.argv[2] if len(sys.argv) > 2 else SQLITE_FILE)
+        print(f"Migrated {migrated} guild entries into SQLite.")
+    elif sys.argv[1:2] == ['cluster']: # python programming-helper.py cluster
+        run_cluster()
+    else:
+        bot.run(TOKEN)
\ No newline at end of file